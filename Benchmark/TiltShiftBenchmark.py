@@ -0,0 +1,469 @@
+import argparse
+import collections
+import csv
+import json
+import multiprocessing
+import os.path
+import platform
+import sys
+import time
+import timeit
+import numpy as np
+
+# Benchmarks for every Tilt-Shift backend.
+# Runs each backend over synthetic images of several sizes, sweeping the
+# number of passes, the mask shape and (for OpenCL) the local work size.
+# Every case gets warm-up runs, which absorb program builds and JIT
+# compiles, and then a number of timed repetitions, of which the median
+# is reported along with the throughput in megapixels per second.
+# The OpenCL times include the upload and the download of the image.
+# Results can be written as JSON and CSV, and compared to an earlier JSON
+# run to catch backends that have become slower:
+#   python TiltShiftBenchmark.py --sizes 256,1K --json before.json
+#   python TiltShiftBenchmark.py --sizes 256,1K --compare before.json
+
+# The backends live in the Python and OpenCL directories next to this one
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path[:0] = [os.path.join(REPO_DIR, 'Python'), os.path.join(REPO_DIR, 'OpenCL')]
+
+# Synthetic image sizes, as (width, height)
+IMAGE_SIZES = collections.OrderedDict([
+    ('256', (256, 256)),
+    ('512', (512, 512)),
+    ('1K', (1024, 1024)),
+    ('HD', (1920, 1080)),
+    ('4K', (3840, 2160)),
+    ('8K', (7680, 4320)),
+])
+
+# The largest image, in pixels, each backend runs on.  The per-pixel
+# reference takes minutes on anything much larger than 256 x 256.
+MAX_PIXELS = {'reference': 256 * 256}
+
+# The saturation and contrast used for every case, so the grading is timed too
+SAT = 0.1
+CON = 20.0
+
+# The columns of the CSV output, in order
+CSV_FIELDS = ['backend', 'size', 'width', 'height', 'num_passes', 'mask_shape', 'local_size',
+              'status', 'repetitions', 'median_s', 'min_s', 'mean_s', 'megapixels_per_s']
+
+# Raised by a backend for a case it cannot run, with the reason
+class SkipCase(Exception):
+    pass
+
+# Returns a random (h, w, 4) RGBA uint8 image, the same one every time for a size
+def synthetic_image(width, height):
+    rng = np.random.RandomState(width * 100003 + height)
+    return rng.randint(0, 256, (height, width, 4)).astype(np.uint8)
+
+# Returns the focus geometry of a case: the in-focus middle (x, y) and radius
+def focus(case):
+    return case['width'] // 2, case['height'] // 2, max(case['height'] // 8, 1)
+
+# Returns the angle, radius_y and vertices of the shape of a case, for
+# the shapes that use them: a band and an ellipse tilted by 30 degrees,
+# and a diamond around the middle
+def shape_options(case):
+    x, y, radius = focus(case)
+    if case['mask_shape'] == 'band':
+        return {'angle': 30.0}
+    if case['mask_shape'] == 'elliptical':
+        return {'angle': 30.0, 'radius_y': 2 * radius}
+    if case['mask_shape'] == 'polygon':
+        return {'vertices': [(x, y - 2 * radius), (x + 4 * radius, y),
+                             (x, y + 2 * radius), (x - 4 * radius, y)]}
+    return {}
+
+# Returns the focus parameters of a case, for the kernels that evaluate
+# the shape themselves (see focus_params() in TiltShiftMasks.py)
+def focus_for(case):
+    from TiltShiftMasks import focus_params
+    x, y, radius = focus(case)
+    return focus_params(case['mask_shape'], x, y, radius, **shape_options(case))
+
+# Returns the float blur mask of a case, from the mask cache in shared
+def blur_mask_for(case, shared):
+    x, y, radius = focus(case)
+    return shared['mask_cache'].mask(case['width'], case['height'], y, radius,
+                                     case['mask_shape'], x, **shape_options(case))
+
+# Runs num_passes passes of run_pass(input_image, output_image, last_pass)
+# on a copy of image, swapping the images between passes like the scripts do
+def run_pass_loop(run_pass, image, num_passes):
+    input_image = image.copy()
+    output_image = np.zeros_like(image)
+    for pass_num in range(num_passes):
+        run_pass(input_image, output_image, pass_num == num_passes - 1)
+        input_image, output_image = output_image, input_image
+    return input_image
+
+# Returns the OpenCL session shared by all the OpenCL cases, creating it the first time
+def shared_session(shared):
+    if 'session' not in shared:
+        from TiltShiftSession import TiltShiftSession
+        shared['session'] = TiltShiftSession()
+    return shared['session']
+
+# Raises SkipCase if the local size does not fit the device
+def check_local_size(session, case, halo):
+    local_size = case['local_size']
+    if local_size[0] * local_size[1] > session.device.max_work_group_size:
+        raise SkipCase('local size larger than the maximum work group size %s'
+                       % session.device.max_work_group_size)
+    local_bytes = 2 * 4 * (local_size[0] + 2 * halo) * (local_size[1] + 2 * halo)
+    if local_bytes > session.device.local_mem_size:
+        raise SkipCase('local size needs more than %s bytes of local memory'
+                       % session.device.local_mem_size)
+
+# The backends.  Each one takes the image, its blur mask, the case and a
+# dict of things shared between cases (the mask cache and the OpenCL
+# session), and returns a function that runs
+# the case once.
+
+# The per-work-group Python loop of TiltShiftColorBlurMask.py
+def setup_reference(image, blur_mask, case, shared):
+    from TiltShiftColorBlurMask import tiltshift, round_up
+    # The reference writes whole pixels, so it needs an RGB image like the script loads
+    image = np.ascontiguousarray(image[..., :3])
+    height, width = image.shape[:2]
+    local_size = (256, 256)
+    global_size = (round_up(width, local_size[0]), round_up(height, local_size[1]))
+    local_memory = [[]] * (local_size[0] + 2) * (local_size[1] + 2)
+
+    def run_pass(input_image, output_image, last_pass):
+        for group_corner_x in range(0, global_size[0], local_size[0]):
+            for group_corner_y in range(0, global_size[1], local_size[1]):
+                tiltshift(input_image, output_image, local_memory, blur_mask,
+                          width, height,
+                          local_size[0] + 2, local_size[1] + 2, 1,
+                          local_size[0], local_size[1],
+                          SAT, CON, last_pass,
+                          group_corner_x, group_corner_y)
+    return lambda: run_pass_loop(run_pass, image, case['num_passes'])
+
+# The NumPy engine of TiltShiftColorBlurMask.py
+def setup_vectorized(image, blur_mask, case, shared):
+    from TiltShiftColorBlurMask import tiltshift_vectorized
+    height, width = image.shape[:2]
+
+    def run_pass(input_image, output_image, last_pass):
+        tiltshift_vectorized(input_image, output_image, blur_mask,
+                             width, height, SAT, CON, last_pass)
+    return lambda: run_pass_loop(run_pass, image, case['num_passes'])
+
+# The running-sum engine of TiltShiftColorBlurMask.py, one sweep per pass
+def setup_running_sum(image, blur_mask, case, shared):
+    from TiltShiftColorBlurMask import tiltshift_running_sum
+    height, width = image.shape[:2]
+
+    def run():
+        output_image = np.zeros_like(image)
+        return tiltshift_running_sum(image, output_image, blur_mask, width, height,
+                                     8, case['num_passes'], SAT, CON)
+    return run
+
+# The pyramid engine of TiltShiftColorBlurMask.py, blurring the image halved twice
+def setup_pyramid(image, blur_mask, case, shared):
+    from TiltShiftColorBlurMask import tiltshift_pyramid
+    height, width = image.shape[:2]
+
+    def run():
+        output_image = np.zeros_like(image)
+        return tiltshift_pyramid(image, output_image, blur_mask, width, height,
+                                 case['num_passes'], 2, SAT, CON)
+    return run
+
+# TiltShiftMultiprocess.py, one worker per core
+def setup_multiprocess(image, blur_mask, case, shared):
+    from TiltShiftMultiprocess import tiltshift_multiprocess
+    return lambda: tiltshift_multiprocess(image, blur_mask, case['num_passes'], SAT, CON)
+
+# TiltShiftCompiled.py, which only counts as compiled when Numba is installed
+def setup_compiled(image, blur_mask, case, shared):
+    from TiltShiftCompiled import tiltshift_compiled, BACKEND
+    if BACKEND != 'numba':
+        raise SkipCase('Numba is not installed')
+    return lambda: tiltshift_compiled(image, blur_mask, case['num_passes'], SAT, CON)
+
+# The Optimized OpenCL buffer kernels, which evaluate the focus shape themselves
+def setup_opencl(image, blur_mask, case, shared, fused=True):
+    from TiltShiftColorOptimized import tiltshift_rgba
+    session = shared_session(shared)
+    check_local_size(session, case, case['num_passes'] if fused else 1)
+    x, y, radius = focus(case)
+    focus_shape = focus_for(case)
+    return lambda: tiltshift_rgba(session, image, case['num_passes'], SAT, CON, y, radius,
+                                  case['local_size'], fused, images=False, focus=focus_shape)
+
+# The Optimized OpenCL kernel launched once per pass instead of fused
+def setup_opencl_unfused(image, blur_mask, case, shared):
+    return setup_opencl(image, blur_mask, case, shared, fused=False)
+
+# The image2d_t variant of the Optimized kernel, which clamps with a sampler
+def setup_opencl_image(image, blur_mask, case, shared):
+    from TiltShiftColorImage import supports_images, tiltshift_image
+    session = shared_session(shared)
+    if not supports_images(session, case['width'], case['height']):
+        raise SkipCase('the device does not support RGBA8 images of this size')
+    check_local_size(session, case, 1)
+    x, y, radius = focus(case)
+    focus_shape = focus_for(case)
+    return lambda: tiltshift_image(session, image, case['num_passes'], SAT, CON, y, radius,
+                                   case['local_size'], focus=focus_shape)
+
+# The pyramid version of the Optimized kernels, blurring the image halved twice
+def setup_opencl_pyramid(image, blur_mask, case, shared):
+    from TiltShiftColorPyramid import tiltshift_pyramid
+    session = shared_session(shared)
+    check_local_size(session, case, case['num_passes'])
+    x, y, radius = focus(case)
+    focus_shape = focus_for(case)
+    return lambda: tiltshift_pyramid(session, image, case['num_passes'], SAT, CON, y, radius,
+                                     2, case['local_size'], focus=focus_shape)
+
+# The running-sum OpenCL kernels, one sweep of a box of up to 8 pixels per pass
+def setup_opencl_running_sum(image, blur_mask, case, shared):
+    from TiltShiftColorRunningSum import tiltshift_running_sum
+    session = shared_session(shared)
+    check_local_size(session, case, 0)
+    x, y, radius = focus(case)
+    focus_shape = focus_for(case)
+    return lambda: tiltshift_running_sum(session, image, case['num_passes'], SAT, CON, y, radius,
+                                         8, case['local_size'], focus=focus_shape)
+
+# The BaselineBlurMask OpenCL kernel, which reads any mask from the alpha
+# byte, with the mask written into the alpha bytes on the device like the
+# BaselineBlurMask script does
+def setup_opencl_mask(image, blur_mask, case, shared):
+    import pyopencl as cl
+    from TiltShiftColorOptimized import round_up, upload_focus
+    from TiltShiftPixels import RGBA_OPTIONS, as_packed, empty_rgba
+    from TiltShiftColorGrade import contrast_factor
+    session = shared_session(shared)
+    check_local_size(session, case, 1)
+    tiltshift = session.kernel('TiltShiftColorBaselineBlurMask.cl', 'tiltshift', RGBA_OPTIONS)
+    focus_alpha = session.kernel('TiltShiftMaskAlpha.cl', 'focus_alpha', RGBA_OPTIONS)
+
+    focus_shape = focus_for(case)
+    image_combined = as_packed(np.ascontiguousarray(image))
+    height, width = image_combined.shape
+    local_size = case['local_size']
+    global_size = (round_up(width, local_size[0]), round_up(height, local_size[1]))
+    local_memory = cl.LocalMemory(4 * (local_size[0] + 2) * (local_size[1] + 2))
+
+    def run():
+        gpu_image_a = session.get_buffer(image_combined.nbytes)
+        gpu_image_b = session.get_buffer(image_combined.nbytes)
+        cl.enqueue_copy(session.queue, gpu_image_a, image_combined, is_blocking=False)
+        focus_alpha(session.queue, global_size, local_size, gpu_image_a,
+                    np.int32(width), np.int32(height), upload_focus(session, None, None, focus_shape))
+        for pass_num in range(case['num_passes']):
+            tiltshift(session.queue, global_size, local_size,
+                      gpu_image_a, gpu_image_b, local_memory,
+                      np.int32(width), np.int32(height),
+                      np.int32(local_size[0] + 2), np.int32(local_size[1] + 2), np.int32(1),
+                      np.float32(SAT), np.float32(contrast_factor(CON)),
+                      np.int32(pass_num == case['num_passes'] - 1),
+                      np.int32(0), np.int32(0))
+            gpu_image_a, gpu_image_b = gpu_image_b, gpu_image_a
+        rgba_filtered = empty_rgba(height, width)
+        cl.enqueue_copy(session.queue, as_packed(rgba_filtered), gpu_image_a, is_blocking=True)
+        session.release_buffer(gpu_image_a)
+        session.release_buffer(gpu_image_b)
+        return rgba_filtered
+    return run
+
+# The backends by name, and whether the local size matters to them
+BACKENDS = collections.OrderedDict([
+    ('reference', (setup_reference, False)),
+    ('vectorized', (setup_vectorized, False)),
+    ('running_sum', (setup_running_sum, False)),
+    ('pyramid', (setup_pyramid, False)),
+    ('multiprocess', (setup_multiprocess, False)),
+    ('compiled', (setup_compiled, False)),
+    ('opencl', (setup_opencl, True)),
+    ('opencl_unfused', (setup_opencl_unfused, True)),
+    ('opencl_image', (setup_opencl_image, True)),
+    ('opencl_pyramid', (setup_opencl_pyramid, True)),
+    ('opencl_running_sum', (setup_opencl_running_sum, True)),
+    ('opencl_mask', (setup_opencl_mask, True)),
+])
+
+# Returns every case of the sweep, as dicts
+def cases(backends, sizes, passes, local_sizes, mask_shapes):
+    for backend in backends:
+        uses_local_size = BACKENDS[backend][1]
+        for size in sizes:
+            width, height = IMAGE_SIZES[size]
+            for num_passes in passes:
+                for mask_shape in mask_shapes:
+                    for local_size in (local_sizes if uses_local_size else [None]):
+                        yield {'backend': backend, 'size': size,
+                               'width': width, 'height': height,
+                               'num_passes': num_passes, 'mask_shape': mask_shape,
+                               'local_size': local_size}
+
+# Times run: warmup untimed runs, then the time of each of repetitions runs
+def time_runs(run, warmup, repetitions):
+    for i in range(warmup):
+        run()
+    times = []
+    for i in range(repetitions):
+        start = timeit.default_timer()
+        run()
+        times.append(timeit.default_timer() - start)
+    return times
+
+# Runs one case and returns its result, a copy of the case with the timings
+# (or with the reason it was skipped) added
+def run_case(case, warmup, repetitions, shared):
+    result = dict(case)
+    result['local_size'] = '%sx%s' % case['local_size'] if case['local_size'] else ''
+    result['status'] = 'ok'
+    pixels = case['width'] * case['height']
+    try:
+        if pixels > MAX_PIXELS.get(case['backend'], pixels):
+            raise SkipCase('larger than the %s pixels this backend runs on' % MAX_PIXELS[case['backend']])
+        image = synthetic_image(case['width'], case['height'])
+        blur_mask = blur_mask_for(case, shared)
+        setup = BACKENDS[case['backend']][0]
+        try:
+            run = setup(image, blur_mask, case, shared)
+        except ImportError as error:
+            raise SkipCase('cannot import the backend: %s' % error)
+        times = time_runs(run, warmup, repetitions)
+    except SkipCase as reason:
+        result['status'] = 'skipped: %s' % reason
+        return result
+
+    median = float(np.median(times))
+    result.update({'repetitions': repetitions,
+                   'times_s': times,
+                   'median_s': median,
+                   'min_s': min(times),
+                   'mean_s': float(np.mean(times)),
+                   'megapixels_per_s': pixels / 1e6 / median})
+    return result
+
+# Returns what the results were measured on
+def environment(shared):
+    info = {'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'cpu_count': multiprocessing.cpu_count(),
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S')}
+    if 'session' in shared:
+        device = shared['session'].device
+        info['opencl_device'] = device.name
+        info['opencl_platform'] = device.platform.name
+    return info
+
+# The key that matches a result to the same case in another run
+def case_key(result):
+    return (result['backend'], result['width'], result['height'], result['num_passes'],
+            result['mask_shape'], result['local_size'])
+
+# Returns the cases whose median time grew by more than tolerance (0.1 is
+# 10%) since the baseline results, as (result, baseline result) pairs
+def regressions(results, baseline_results, tolerance):
+    baseline = dict((case_key(result), result) for result in baseline_results
+                    if result['status'] == 'ok')
+    slower = []
+    for result in results:
+        before = baseline.get(case_key(result))
+        if result['status'] == 'ok' and before is not None:
+            if result['median_s'] > before['median_s'] * (1 + tolerance):
+                slower.append((result, before))
+    return slower
+
+# Writes the results to a CSV file, one row per case
+def write_csv(path, results):
+    with open(path, 'w') as csv_file:
+        writer = csv.DictWriter(csv_file, CSV_FIELDS, extrasaction='ignore')
+        writer.writeheader()
+        for result in results:
+            writer.writerow(result)
+
+# Prints one line for a result
+def print_result(result):
+    name = '%-15s %-4s %2s passes %-10s %-7s' % (result['backend'], result['size'], result['num_passes'],
+                                                 result['mask_shape'], result['local_size'])
+    if result['status'] == 'ok':
+        print('%s %10.4f s %10.2f MP/s' % (name, result['median_s'], result['megapixels_per_s']))
+    else:
+        print('%s %s' % (name, result['status']))
+
+# Returns a list from a comma separated argument
+def split_list(value):
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+# Returns a (x, y) local size from an argument like 256x2
+def parse_local_size(value):
+    x, y = value.lower().split('x')
+    return int(x), int(y)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the Tilt-Shift backends.')
+    parser.add_argument('--backends', default=','.join(BACKENDS),
+                        help='comma separated backends (default: %(default)s)')
+    parser.add_argument('--sizes', default=','.join(IMAGE_SIZES),
+                        help='comma separated image sizes (default: %(default)s)')
+    parser.add_argument('--passes', default='1,3,5',
+                        help='comma separated numbers of passes (default: %(default)s)')
+    parser.add_argument('--local-sizes', default='256x2,64x4,16x16',
+                        help='comma separated OpenCL local sizes (default: %(default)s)')
+    parser.add_argument('--masks', default='horizontal,circular',
+                        help='comma separated mask shapes: horizontal, circular, band, elliptical '
+                             'or polygon (default: %(default)s)')
+    parser.add_argument('--warmup', type=int, default=1,
+                        help='untimed runs before timing each case (default: %(default)s)')
+    parser.add_argument('--repetitions', type=int, default=5,
+                        help='timed runs of each case (default: %(default)s)')
+    parser.add_argument('--json', help='write the results to this JSON file')
+    parser.add_argument('--csv', help='write the results to this CSV file')
+    parser.add_argument('--compare', help='JSON results of an earlier run to check for regressions against')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='how much slower a case may get before it counts as a regression (default: %(default)s)')
+    args = parser.parse_args()
+
+    backends = split_list(args.backends)
+    sizes = split_list(args.sizes)
+    for name, known in [('backend', BACKENDS), ('size', IMAGE_SIZES)]:
+        unknown = [item for item in (backends if name == 'backend' else sizes) if item not in known]
+        if unknown:
+            parser.error('unknown %s %s, expected one of %s' % (name, ', '.join(unknown), ', '.join(known)))
+    passes = [int(num_passes) for num_passes in split_list(args.passes)]
+    local_sizes = [parse_local_size(local_size) for local_size in split_list(args.local_sizes)]
+    mask_shapes = split_list(args.masks)
+
+    # Imported here so the masks come from the same code the OpenCL scripts use
+    from TiltShiftMasks import BlurMaskCache
+    shared = {'mask_cache': BlurMaskCache()}
+    results = []
+    for case in cases(backends, sizes, passes, local_sizes, mask_shapes):
+        result = run_case(case, args.warmup, args.repetitions, shared)
+        print_result(result)
+        results.append(result)
+
+    report = {'environment': environment(shared),
+              'settings': {'warmup': args.warmup, 'repetitions': args.repetitions,
+                           'sat': SAT, 'con': CON},
+              'results': results}
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(report, json_file, indent=2)
+    if args.csv:
+        write_csv(args.csv, results)
+
+    if args.compare:
+        with open(args.compare) as json_file:
+            baseline_results = json.load(json_file)['results']
+        slower = regressions(results, baseline_results, args.tolerance)
+        for result, before in slower:
+            print('REGRESSION %s %s %s passes %s %s: %.4f s, was %.4f s' %
+                  (result['backend'], result['size'], result['num_passes'], result['mask_shape'],
+                   result['local_size'], result['median_s'], before['median_s']))
+        if slower:
+            sys.exit(1)
@@ -0,0 +1,218 @@
+import pyopencl as cl
+import numpy as np
+import glob
+import os.path
+import sys
+import threading
+import time
+from TiltShiftSession import TiltShiftSession
+from TiltShiftColorOptimized import run_passes
+from TiltShiftPixels import as_packed, empty_rgba
+from TiltShiftImageIO import load_rgba, save_rgba
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+# Batch processing for the Tilt-Shift effect.
+# Instead of loading, converting, blurring, converting back and saving
+# one image at a time, every stage runs at the same time on different
+# images:
+#  - loader threads decode images into RGBA bytes
+#  - the calling thread uploads each image, queues the kernel
+#    passes and a non-blocking download, and keeps up to max_in_flight
+#    images queued on the device before waiting for the oldest one.
+#    Uploads and downloads go on queues of their own, like in
+#    TiltShiftVideo.py, so the next image is uploaded and the last one
+#    downloaded while the passes of this one run
+#  - saver threads encode the filtered images
+# The stages are connected with bounded queues, so only a few images are
+# held in memory however many are in the batch.
+
+# The file types picked up when a directory is given.  .npy frames are
+# memory-mapped rather than decoded (see TiltShiftImageIO.py)
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.npy')
+
+# Marks the end of the images on a queue
+END_OF_BATCH = None
+
+# Returns the images matched by a directory (every image in it) or a glob pattern
+def find_images(path_or_pattern):
+    if os.path.isdir(path_or_pattern):
+        paths = [os.path.join(path_or_pattern, name) for name in os.listdir(path_or_pattern)
+                 if name.lower().endswith(IMAGE_EXTENSIONS)]
+    else:
+        paths = glob.glob(path_or_pattern)
+    return sorted(paths)
+
+# Returns where the filtered version of an image is saved: as .npy for
+# .npy images, so they are never encoded, and as PNG for the others
+def output_path(input_path, output_dir):
+    name, extension = os.path.splitext(os.path.basename(input_path))
+    if extension.lower() != '.npy':
+        extension = '.png'
+    return os.path.join(output_dir, name + '_TiltShift' + extension)
+
+# Loader thread: loads the images named on paths and puts them on loaded
+def loader(paths, loaded, failures):
+    while True:
+        path = paths.get()
+        if path is END_OF_BATCH:
+            loaded.put(END_OF_BATCH)
+            return
+        try:
+            loaded.put((path, load_rgba(path)))
+        except Exception as error:
+            failures.append((path, error))
+
+# Saver thread: saves the filtered images put on finished
+def saver(finished, output_dir, failures):
+    while True:
+        item = finished.get()
+        if item is END_OF_BATCH:
+            return
+        path, image_filtered = item
+        try:
+            save_rgba(output_path(path, output_dir), image_filtered)
+        except Exception as error:
+            failures.append((path, error))
+
+# Applies the tilt-shift effect to every image in input_paths and saves the
+# results in output_dir.  Returns a list of (path, error) for the images
+# that could not be processed.
+def process_batch(session, input_paths, output_dir,
+                  num_passes=3, sat=0.0, con=0.0,
+                  middle_in_focus=600, in_focus_radius=50,
+                  local_size=None, fused=True,
+                  num_loaders=2, num_savers=2, max_in_flight=2):
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    # Bounded queues keep the loaders from decoding the whole batch ahead of the device
+    paths = queue.Queue()
+    loaded = queue.Queue(maxsize=max_in_flight + num_loaders)
+    finished = queue.Queue(maxsize=max_in_flight + num_savers)
+    failures = []
+
+    for path in input_paths:
+        paths.put(path)
+    for i in range(num_loaders):
+        paths.put(END_OF_BATCH)
+
+    threads = ([threading.Thread(target=loader, args=(paths, loaded, failures))
+                for i in range(num_loaders)] +
+               [threading.Thread(target=saver, args=(finished, output_dir, failures))
+                for i in range(num_savers)])
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    # The kernels run on the session queue, while transfers get queues of their own,
+    # with profiling turned on like the session queue so the profiler can time them
+    properties = cl.command_queue_properties.PROFILING_ENABLE
+    upload_queue = cl.CommandQueue(session.context, session.device, properties=properties)
+    download_queue = cl.CommandQueue(session.context, session.device, properties=properties)
+
+    # Images queued on the device, oldest first
+    in_flight = []
+
+    # Waits for the oldest image on the device and hands it to the savers
+    def finish_oldest():
+        path, rgba, image_filtered, buffers, event = in_flight.pop(0)
+        event.wait()
+        for buffer in buffers:
+            session.release_buffer(buffer)
+        finished.put((path, image_filtered))
+
+    loaders_running = num_loaders
+    while loaders_running > 0:
+        item = loaded.get()
+        if item is END_OF_BATCH:
+            loaders_running -= 1
+            continue
+        path, rgba = item
+        image_combined = as_packed(rgba)
+        height, width = image_combined.shape
+
+        # Queue the upload, the passes and the download without waiting on any of them
+        gpu_image_a = session.get_buffer(image_combined.nbytes)
+        gpu_image_b = session.get_buffer(image_combined.nbytes)
+        upload_event = cl.enqueue_copy(upload_queue, gpu_image_a, image_combined, is_blocking=False)
+        session.record(upload_event, 'upload', 'upload', image_combined.nbytes)
+
+        # The passes wait for this image's upload, but not for anything on the other queues
+        cl.enqueue_barrier(session.queue, wait_for=[upload_event])
+        gpu_image_a, gpu_image_b = run_passes(session, gpu_image_a, gpu_image_b, width, height,
+                                              num_passes, sat, con, middle_in_focus, in_focus_radius,
+                                              local_size, fused, rgba=True)
+        kernel_event = cl.enqueue_marker(session.queue)
+
+        image_filtered = empty_rgba(height, width)
+        event = cl.enqueue_copy(download_queue, as_packed(image_filtered), gpu_image_a,
+                                is_blocking=False, wait_for=[kernel_event])
+        session.record(event, 'download', 'download', image_filtered.nbytes)
+        # Start the queues now rather than when the next image is loaded
+        upload_queue.flush()
+        session.queue.flush()
+        download_queue.flush()
+        # rgba is kept until the download is done, since the upload reads from it
+        in_flight.append((path, rgba, image_filtered, [gpu_image_a, gpu_image_b], event))
+
+        if len(in_flight) > max_in_flight:
+            finish_oldest()
+
+    while in_flight:
+        finish_oldest()
+    for i in range(num_savers):
+        finished.put(END_OF_BATCH)
+    for thread in threads:
+        thread.join()
+    return failures
+
+# Run the Tilt-Shift effect on a directory or glob of images:
+#   python TiltShiftBatch.py '../*.png' output_directory
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print("Usage: python TiltShiftBatch.py <directory or glob> <output directory>")
+        sys.exit(1)
+    input_paths = find_images(sys.argv[1])
+    output_dir = sys.argv[2]
+
+    ################################
+    ### USER CHANGEABLE SETTINGS ###
+    ################################
+    # Number of Passes - 3 passes approximates Gaussian Blur
+    num_passes = 3
+    # Saturation - Between 0 and 1
+    sat = 0.0
+    # Contrast - Between -255 and 255
+    con = 0.0
+    # The y-index of the center of the in-focus region
+    middle_in_focus = 600
+    # The number of pixels to either side of the middle_in_focus to keep in focus
+    in_focus_radius = 50
+    # Threads decoding and encoding images while the device is busy
+    num_loaders = 2
+    num_savers = 2
+    # Images queued on the device before waiting for the oldest one
+    max_in_flight = 2
+    ####################################
+    ### END USER CHANGEABLE SETTINGS ###
+    ####################################
+
+    start_time = time.time()
+    session = TiltShiftSession()
+    print("The queue is using the device: %s" % session.queue.device.name)
+    failures = process_batch(session, input_paths, output_dir,
+                             num_passes, sat, con,
+                             middle_in_focus, in_focus_radius,
+                             num_loaders=num_loaders, num_savers=num_savers,
+                             max_in_flight=max_in_flight)
+    end_time = time.time()
+
+    for path, error in failures:
+        print("Failed to process %s: %s" % (path, error))
+    num_done = len(input_paths) - len(failures)
+    print("Processed %s images in %s seconds (%s images per second)" %
+          (num_done, end_time - start_time, num_done / max(end_time - start_time, 1e-9)))
@@ -1,3 +1,6 @@
+#include "TiltShiftPixels.h"
+#include "TiltShiftColorGrade.h"
+
 // A method that takes in a matrix of 3x3 pixels and blurs 
 // the center pixel based on the surrounding pixels, a 
 // bluramount of 1 is full blur and will weight the neighboring
@@ -29,13 +32,13 @@ inline uint boxblur(float blur_amount,
 // All of the work for a workgroup happens in one thread in 
 // this method
 __kernel void
-tiltshift(__global __read_only uint* in_values, 
-          __global __write_only uint* out_values, 
+tiltshift(__global const uint* in_values, 
+          __global uint* out_values, 
           __local uchar4* buf, 
           int w, int h, 
           int buf_w, int buf_h, 
           const int halo,
-          float sat, float con, bool last_pass,
+          float sat, float contrast_factor, int last_pass,
           int focus_m, int focus_r) {
 
     // Global position of output pixel
@@ -118,8 +121,7 @@ tiltshift(__global __read_only uint* in_values,
                     
         // If we're in the last pass, perform the saturation and contrast adjustments as well
         if (last_pass) {
-        //    blurred_pixel = saturation(blurred_pixel, sat);
-        //    blurred_pixel = contrast(blurred_pixel, con);
+            blurred_pixel = pack(color_grade(expand(blurred_pixel), sat, contrast_factor));
         }
         out_values[y * w + x] = blurred_pixel;
     }
@@ -1,12 +1,12 @@
+from __future__ import print_function
 import pyopencl as cl
 import os.path
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib.image as mpimg
-from skimage import color
-from cython.parallel import prange
 import time
 import math
+from TiltShiftColorGrade import contrast_factor
+from TiltShiftSession import default_device
+from TiltShiftProfiler import TiltShiftProfiler
 
 # A basic, parallelized Python implementation of 
 # the Tilt-Shift effect we hope to achieve in OpenCL
@@ -44,6 +44,8 @@ def round_up(global_size, group_size):
 
 # Run a Python implementation of Tilt-Shift (grayscale)
 if __name__ == '__main__':
+    import matplotlib.pyplot as plt
+    import matplotlib.image as mpimg
     # Load the image
     input_image = mpimg.imread('../MITBoathouse.png',0)
     plt.imshow(input_image)    
@@ -56,7 +58,7 @@ if __name__ == '__main__':
     # Convert the image from (h, w, 3) to (h, w), storing the RGB value into an int
     image_combined = (input_image[...,0].astype(np.uint32) << 16) + (input_image[...,1].astype(np.uint32) << 8) + (input_image[...,2].astype(np.uint32) << 0)
     conversion_end_time = time.time()
-    print image_combined.shape
+    print(image_combined.shape)
     
     # Make the placeholders for the output image and output combined
     #output_combined = np.zeros_like(image_combined)
@@ -64,32 +66,35 @@ if __name__ == '__main__':
         
     # List our platforms
     platforms = cl.get_platforms()
-    print 'The platforms detected are:'
-    print '---------------------------'
+    print('The platforms detected are:')
+    print('---------------------------')
     for platform in platforms:
-        print platform.name, platform.vendor, 'version:', platform.version
+        print(platform.name, platform.vendor, 'version:', platform.version)
     
     # List devices in each platform
     for platform in platforms:
-        print 'The devices detected on platform', platform.name, 'are:'
-        print '---------------------------'
+        print('The devices detected on platform', platform.name, 'are:')
+        print('---------------------------')
         for device in platform.get_devices():
-            print device.name, '[Type:', cl.device_type.to_string(device.type), ']'
-            print 'Maximum clock Frequency:', device.max_clock_frequency, 'MHz'
-            print 'Maximum allocable memory size:', int(device.max_mem_alloc_size / 1e6), 'MB'
-            print 'Maximum work group size', device.max_work_group_size
-            print '---------------------------'
+            print(device.name, '[Type:', cl.device_type.to_string(device.type), ']')
+            print('Maximum clock Frequency:', device.max_clock_frequency, 'MHz')
+            print('Maximum allocable memory size:', int(device.max_mem_alloc_size / 1e6), 'MB')
+            print('Maximum work group size', device.max_work_group_size)
+            print('---------------------------')
 
-    # Create a context with all the devices
-    devices = platforms[0].get_devices()
-    context = cl.Context(devices[1:])
-    print 'This context is associated with ', len(context.devices), 'devices'
+    # Create a context with the device to run on: the one TILTSHIFT_DEVICE
+    # selects (a name, type or index, see TiltShiftSession.py) or else the first GPU
+    device = default_device()
+    context = cl.Context([device])
+    print('This context is associated with ', len(context.devices), 'devices')
     
     # Create a queue for transferring data and launching computations.
     # Turn on profiling to allow us to check event times.
-    queue = cl.CommandQueue(context, context.devices[0],
+    queue = cl.CommandQueue(context, device,
                             properties=cl.command_queue_properties.PROFILING_ENABLE)
-    print 'The queue is using the device:', queue.device.name
+    print('The queue is using the device:', queue.device.name)
+    # Record the event of every transfer and kernel to report the device's own times
+    profiler = TiltShiftProfiler()
 
     curdir = os.path.dirname(os.path.realpath(__file__))
     program = cl.Program(context, open('TiltShiftColorBaseline.cl').read()).build(options=['-I', curdir])
@@ -117,7 +122,8 @@ if __name__ == '__main__':
     
     # Send image to the device, non-blocking
     enqueue_start_time = time.time()
-    cl.enqueue_copy(queue, gpu_image_a, image_combined, is_blocking=False)
+    profiler.record(cl.enqueue_copy(queue, gpu_image_a, image_combined, is_blocking=False),
+                    'upload', 'upload', image_combined.nbytes)
     enqueue_end_time = time.time()
     
     ################################
@@ -134,37 +140,43 @@ if __name__ == '__main__':
     # The number of pixels to either side of the middle_in_focus to keep in focus
     in_focus_radius = np.int32(50)
 
-    print "Image Width %s" % width
-    print "Image Height %s" % height
+    print("Image Width %s" % width)
+    print("Image Height %s" % height)
+
+    # The kernel takes the contrast as the factor contrast() works out from it
+    factor = np.float32(contrast_factor(con))
     
     kernel_start_time = time.time()
     # We will perform 3 passes of the bux blur 
     # effect to approximate Gaussian blurring
     for pass_num in range(num_passes):
-        print "In iteration %s of %s" % (pass_num + 1, num_passes)
+        print("In iteration %s of %s" % (pass_num + 1, num_passes))
         # We need to loop over the workgroups here, 
         # because unlike OpenCL, they are not 
         # automatically set up by Python
-        last_pass = np.bool_(False)
+        last_pass = np.int32(False)
         if pass_num == num_passes - 1:
-            print "Last Pass!"
-            last_pass = np.bool_(True)
+            print("Last Pass!")
+            last_pass = np.int32(True)
             
         # Run tilt shift over the group and store the results in host_image_tilt_shifted
         # Loop over all groups and call tiltshift once per group    
-        program.tiltshift(queue, global_size, local_size,
-                          gpu_image_a, gpu_image_b, local_memory, 
-                          width, height, 
-                          buf_width, buf_height, halo,
-                          sat, con, last_pass, 
-                          middle_in_focus, in_focus_radius)
+        event = program.tiltshift(queue, global_size, local_size,
+                                  gpu_image_a, gpu_image_b, local_memory, 
+                                  width, height, 
+                                  buf_width, buf_height, halo,
+                                  sat, factor, last_pass, 
+                                  middle_in_focus, in_focus_radius)
+        # Each pass reads and writes the whole image once
+        profiler.record(event, 'pass %s' % (pass_num + 1), 'kernel', 2 * image_combined.nbytes)
 
         # Now put the output of the last pass into the input of the next pass
         gpu_image_a, gpu_image_b = gpu_image_b, gpu_image_a
     kernel_end_time = time.time()
     
     dequeue_start_time = time.time()
-    cl.enqueue_copy(queue, image_combined, gpu_image_a, is_blocking=True)
+    profiler.record(cl.enqueue_copy(queue, image_combined, gpu_image_a, is_blocking=True),
+                    'download', 'download', image_combined.nbytes)
     dequeue_end_time = time.time()
     
     reconversion_start_time = time.time()
@@ -174,14 +186,19 @@ if __name__ == '__main__':
     reconversion_end_time = time.time()
     
     end_time = time.time()
-    print "####### TIMING BREAKDOWN #######"
-    print "Took %s total seconds to run %s passes" % (end_time - start_time, num_passes)  
-    print "Conversion time was %s seconds" % (conversion_end_time - conversion_start_time) 
-    print "Buf creation time was %s seconds" % (buf_end_time - buf_start_time)
-    print "Enqueue time was %s seconds" % (enqueue_end_time - enqueue_start_time) 
-    print "Kernel time was %s seconds" % (kernel_end_time - kernel_start_time)  
-    print "Dequeue time was %s seconds" % (dequeue_end_time - dequeue_start_time) 
-    print "Reconversion time was %s seconds" % (reconversion_end_time - reconversion_start_time) 
+    print("####### TIMING BREAKDOWN #######")
+    print("Took %s total seconds to run %s passes" % (end_time - start_time, num_passes))
+    print("Conversion time was %s seconds" % (conversion_end_time - conversion_start_time))
+    print("Buf creation time was %s seconds" % (buf_end_time - buf_start_time))
+    print("Enqueue time was %s seconds" % (enqueue_end_time - enqueue_start_time))
+    print("Kernel time was %s seconds" % (kernel_end_time - kernel_start_time))
+    print("Dequeue time was %s seconds" % (dequeue_end_time - dequeue_start_time))
+    print("Reconversion time was %s seconds" % (reconversion_end_time - reconversion_start_time))
+
+    # The times above only measure how long the calls took to return, the
+    # device's own times for each transfer and kernel come from their events
+    print("####### DEVICE TIMING #######")
+    profiler.print_report()
     
     # Display the new image
     plt.imshow(host_image_filtered)    
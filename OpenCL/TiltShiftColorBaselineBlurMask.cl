@@ -1,3 +1,6 @@
+#include "TiltShiftPixels.h"
+#include "TiltShiftColorGrade.h"
+
 // A method that takes in a matrix of 3x3 pixels and blurs 
 // the center pixel based on the surrounding pixels, a 
 // bluramount of 1 is full blur and will weight the neighboring
@@ -18,8 +21,8 @@ inline uint boxblur(uchar4 p0, uchar4 p1, uchar4 p2,
     uchar green_v = (self_blur_amount * p4.z) + (other_blur_amount * (p0.z + p1.z + p2.z + p3.z + p5.z + p6.z + p7.z + p8.z));
     uchar blue_v = (self_blur_amount * p4.w) + (other_blur_amount * (p0.w + p1.w + p2.w + p3.w + p5.w + p6.w + p7.w + p8.w));
         
-    uint blur = (p4.x << 24) + (red_v << 16) + (green_v << 8) + blue_v;
-    return blur;
+    uchar4 blur = {p4.x, red_v, green_v, blue_v};
+    return pack(blur);
 }
 
 // Applies the tilt-shift effect onto an image (grayscale for now)
@@ -29,13 +32,13 @@ inline uint boxblur(uchar4 p0, uchar4 p1, uchar4 p2,
 // All of the work for a workgroup happens in one thread in 
 // this method
 __kernel void
-tiltshift(__global __read_only uint* in_values, 
-          __global __write_only uint* out_values, 
+tiltshift(__global const uint* in_values, 
+          __global uint* out_values, 
           __local uchar4* buf, 
           int w, int h, 
           int buf_w, int buf_h, 
           const int halo,
-          float sat, float con, bool last_pass,
+          float sat, float contrast_factor, int last_pass,
           int focus_m, int focus_r) {
 
     // Global position of output pixel
@@ -80,8 +83,7 @@ tiltshift(__global __read_only uint* in_values,
             }
              
             uint accessed = in_values[((buf_corner_y + tmp_y) * w) + buf_corner_x + tmp_x];
-            uchar4 expanded = {((accessed >> 24) & 0xFF), ((accessed >> 16) & 0xFF), ((accessed >> 8) & 0xFF), ((accessed) & 0xFF)};
-            buf[row * buf_w + idx_1D] = expanded;
+            buf[row * buf_w + idx_1D] = expand(accessed);
         }
     }
 
@@ -105,8 +107,7 @@ tiltshift(__global __read_only uint* in_values,
                     
         // If we're in the last pass, perform the saturation and contrast adjustments as well
         if (last_pass) {
-        //    blurred_pixel = saturation(blurred_pixel, sat);
-        //    blurred_pixel = contrast(blurred_pixel, con);
+            blurred_pixel = pack(color_grade(expand(blurred_pixel), sat, contrast_factor));
         }
         out_values[y * w + x] = blurred_pixel;
     }
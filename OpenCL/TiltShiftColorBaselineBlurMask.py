@@ -1,12 +1,14 @@
+from __future__ import print_function
 import pyopencl as cl
 import os.path
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib.image as mpimg
-from skimage import color
-from cython.parallel import prange
 import time
 import math
+from TiltShiftMasks import focus_params
+from TiltShiftPixels import RGBA_OPTIONS, to_rgba, as_packed, empty_rgba
+from TiltShiftColorGrade import contrast_factor
+from TiltShiftSession import default_device
+from TiltShiftProfiler import TiltShiftProfiler
 
 # A basic, parallelized Python implementation of 
 # the Tilt-Shift effect we hope to achieve in OpenCL
@@ -42,49 +44,42 @@ def round_up(global_size, group_size):
         return global_size
     return global_size + group_size - r
 
-# generates blur mask using focus middle, focus radius, and image height,
-# and stores the blur mask in the blur_mask parameter (np.array)
-def generate_blur_mask(blur_mask, middle_in_focus, in_focus_radius, height):
-    # Calculate blur amount for each pixel based on middle_in_focus and in_focus_radius
-    
-    # find values of y that are within the focus radius
-    #focus_y_max = min(middle_in_focus + in_focus_radius, height - 1)
-    #focus_y_min = max(middle_in_focus - in_focus_radius, 0)
-    #print focus_y_max
-    #print focus_y_min
+# Runs num_passes passes of the blur mask kernel in a TiltShiftSession on
+# the packed RGBA gpu_image_a, whose alpha bytes hold the blur mask, using
+# gpu_image_b as scratch space.  Returns the pair of buffers swapped so
+# that the first one holds the result.  The kernel stages its pixels like
+# the unfused Optimized kernel, so local_size=None uses the local size
+# tuned for that one.
+def run_mask_passes(session, gpu_image_a, gpu_image_b, width, height,
+                    num_passes, sat, con, local_size=None):
+    if local_size is None:
+        local_size = session.tuner.local_size(session, width, 1, False)
+    global_size = (round_up(int(width), local_size[0]), round_up(int(height), local_size[1]))
+    local_memory = cl.LocalMemory(4 * (local_size[0] + 2) * (local_size[1] + 2))
+    tiltshift = session.kernel('TiltShiftColorBaselineBlurMask.cl', 'tiltshift', RGBA_OPTIONS)
+    # Each pass reads and writes the whole image once
+    image_bytes = 2 * 4 * int(width) * int(height)
+
+    for pass_num in range(num_passes):
+        event = tiltshift(session.queue, global_size, local_size,
+                          gpu_image_a, gpu_image_b, local_memory,
+                          np.int32(width), np.int32(height),
+                          np.int32(local_size[0] + 2), np.int32(local_size[1] + 2), np.int32(1),
+                          np.float32(sat), np.float32(contrast_factor(con)),
+                          np.int32(pass_num == num_passes - 1),
+                          np.int32(0), np.int32(0))
+        session.record(event, 'mask pass %s' % (pass_num + 1), 'kernel', image_bytes)
 
-    # Linearly fade out the last 20% on each side to blurry,
-    # so that there is not an abrupt transition
-    no_blur_region = .8 * in_focus_radius
-    
-    # Set blur amount for focus middle
-    #blur_row = np.array([blur_mask])
-    blur_row = np.zeros_like(blur_mask[0], dtype=np.float)
-    blur_mask[middle_in_focus] = blur_row
-    # Simulataneously set blur amount for both rows of same distance from middle
-    # Loop over y first so we can calculate the blur amount
-    for y in xrange(middle_in_focus - in_focus_radius, middle_in_focus):
-        # The blur amount depends on the y-value of the pixel
-        distance_to_m = abs(y - middle_in_focus)
-        # Note: Because we are iterating over all y's in the focus region, all the y's are within
-        # the focus radius.
-        # Thus, we need only check if we should fade to blurry so that there is not an abrupt transition
-        if distance_to_m > no_blur_region:
-            # Calculate blur ammount
-            blur_amount = (1.0 / (in_focus_radius - no_blur_region)) * (distance_to_m - no_blur_region) 
-        else:
-            # No blur
-            blur_amount = 0.0
-        blur_row.fill(blur_amount)
-        if y > 0:
-            blur_mask[y] = blur_row
-        if middle_in_focus + distance_to_m < height:
-            blur_mask[middle_in_focus + distance_to_m] = blur_row
+        # Now put the output of the last pass into the input of the next pass
+        gpu_image_a, gpu_image_b = gpu_image_b, gpu_image_a
+    return gpu_image_a, gpu_image_b
 
 # Run a Python implementation of Tilt-Shift (grayscale)
 if __name__ == '__main__':
-    # Load the image
-    input_image = mpimg.imread('../MITBoathouse.png',0)
+    import matplotlib.pyplot as plt
+    from TiltShiftImageIO import load_rgba, save_rgba
+    # Load the image, decoded straight to RGBA bytes
+    input_image = load_rgba('../MITBoathouse.png')
     plt.imshow(input_image)    
     plt.show()
     
@@ -92,50 +87,55 @@ if __name__ == '__main__':
     start_time = time.time()
     
     conversion_start_time = time.time()
-    # Convert the image from (h, w, 3) to (h, w), storing the RGB value into an int
-    image_combined = (input_image[...,0].astype(np.uint32) << 16) + (input_image[...,1].astype(np.uint32) << 8) + (input_image[...,2].astype(np.uint32) << 0)
+    # Get the image as (h, w, 4) RGBA bytes and view it as (h, w) uints,
+    # one per pixel, without converting it
+    input_rgba = to_rgba(input_image)
+    image_combined = as_packed(input_rgba)
     conversion_end_time = time.time()
-    print image_combined.shape
+    print(image_combined.shape)
     
-    # Make the placeholders for the output image and output combined
-    #output_combined = np.zeros_like(image_combined)
-    host_image_filtered = np.zeros_like(input_image)
+    # Make the placeholder for the output image, which the kernel output is copied straight into
+    host_image_filtered = empty_rgba(*image_combined.shape)
         
     # List our platforms
     platforms = cl.get_platforms()
-    print 'The platforms detected are:'
-    print '---------------------------'
+    print('The platforms detected are:')
+    print('---------------------------')
     for platform in platforms:
-        print platform.name, platform.vendor, 'version:', platform.version
+        print(platform.name, platform.vendor, 'version:', platform.version)
     
     # List devices in each platform
     for platform in platforms:
-        print 'The devices detected on platform', platform.name, 'are:'
-        print '---------------------------'
+        print('The devices detected on platform', platform.name, 'are:')
+        print('---------------------------')
         for device in platform.get_devices():
-            print device.name, '[Type:', cl.device_type.to_string(device.type), ']'
-            print 'Maximum clock Frequency:', device.max_clock_frequency, 'MHz'
-            print 'Maximum allocable memory size:', int(device.max_mem_alloc_size / 1e6), 'MB'
-            print 'Maximum work group size', device.max_work_group_size
-            print '---------------------------'
+            print(device.name, '[Type:', cl.device_type.to_string(device.type), ']')
+            print('Maximum clock Frequency:', device.max_clock_frequency, 'MHz')
+            print('Maximum allocable memory size:', int(device.max_mem_alloc_size / 1e6), 'MB')
+            print('Maximum work group size', device.max_work_group_size)
+            print('---------------------------')
 
-    # Create a context with all the devices
-    devices = platforms[0].get_devices()
-    context = cl.Context(devices[1:])
-    print 'This context is associated with ', len(context.devices), 'devices'
+    # Create a context with the device to run on: the one TILTSHIFT_DEVICE
+    # selects (a name, type or index, see TiltShiftSession.py) or else the first GPU
+    device = default_device()
+    context = cl.Context([device])
+    print('This context is associated with ', len(context.devices), 'devices')
     
     # Create a queue for transferring data and launching computations.
     # Turn on profiling to allow us to check event times.
-    queue = cl.CommandQueue(context, context.devices[0],
+    queue = cl.CommandQueue(context, device,
                             properties=cl.command_queue_properties.PROFILING_ENABLE)
-    print 'The queue is using the device:', queue.device.name
+    print('The queue is using the device:', queue.device.name)
+    # Record the event of every transfer and kernel to report the device's own times
+    profiler = TiltShiftProfiler()
 
     curdir = os.path.dirname(os.path.realpath(__file__))
-    program = cl.Program(context, open('TiltShiftColorBaselineBlurMask.cl').read()).build(options=['-I', curdir])
+    program = cl.Program(context, open('TiltShiftColorBaselineBlurMask.cl').read()).build(options=['-I', curdir] + list(RGBA_OPTIONS))
+    mask_program = cl.Program(context, open('TiltShiftMaskAlpha.cl').read()).build(options=['-I', curdir] + list(RGBA_OPTIONS))
         
     buf_start_time = time.time()
-    gpu_image_a = cl.Buffer(context, cl.mem_flags.READ_WRITE, image_combined.size * 32)
-    gpu_image_b = cl.Buffer(context, cl.mem_flags.READ_WRITE, image_combined.size * 32)
+    gpu_image_a = cl.Buffer(context, cl.mem_flags.READ_WRITE, image_combined.nbytes)
+    gpu_image_b = cl.Buffer(context, cl.mem_flags.READ_WRITE, image_combined.nbytes)
     buf_end_time = time.time()
     
     # These settings for local_size appear to work best on my computer, not entirely sure why
@@ -167,73 +167,94 @@ if __name__ == '__main__':
     middle_in_focus = np.int32(600)
     # The number of pixels to either side of the middle_in_focus to keep in focus
     in_focus_radius = np.int32(50)
+    # The shape of the in-focus region: 'horizontal', 'circular', 'band' (a band
+    # through (middle_in_focus_x, middle_in_focus) tilted by focus_angle degrees)
+    # or 'elliptical' (see TiltShiftMasks.py)
+    focus_shape = 'horizontal'
+    # The x-index of the center of the in-focus region (all but horizontal)
+    middle_in_focus_x = 650
+    focus_angle = 0.0
     ####################################
     ### END USER CHANGEABLE SETTINGS ###
     ####################################
         
-    # Initialize blur mask to be all 1's (completely blurry)
-    # Note: There is one float blur amount per pixel
-    blur_mask = np.ones_like(image_combined, dtype=np.float32)
-    # Generate the blur mask
-    generate_blur_mask(blur_mask, middle_in_focus, in_focus_radius, height)
-    image_combined += ((255 * blur_mask).astype(np.uint32) << 24)
-
     # Send image to the device, non-blocking
-    # This needs to be run after we update the image combined with our new values
     enqueue_start_time = time.time()
-    cl.enqueue_copy(queue, gpu_image_a, image_combined, is_blocking=False)
+    profiler.record(cl.enqueue_copy(queue, gpu_image_a, image_combined, is_blocking=False),
+                    'upload', 'upload', image_combined.nbytes)
     enqueue_end_time = time.time()
+
+    # The kernel reads the blur amount from the alpha byte, so write the blur
+    # mask there on the device, from the focus shape, instead of generating
+    # it on the host and combining it with the image before the upload
+    focus = focus_params(focus_shape, middle_in_focus_x, middle_in_focus, in_focus_radius,
+                         angle=focus_angle)
+    gpu_focus = cl.Buffer(context, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR, hostbuf=focus)
+    event = mask_program.focus_alpha(queue, global_size, local_size,
+                                     gpu_image_a, width, height, gpu_focus)
+    profiler.record(event, 'focus alpha', 'kernel', 2 * image_combined.nbytes)
     
-    print "Image Width %s" % width
-    print "Image Height %s" % height
+    print("Image Width %s" % width)
+    print("Image Height %s" % height)
+
+    # The kernel takes the contrast as the factor contrast() works out from it
+    factor = np.float32(contrast_factor(con))
         
     kernel_start_time = time.time()
     # We will perform 3 passes of the bux blur 
     # effect to approximate Gaussian blurring
     for pass_num in range(num_passes):
-        print "In iteration %s of %s" % (pass_num + 1, num_passes)
+        print("In iteration %s of %s" % (pass_num + 1, num_passes))
         # We need to loop over the workgroups here, 
         # because unlike OpenCL, they are not 
         # automatically set up by Python
-        last_pass = np.bool_(False)
+        last_pass = np.int32(False)
         if pass_num == num_passes - 1:
-            print "Last Pass!"
-            last_pass = np.bool_(True)
+            print("Last Pass!")
+            last_pass = np.int32(True)
             
         # Run tilt shift over the group and store the results in host_image_tilt_shifted
         # Loop over all groups and call tiltshift once per group    
-        program.tiltshift(queue, global_size, local_size,
-                          gpu_image_a, gpu_image_b, local_memory, 
-                          width, height, 
-                          buf_width, buf_height, halo,
-                          sat, con, last_pass, 
-                          middle_in_focus, in_focus_radius)
+        event = program.tiltshift(queue, global_size, local_size,
+                                  gpu_image_a, gpu_image_b, local_memory, 
+                                  width, height, 
+                                  buf_width, buf_height, halo,
+                                  sat, factor, last_pass, 
+                                  middle_in_focus, in_focus_radius)
+        # Each pass reads and writes the whole image once
+        profiler.record(event, 'pass %s' % (pass_num + 1), 'kernel', 2 * image_combined.nbytes)
 
         # Now put the output of the last pass into the input of the next pass
         gpu_image_a, gpu_image_b = gpu_image_b, gpu_image_a
     kernel_end_time = time.time()
     
     dequeue_start_time = time.time()
-    cl.enqueue_copy(queue, image_combined, gpu_image_a, is_blocking=True)
+    profiler.record(cl.enqueue_copy(queue, as_packed(host_image_filtered), gpu_image_a, is_blocking=True),
+                    'download', 'download', image_combined.nbytes)
     dequeue_end_time = time.time()
     
-    reconversion_start_time = time.time()    
-    host_image_filtered[...,0] = ((image_combined >> 16) & 0xFF)
-    host_image_filtered[...,1] = ((image_combined >> 8) & 0xFF)
-    host_image_filtered[...,2] = ((image_combined) & 0xFF)
+    # The output is already RGBA bytes, so there is nothing left to convert.
+    # Its alpha channel still holds the blur mask, so only the colors are shown and saved
+    reconversion_start_time = time.time()
+    host_image_filtered = host_image_filtered[..., :3]
     reconversion_end_time = time.time()
     
     end_time = time.time()
-    print "####### TIMING BREAKDOWN #######"
-    print "Took %s total seconds to run %s passes" % (end_time - start_time, num_passes)  
-    print "Conversion time was %s seconds" % (conversion_end_time - conversion_start_time) 
-    print "Buf creation time was %s seconds" % (buf_end_time - buf_start_time)
-    print "Enqueue time was %s seconds" % (enqueue_end_time - enqueue_start_time) 
-    print "Kernel time was %s seconds" % (kernel_end_time - kernel_start_time)  
-    print "Dequeue time was %s seconds" % (dequeue_end_time - dequeue_start_time) 
-    print "Reconversion time was %s seconds" % (reconversion_end_time - reconversion_start_time) 
+    print("####### TIMING BREAKDOWN #######")
+    print("Took %s total seconds to run %s passes" % (end_time - start_time, num_passes))
+    print("Conversion time was %s seconds" % (conversion_end_time - conversion_start_time))
+    print("Buf creation time was %s seconds" % (buf_end_time - buf_start_time))
+    print("Enqueue time was %s seconds" % (enqueue_end_time - enqueue_start_time))
+    print("Kernel time was %s seconds" % (kernel_end_time - kernel_start_time))
+    print("Dequeue time was %s seconds" % (dequeue_end_time - dequeue_start_time))
+    print("Reconversion time was %s seconds" % (reconversion_end_time - reconversion_start_time))
+
+    # The times above only measure how long the calls took to return, the
+    # device's own times for each transfer and kernel come from their events
+    print("####### DEVICE TIMING #######")
+    profiler.print_report()
     
     # Display the new image
     plt.imshow(host_image_filtered)    
     plt.show()
-    mpimg.imsave("MITBoathouse_TiltShiftColorBaselineBlurMask.png", host_image_filtered)
\ No newline at end of file
+    save_rgba("MITBoathouse_TiltShiftColorBaselineBlurMask.png", host_image_filtered)
\ No newline at end of file
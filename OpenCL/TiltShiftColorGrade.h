@@ -0,0 +1,32 @@
+#ifndef TILTSHIFT_COLOR_GRADE_H
+#define TILTSHIFT_COLOR_GRADE_H
+
+// Color grading shared by the Tilt-Shift kernels, done in the last pass
+// so the image does not need a second trip through the host.
+// Pixels are uchar4s of (alpha, red, green, blue), see TiltShiftPixels.h.
+
+// Adjusts the saturation and then the contrast of a pixel, like
+// saturation() and contrast() in the Python version, on all the channels
+// at once.  contrast_factor is the factor contrast() works out from the
+// contrast value, which the host computes once per image (see
+// TiltShiftColorGrade.py).  The alpha byte is left as it is.
+inline uchar4 color_grade(uchar4 p, float sat, float contrast_factor) {
+    float4 graded = convert_float4(p) * (1 - sat);
+    graded = clamp(contrast_factor * (graded - 128.0f) + 128.0f, 0.0f, 255.0f);
+    uchar4 result = convert_uchar4_sat_rtz(graded);
+    result.x = p.x;
+    return result;
+}
+
+// Grades a pixel by looking its colors up in tone_lut, a (3, 256) table
+// with one row per color, which the host builds from the saturation, the
+// contrast and any tone curve (see tone_lut() in TiltShiftColorGrade.py).
+// The table is small enough for constant memory, which is cached and
+// broadcast when the work items of a group read the same entry.
+// The alpha byte is left as it is.
+inline uchar4 tone_map(uchar4 p, __constant uchar* tone_lut) {
+    uchar4 result = {p.x, tone_lut[p.y], tone_lut[256 + p.z], tone_lut[512 + p.w]};
+    return result;
+}
+
+#endif
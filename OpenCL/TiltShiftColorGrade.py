@@ -0,0 +1,49 @@
+import numpy as np
+
+# Host side of the color grading in TiltShiftColorGrade.h.
+# Saturation and contrast only depend on the 8-bit value of each color,
+# so instead of working them out for every pixel they can be looked up
+# in a table of the 256 possible results.  The Optimized kernels take a
+# (3, 256) byte table in constant memory, one row per color, which holds
+# the saturation and contrast adjustments followed by an optional tone
+# curve, so any grading can be done in the last pass.
+
+# Returns the factor contrast() scales the distance of each color from 128
+# by, for a contrast between -255 and 255.  The kernels take this factor
+# instead of the contrast, so it is worked out once rather than per pixel.
+def contrast_factor(con):
+    return (259 * (con + 255)) / float(255 * (259 - con))
+
+# Returns a tone curve as a (3, 256) uint8 table, one row per color.
+# The curve can be a table of 256 outputs used for all three colors, a
+# (3, 256) table, or a list of (input, output) control points which are
+# linearly interpolated between.
+def tone_curve_table(tone_curve):
+    table = np.asarray(tone_curve, dtype=np.float64)
+    if table.ndim == 2 and table.shape[1] == 2:
+        x, y = table[np.argsort(table[:, 0])].T
+        table = np.round(np.interp(np.arange(256), x, y))
+    if table.shape == (256,):
+        table = np.tile(table, (3, 1))
+    if table.shape != (3, 256):
+        raise ValueError('A tone curve is 256 outputs, 3 x 256 outputs or a list of '
+                         '(input, output) points, not an array of shape %s' % (table.shape,))
+    return np.clip(table, 0, 255).astype(np.uint8)
+
+# Returns the (3, 256) uint8 table the Optimized kernels grade colors with:
+# saturation() and then contrast(), truncated to a byte like the kernels
+# do, followed by tone_curve if there is one
+def tone_lut(sat, con, tone_curve=None):
+    values = np.arange(256, dtype=np.float64) * (1 - sat)
+    graded = np.clip(contrast_factor(con) * (values - 128) + 128, 0, 255).astype(np.uint8)
+    lut = np.tile(graded, (3, 1))
+    if tone_curve is not None:
+        lut = tone_curve_table(tone_curve)[np.arange(3)[:, np.newaxis], lut]
+    return np.ascontiguousarray(lut)
+
+# Applies a (3, 256) table to the colors of an (h, w, 3) or (h, w, 4) uint8
+# image on the host, by indexing the table with the image.  Alpha is kept.
+def apply_tone_lut(image, lut):
+    graded = image.copy()
+    graded[..., :3] = lut[np.arange(3), image[..., :3]]
+    return graded
@@ -0,0 +1,90 @@
+#include "TiltShiftPixels.h"
+#include "TiltShiftColorGrade.h"
+#include "TiltShiftFocus.h"
+
+// The image variant of the tiltshift kernel in TiltShiftColorOptimized.cl.
+// The image is an RGBA8 image2d_t instead of a buffer of uints, so
+//  - the sampler clamps the neighbours of edge pixels to the edge of the
+//    image, instead of clamping the halo coordinates by hand, and
+//  - the texture path unpacks and normalizes the pixels, instead of
+//    shifting and masking each uint.
+// The texture cache serves the neighbouring pixels that the buffer kernel
+// stages in local memory.  The colors are scaled back to 0-255 and blurred
+// exactly as in the buffer kernel, so the output is the same.
+// The program is built with RGBA_OPTIONS, so that boxblur()'s packed
+// result unpacks with expand().
+
+__constant sampler_t clamped = CLK_NORMALIZED_COORDS_FALSE |
+                               CLK_ADDRESS_CLAMP_TO_EDGE |
+                               CLK_FILTER_NEAREST;
+
+// Reads a pixel as (alpha, red, green, blue) bytes, like expand()
+inline uchar4 read_pixel(read_only image2d_t image, int x, int y) {
+    // read_imagef() returns c / 255 for a byte c, which rounds back to c exactly
+    uchar4 rgba = convert_uchar4_sat_rte(read_imagef(image, clamped, (int2)(x, y)) * 255.0f);
+    uchar4 pixel = {rgba.w, rgba.x, rgba.y, rgba.z};
+    return pixel;
+}
+
+// Blurs the center pixel of a 3x3 neighbourhood, the same way as
+// boxblur() in TiltShiftColorOptimized.cl
+inline uint boxblur(float blur_amount,
+                     uchar4 p0, uchar4 p1, uchar4 p2,
+                     uchar4 p3, uchar4 p4, uchar4 p5,
+                     uchar4 p6, uchar4 p7, uchar4 p8) {
+
+    // Calculate the blur amount for the central and
+    // neighboring pixels
+    float self_blur_amount = (9 - (blur_amount * 8)) / 9.0;
+    float other_blur_amount = blur_amount / 9.0;
+
+    // Sum a weighted average of self and others based on the blur amount
+    uchar red_v = (self_blur_amount * p4.y) + (other_blur_amount * (p0.y + p1.y + p2.y + p3.y + p5.y + p6.y + p7.y + p8.y));
+    uchar green_v = (self_blur_amount * p4.z) + (other_blur_amount * (p0.z + p1.z + p2.z + p3.z + p5.z + p6.z + p7.z + p8.z));
+    uchar blue_v = (self_blur_amount * p4.w) + (other_blur_amount * (p0.w + p1.w + p2.w + p3.w + p5.w + p6.w + p7.w + p8.w));
+
+    uchar4 blur = {p4.x, red_v, green_v, blue_v};
+    return pack(blur);
+}
+
+// Runs one pass of the tilt-shift effect from in_image into out_image
+__kernel void
+tiltshift_image(read_only image2d_t in_image,
+                write_only image2d_t out_image,
+                int w, int h,
+                __constant uchar* tone_lut, int last_pass,
+                __constant float* focus) {
+
+    // Global position of output pixel
+    const int x = get_global_id(0);
+    const int y = get_global_id(1);
+
+    // Stay in bounds check is necessary due to possible
+    // images with size not nicely divisible by workgroup size
+    if ((y < h) && (x < w)) {
+        // The sampler clamps the neighbours outside the image to its edge
+        uchar4 p0 = read_pixel(in_image, x - 1, y - 1);
+        uchar4 p1 = read_pixel(in_image, x, y - 1);
+        uchar4 p2 = read_pixel(in_image, x + 1, y - 1);
+        uchar4 p3 = read_pixel(in_image, x - 1, y);
+        uchar4 p4 = read_pixel(in_image, x, y);
+        uchar4 p5 = read_pixel(in_image, x + 1, y);
+        uchar4 p6 = read_pixel(in_image, x - 1, y + 1);
+        uchar4 p7 = read_pixel(in_image, x, y + 1);
+        uchar4 p8 = read_pixel(in_image, x + 1, y + 1);
+
+        // The blur amount depends on where the pixel is in the focus shape
+        float blur_amount = focus_blur_amount(x, y, focus);
+        uchar4 blurred_pixel = expand(boxblur(blur_amount, p0, p1, p2, p3, p4, p5, p6, p7, p8));
+
+        // If we're in the last pass, perform the saturation and contrast adjustments as well,
+        // along with any tone curve, by looking the colors up in the tone table
+        if (last_pass) {
+            blurred_pixel = tone_map(blurred_pixel, tone_lut);
+        }
+
+        // write_imagef() rounds c / 255 back to the byte c
+        float4 rgba = {blurred_pixel.y, blurred_pixel.z, blurred_pixel.w, blurred_pixel.x};
+        write_imagef(out_image, (int2)(x, y), rgba / 255.0f);
+    }
+}
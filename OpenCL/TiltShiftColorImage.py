@@ -0,0 +1,134 @@
+import pyopencl as cl
+import numpy as np
+import sys
+import time
+from TiltShiftSession import TiltShiftSession
+from TiltShiftPixels import RGBA_OPTIONS, empty_rgba
+from TiltShiftColorOptimized import round_up, upload_tone_lut, upload_focus
+
+# The image2d_t variant of the Optimized Tilt-Shift kernels.
+# Instead of a buffer of uints, the image lives in an RGBA8 OpenCL image,
+# and the kernel (see TiltShiftColorImage.cl) reads it through a sampler
+# that clamps to the edge, so the hardware handles the edges of the image
+# and unpacks the pixels.  The output is the same as the buffer kernels'.
+# Not every device supports images, so supports_images() checks before
+# tiltshift_rgba() (see TiltShiftColorOptimized.py) picks this path.
+
+# The pixel format of the images: the bytes of an (h, w, 4) RGBA uint8 array
+IMAGE_FORMAT = (cl.channel_order.RGBA, cl.channel_type.UNORM_INT8)
+
+# Returns whether the session's device can run the image kernel on a
+# width x height image
+def supports_images(session, width, height):
+    device = session.device
+    if not device.image_support:
+        return False
+    if width > device.image2d_max_width or height > device.image2d_max_height:
+        return False
+    formats = cl.get_supported_image_formats(session.context, cl.mem_flags.READ_WRITE,
+                                             cl.mem_object_type.IMAGE2D)
+    return any((image_format.channel_order, image_format.channel_data_type) == IMAGE_FORMAT
+               for image_format in formats)
+
+# Runs num_passes passes of the image kernel on gpu_image_a, using
+# gpu_image_b as scratch space, like run_passes().  Returns the pair of
+# images swapped so that the first one holds the result.
+# local_size=None leaves the work-group size to the driver, since the
+# kernel has no local memory to size.  focus is the focus shape from
+# focus_params(), or None for the horizontal band.
+def run_image_passes(session, gpu_image_a, gpu_image_b, width, height,
+                     num_passes, sat, con, middle_in_focus, in_focus_radius,
+                     local_size=None, tone_curve=None, focus=None):
+    if local_size is None:
+        global_size = (int(width), int(height))
+    else:
+        global_size = (round_up(int(width), local_size[0]), round_up(int(height), local_size[1]))
+    # Each launch reads and writes the whole image once
+    image_bytes = 2 * 4 * int(width) * int(height)
+    gpu_tone_lut = upload_tone_lut(session, sat, con, tone_curve)
+    gpu_focus = upload_focus(session, middle_in_focus, in_focus_radius, focus)
+    tiltshift = session.kernel('TiltShiftColorImage.cl', 'tiltshift_image', RGBA_OPTIONS)
+
+    for pass_num in range(num_passes):
+        last_pass = np.int32(pass_num == num_passes - 1)
+        event = tiltshift(session.queue, global_size, local_size,
+                          gpu_image_a, gpu_image_b,
+                          np.int32(width), np.int32(height),
+                          gpu_tone_lut, last_pass, gpu_focus)
+        session.record(event, 'image pass %s' % (pass_num + 1), 'kernel', image_bytes)
+
+        # Now put the output of the last pass into the input of the next pass
+        gpu_image_a, gpu_image_b = gpu_image_b, gpu_image_a
+    return gpu_image_a, gpu_image_b
+
+# Applies the tilt-shift effect to an (h, w, 4) RGBA uint8 image with the
+# image kernel, and returns the filtered RGBA image
+def tiltshift_image(session, rgba,
+                    num_passes=3, sat=0.0, con=0.0,
+                    middle_in_focus=600, in_focus_radius=50,
+                    local_size=None, tone_curve=None, focus=None):
+    rgba = np.ascontiguousarray(rgba)
+    height, width = rgba.shape[:2]
+    gpu_image_a = session.get_image(width, height)
+    gpu_image_b = session.get_image(width, height)
+
+    session.record(cl.enqueue_copy(session.queue, gpu_image_a, rgba, origin=(0, 0),
+                                   region=(width, height), is_blocking=False),
+                   'upload', 'upload', rgba.nbytes)
+    gpu_image_a, gpu_image_b = run_image_passes(session, gpu_image_a, gpu_image_b, width, height,
+                                                num_passes, sat, con, middle_in_focus, in_focus_radius,
+                                                local_size, tone_curve, focus)
+    rgba_filtered = empty_rgba(height, width)
+    session.record(cl.enqueue_copy(session.queue, rgba_filtered, gpu_image_a, origin=(0, 0),
+                                   region=(width, height), is_blocking=True),
+                   'download', 'download', rgba_filtered.nbytes)
+
+    session.release_image(gpu_image_a)
+    session.release_image(gpu_image_b)
+    return rgba_filtered
+
+# Check the image kernel against the buffer kernel on an image, and time both:
+#   python TiltShiftColorImage.py ../MITBoathouse.png
+if __name__ == '__main__':
+    from TiltShiftImageIO import load_rgba
+    from TiltShiftColorOptimized import tiltshift_rgba
+    if len(sys.argv) != 2:
+        print("Usage: python TiltShiftColorImage.py <image>")
+        sys.exit(1)
+
+    ################################
+    ### USER CHANGEABLE SETTINGS ###
+    ################################
+    # Number of Passes - 3 passes approximates Gaussian Blur
+    num_passes = 3
+    # Saturation - Between 0 and 1
+    sat = 0.0
+    # Contrast - Between -255 and 255
+    con = 0.0
+    # The y-index of the center of the in-focus region
+    middle_in_focus = 600
+    # The number of pixels to either side of the middle_in_focus to keep in focus
+    in_focus_radius = 50
+    ####################################
+    ### END USER CHANGEABLE SETTINGS ###
+    ####################################
+
+    rgba = load_rgba(sys.argv[1])
+    height, width = rgba.shape[:2]
+    session = TiltShiftSession()
+    print("The queue is using the device: %s" % session.queue.device.name)
+    if not supports_images(session, width, height):
+        print("The device does not support %sx%s RGBA8 images" % (width, height))
+        sys.exit(1)
+
+    start_time = time.time()
+    rgba_buffer = tiltshift_rgba(session, rgba, num_passes, sat, con,
+                                 middle_in_focus, in_focus_radius, fused=False, images=False)
+    buffer_time = time.time() - start_time
+    start_time = time.time()
+    rgba_image = tiltshift_image(session, rgba, num_passes, sat, con,
+                                 middle_in_focus, in_focus_radius)
+    image_time = time.time() - start_time
+
+    print("Buffer kernel took %s seconds, image kernel %s seconds" % (buffer_time, image_time))
+    print("Pixels that differ: %s" % np.count_nonzero(np.any(rgba_buffer != rgba_image, axis=2)))
@@ -1,3 +1,7 @@
+#include "TiltShiftPixels.h"
+#include "TiltShiftColorGrade.h"
+#include "TiltShiftFocus.h"
+
 // A method that takes in a matrix of 3x3 pixels and blurs 
 // the center pixel based on the surrounding pixels, a 
 // bluramount of 1 is full blur and will weight the neighboring
@@ -18,8 +22,8 @@ inline uint boxblur(float blur_amount,
     uchar green_v = (self_blur_amount * p4.z) + (other_blur_amount * (p0.z + p1.z + p2.z + p3.z + p5.z + p6.z + p7.z + p8.z));
     uchar blue_v = (self_blur_amount * p4.w) + (other_blur_amount * (p0.w + p1.w + p2.w + p3.w + p5.w + p6.w + p7.w + p8.w));
         
-    uint blur = (red_v << 16) + (green_v << 8) + blue_v;
-    return blur;
+    uchar4 blur = {p4.x, red_v, green_v, blue_v};
+    return pack(blur);
 }
 
 // Applies the tilt-shift effect onto an image (grayscale for now)
@@ -29,14 +33,14 @@ inline uint boxblur(float blur_amount,
 // All of the work for a workgroup happens in one thread in 
 // this method
 __kernel void
-tiltshift(__global __read_only uint* in_values, 
-          __global __write_only uint* out_values, 
+tiltshift(__global const uint* in_values, 
+          __global uint* out_values, 
           __local uchar4* buf, 
           int w, int h, 
           int buf_w, int buf_h, 
           const int halo,
-          float sat, float con, bool last_pass,
-          int focus_m, int focus_r) {
+          __constant uchar* tone_lut, int last_pass,
+          __constant float* focus) {
 
     // Global position of output pixel
     const int x = get_global_id(0);
@@ -80,25 +84,14 @@ tiltshift(__global __read_only uint* in_values,
             }
              
             uint accessed = in_values[((buf_corner_y + tmp_y) * w) + buf_corner_x + tmp_x];
-            uchar4 expanded = {0, ((accessed >> 16) & 0xFF), ((accessed >> 8) & 0xFF), ((accessed) & 0xFF)};
-            buf[row * buf_w + idx_1D] = expanded;
+            buf[row * buf_w + idx_1D] = expand(accessed);
         }
     }
 
     barrier(CLK_LOCAL_MEM_FENCE);
     
-    // The blur amount depends on the y-value of the pixel
-    float blur_amount = 1.0;
-    int distance_to_m = abs(y - focus_m);
-
-    // The edge of the in-focus area should fade to blurry so that there is not an abrupt transition
-    float no_blur_region = .8 * focus_r;
-    // If it is within the middle 90% then don't have any blur at all, but then linearly increase to 1.0
-    if (distance_to_m < no_blur_region) {
-        blur_amount = 0;
-    } else if (distance_to_m < focus_r) {
-        blur_amount = (1.0 / (focus_r - no_blur_region)) * (distance_to_m - no_blur_region);
-    }
+    // The blur amount depends on where the pixel is in the focus shape
+    float blur_amount = focus_blur_amount(x, y, focus);
 
     // Stay in bounds check is necessary due to possible 
     // images with size not nicely divisible by workgroup size
@@ -116,11 +109,120 @@ tiltshift(__global __read_only uint* in_values,
         // Perform boxblur
         uint blurred_pixel = boxblur(blur_amount, p0, p1, p2, p3, p4, p5, p6, p7, p8);
                     
-        // If we're in the last pass, perform the saturation and contrast adjustments as well
+        // If we're in the last pass, perform the saturation and contrast adjustments as well,
+        // along with any tone curve, by looking the colors up in the tone table
         if (last_pass) {
-        //    blurred_pixel = saturation(blurred_pixel, sat);
-        //    blurred_pixel = contrast(blurred_pixel, con);
+            blurred_pixel = pack(tone_map(expand(blurred_pixel), tone_lut));
         }
         out_values[y * w + x] = blurred_pixel;
     }
+}
+
+// Applies all num_passes passes of the tilt-shift effect in one launch.
+// Each work group loads its tile plus a num_passes-pixel halo into local
+// memory once, then runs every pass inside local memory, ping-ponging
+// between buf_a and buf_b.  Each pass needs one more pixel of halo than
+// the next, so the area that gets blurred shrinks by one pixel per pass
+// until only the tile itself is left, and only that final result is
+// written back to global memory.
+// Neighbours outside the image are clamped to the edge of the image, so
+// the output is the same as launching tiltshift() num_passes times.
+__kernel void
+tiltshift_fused(__global const uint* in_values, 
+                __global uint* out_values, 
+                __local uchar4* buf_a, 
+                __local uchar4* buf_b, 
+                int w, int h, 
+                int buf_w, int buf_h, 
+                const int num_passes,
+                __constant uchar* tone_lut,
+                __constant float* focus) {
+
+    // Global position of output pixel
+    const int x = get_global_id(0);
+    const int y = get_global_id(1);
+
+    // Local position relative to (0, 0) in workgroup
+    const int lx = get_local_id(0);
+    const int ly = get_local_id(1);
+
+    // The halo needs one pixel per pass
+    const int halo = num_passes;
+
+    // coordinates of the upper left corner of the buffer in image
+    // space, including halo
+    const int buf_corner_x = x - lx - halo;
+    const int buf_corner_y = y - ly - halo;
+
+    // 1D index of thread within our work-group, and the number of
+    // threads that share the loading and blurring of the buffer
+    const int idx_1D = ly * get_local_size(0) + lx;
+    const int group_size = get_local_size(0) * get_local_size(1);
+
+    __local uchar4* src = buf_a;
+    __local uchar4* dst = buf_b;
+    __local uchar4* tmp;
+
+    int i, pass_num;
+
+    // Load the tile and its halo, clamping to the edge of the image
+    for (i = idx_1D; i < buf_w * buf_h; i += group_size) {
+        int img_x = clamp(buf_corner_x + (i % buf_w), 0, w - 1);
+        int img_y = clamp(buf_corner_y + (i / buf_w), 0, h - 1);
+        src[i] = expand(in_values[img_y * w + img_x]);
+    }
+
+    barrier(CLK_LOCAL_MEM_FENCE);
+
+    for (pass_num = 0; pass_num < num_passes; pass_num++) {
+        // The part of the buffer that can be blurred in this pass
+        const int margin = pass_num + 1;
+
+        for (i = idx_1D; i < buf_w * buf_h; i += group_size) {
+            const int buf_x = i % buf_w;
+            const int buf_y = i / buf_w;
+            const int img_x = buf_corner_x + buf_x;
+            const int img_y = buf_corner_y + buf_y;
+
+            // Pixels outside the image are never blurred, their neighbours
+            // read the clamped in-image pixel instead
+            if ((buf_x >= margin) && (buf_x < buf_w - margin) &&
+                (buf_y >= margin) && (buf_y < buf_h - margin) &&
+                (img_x < w) && (img_y < h) && (img_x >= 0) && (img_y >= 0)) {
+                // Buffer columns and rows of the neighbours, clamped to the image
+                const int left = max(img_x - 1, 0) - buf_corner_x;
+                const int right = min(img_x + 1, w - 1) - buf_corner_x;
+                const int up = max(img_y - 1, 0) - buf_corner_y;
+                const int down = min(img_y + 1, h - 1) - buf_corner_y;
+
+                uchar4 p0 = src[(up * buf_w) + left];
+                uchar4 p1 = src[(up * buf_w) + buf_x];
+                uchar4 p2 = src[(up * buf_w) + right];
+                uchar4 p3 = src[(buf_y * buf_w) + left];
+                uchar4 p4 = src[(buf_y * buf_w) + buf_x];
+                uchar4 p5 = src[(buf_y * buf_w) + right];
+                uchar4 p6 = src[(down * buf_w) + left];
+                uchar4 p7 = src[(down * buf_w) + buf_x];
+                uchar4 p8 = src[(down * buf_w) + right];
+
+                float blur_amount = focus_blur_amount(img_x, img_y, focus);
+                dst[i] = expand(boxblur(blur_amount, p0, p1, p2, p3, p4, p5, p6, p7, p8));
+            }
+        }
+
+        barrier(CLK_LOCAL_MEM_FENCE);
+
+        // The output of this pass is the input of the next one
+        tmp = src;
+        src = dst;
+        dst = tmp;
+    }
+
+    // Stay in bounds check is necessary due to possible 
+    // images with size not nicely divisible by workgroup size
+    if ((y < h) && (x < w)) {
+        // Perform the saturation and contrast adjustments, and any tone curve, on the final result
+        uint blurred_pixel = pack(tone_map(src[((ly + halo) * buf_w) + lx + halo], tone_lut));
+        out_values[y * w + x] = blurred_pixel;
+    }
 }
\ No newline at end of file
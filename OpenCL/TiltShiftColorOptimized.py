@@ -1,12 +1,15 @@
+from __future__ import print_function
 import pyopencl as cl
 import os.path
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib.image as mpimg
-from skimage import color
-from cython.parallel import prange
 import time
 import math
+from TiltShiftSession import TiltShiftSession
+from TiltShiftTuner import loads_halo
+from TiltShiftProfiler import TiltShiftProfiler
+from TiltShiftPixels import RGBA_OPTIONS, to_rgba, as_packed, empty_rgba
+from TiltShiftColorGrade import tone_lut
+from TiltShiftMasks import focus_params
 
 # A basic, parallelized Python implementation of 
 # the Tilt-Shift effect we hope to achieve in OpenCL
@@ -42,10 +45,185 @@ def round_up(global_size, group_size):
         return global_size
     return global_size + group_size - r
 
+# Runs num_passes passes of the tilt-shift kernel on the packed image in
+# gpu_image_a, using gpu_image_b as scratch space.  Returns the pair of
+# buffers swapped so that the first one holds the result.
+# With rgba=True the buffers hold RGBA bytes (see TiltShiftPixels.py)
+# instead of 0x00RRGGBB uints.  tone_curve is an optional tone curve
+# applied after the saturation and contrast (see TiltShiftColorGrade.py).
+# local_size=None uses the local size tuned for the device and the width
+# (see TiltShiftTuner.py).  The in-focus region is a horizontal band of
+# in_focus_radius around row middle_in_focus, unless focus holds the
+# parameters of another shape from focus_params() (see TiltShiftMasks.py).
+def run_passes(session, gpu_image_a, gpu_image_b, width, height,
+               num_passes, sat, con, middle_in_focus, in_focus_radius,
+               local_size, fused, rgba=False, tone_curve=None, focus=None):
+    options = RGBA_OPTIONS if rgba else ()
+    if local_size is None:
+        local_size = session.tuner.local_size(session, width, num_passes, fused, rgba)
+    global_size = (round_up(int(width), local_size[0]), round_up(int(height), local_size[1]))
+    # Each launch reads and writes the whole image once
+    image_bytes = 2 * 4 * int(width) * int(height)
+    width = np.int32(width)
+    height = np.int32(height)
+    gpu_tone_lut = upload_tone_lut(session, sat, con, tone_curve)
+    gpu_focus = upload_focus(session, middle_in_focus, in_focus_radius, focus)
+
+    if fused:
+        # One launch runs every pass, and only the final result is written to gpu_image_b.
+        # It needs a num_passes-pixel halo on all sides, 
+        # and two buffers of 4-byte pixels to ping-pong between passes
+        halo = np.int32(num_passes)
+        buf_width = np.int32(local_size[0] + 2 * halo)
+        buf_height = np.int32(local_size[1] + 2 * halo)
+        local_memory_a = cl.LocalMemory(4 * buf_width * buf_height)
+        local_memory_b = cl.LocalMemory(4 * buf_width * buf_height)
+        event = session.kernel('TiltShiftColorOptimized.cl', 'tiltshift_fused', options)(
+            session.queue, global_size, local_size,
+            gpu_image_a, gpu_image_b, 
+            local_memory_a, local_memory_b,
+            width, height, 
+            buf_width, buf_height, halo,
+            gpu_tone_lut, gpu_focus)
+        session.record(event, 'fused %s passes' % num_passes, 'kernel', image_bytes)
+        return gpu_image_b, gpu_image_a
+
+    # We will perform 3 passes of the bux blur 
+    # effect to approximate Gaussian blurring
+    for pass_num in range(num_passes):
+        run_pass(session, gpu_image_a, gpu_image_b, width, height, gpu_tone_lut,
+                 pass_num == num_passes - 1, gpu_focus,
+                 local_size, rgba, 'pass %s' % (pass_num + 1))
+
+        # Now put the output of the last pass into the input of the next pass
+        gpu_image_a, gpu_image_b = gpu_image_b, gpu_image_a
+    return gpu_image_a, gpu_image_b
+
+# Uploads the table the kernels grade the colors with in the last pass,
+# built once from the saturation, the contrast and the tone curve, and
+# returns its buffer.  The buffer goes back to the pool straight away,
+# since anything that writes to it later is queued behind the kernels
+# that read it.
+def upload_tone_lut(session, sat, con, tone_curve=None):
+    lut = tone_lut(sat, con, tone_curve)
+    gpu_tone_lut = session.get_buffer(lut.nbytes, cl.mem_flags.READ_ONLY)
+    session.record(cl.enqueue_copy(session.queue, gpu_tone_lut, lut, is_blocking=False),
+                   'tone table', 'upload', lut.nbytes)
+    session.release_buffer(gpu_tone_lut)
+    return gpu_tone_lut
+
+# Uploads the focus parameters the kernels work out the blur amount of each
+# pixel from, and returns their buffer, which goes back to the pool like the
+# tone table's.  Without focus the region is a horizontal band of
+# in_focus_radius around row middle_in_focus.
+def upload_focus(session, middle_in_focus, in_focus_radius, focus=None):
+    if focus is None:
+        focus = focus_params('horizontal', None, middle_in_focus, in_focus_radius)
+    gpu_focus = session.get_buffer(focus.nbytes, cl.mem_flags.READ_ONLY)
+    session.record(cl.enqueue_copy(session.queue, gpu_focus, focus, is_blocking=False),
+                   'focus', 'upload', focus.nbytes)
+    session.release_buffer(gpu_focus)
+    return gpu_focus
+
+# Runs a single pass of the (unfused) tilt-shift kernel from gpu_image_a
+# into gpu_image_b, grading the colors if it is the last pass, and
+# returns its event.  gpu_focus comes from upload_focus().
+def run_pass(session, gpu_image_a, gpu_image_b, width, height, gpu_tone_lut,
+             last_pass, gpu_focus, local_size,
+             rgba=False, name='pass'):
+    options = RGBA_OPTIONS if rgba else ()
+    if not loads_halo(local_size, False):
+        raise ValueError('The unfused kernel needs local sizes (x, y) with x * y >= x + 2 '
+                         'to load its halo, not %s' % (local_size,))
+    global_size = (round_up(int(width), local_size[0]), round_up(int(height), local_size[1]))
+    # Set up a (N+2 x N+2) local memory buffer.
+    # +2 for 1-pixel halo on all sides, 4 bytes for float.
+    local_memory = cl.LocalMemory(4 * (local_size[0] + 2) * (local_size[1] + 2))
+    # Each work group will have its own private buffer.
+    buf_width = np.int32(local_size[0] + 2)
+    buf_height = np.int32(local_size[1] + 2)
+    halo = np.int32(1)
+    event = session.kernel('TiltShiftColorOptimized.cl', 'tiltshift', options)(
+        session.queue, global_size, local_size,
+        gpu_image_a, gpu_image_b, local_memory, 
+        np.int32(width), np.int32(height), 
+        buf_width, buf_height, halo,
+        gpu_tone_lut, np.int32(last_pass), 
+        gpu_focus)
+    # Each launch reads and writes the whole image once
+    return session.record(event, name, 'kernel', 2 * 4 * int(width) * int(height))
+
+# Applies the tilt-shift effect to a packed (h, w) uint32 image using an
+# existing TiltShiftSession, so that a service can keep one session alive
+# and only pay for the transfers and the kernel on each image.
+# Returns the filtered packed image.
+def tiltshift_combined(session, image_combined,
+                       num_passes=3, sat=0.0, con=0.0,
+                       middle_in_focus=600, in_focus_radius=50,
+                       local_size=None, fused=True, tone_curve=None, focus=None):
+    image_combined = np.ascontiguousarray(image_combined, dtype=np.uint32)
+    height, width = image_combined.shape
+    gpu_image_a = session.get_buffer(image_combined.nbytes)
+    gpu_image_b = session.get_buffer(image_combined.nbytes)
+
+    session.record(cl.enqueue_copy(session.queue, gpu_image_a, image_combined, is_blocking=False),
+                   'upload', 'upload', image_combined.nbytes)
+    gpu_image_a, gpu_image_b = run_passes(session, gpu_image_a, gpu_image_b, width, height,
+                                          num_passes, sat, con, middle_in_focus, in_focus_radius,
+                                          local_size, fused, tone_curve=tone_curve, focus=focus)
+    image_filtered = np.empty_like(image_combined)
+    session.record(cl.enqueue_copy(session.queue, image_filtered, gpu_image_a, is_blocking=True),
+                   'download', 'download', image_filtered.nbytes)
+
+    session.release_buffer(gpu_image_a)
+    session.release_buffer(gpu_image_b)
+    return image_filtered
+
+# Applies the tilt-shift effect to an (h, w, 4) RGBA uint8 image, like
+# tiltshift_combined() but without converting the image: the kernels
+# read and write its bytes directly.  Returns the filtered RGBA image.
+# images=None (the default) runs the image2d_t kernel when the device
+# supports images, and the buffer kernels otherwise (see
+# TiltShiftColorImage.py).  Both give the same output.  images=True always
+# runs the image kernel and images=False always runs the buffer kernels,
+# which are the only ones fused applies to.  focus is the focus shape, as
+# in run_passes().
+def tiltshift_rgba(session, rgba,
+                   num_passes=3, sat=0.0, con=0.0,
+                   middle_in_focus=600, in_focus_radius=50,
+                   local_size=None, fused=True, tone_curve=None, images=None,
+                   focus=None):
+    image_combined = as_packed(rgba)
+    height, width = image_combined.shape
+    if images is not False:
+        from TiltShiftColorImage import supports_images, tiltshift_image
+        if images or supports_images(session, width, height):
+            return tiltshift_image(session, rgba, num_passes, sat, con,
+                                   middle_in_focus, in_focus_radius,
+                                   local_size, tone_curve, focus)
+    gpu_image_a = session.get_buffer(image_combined.nbytes)
+    gpu_image_b = session.get_buffer(image_combined.nbytes)
+
+    session.record(cl.enqueue_copy(session.queue, gpu_image_a, image_combined, is_blocking=False),
+                   'upload', 'upload', image_combined.nbytes)
+    gpu_image_a, gpu_image_b = run_passes(session, gpu_image_a, gpu_image_b, width, height,
+                                          num_passes, sat, con, middle_in_focus, in_focus_radius,
+                                          local_size, fused, rgba=True, tone_curve=tone_curve,
+                                          focus=focus)
+    rgba_filtered = empty_rgba(height, width)
+    session.record(cl.enqueue_copy(session.queue, as_packed(rgba_filtered), gpu_image_a, is_blocking=True),
+                   'download', 'download', rgba_filtered.nbytes)
+
+    session.release_buffer(gpu_image_a)
+    session.release_buffer(gpu_image_b)
+    return rgba_filtered
+
 # Run a Python implementation of Tilt-Shift (grayscale)
 if __name__ == '__main__':
-    # Load the image
-    input_image = mpimg.imread('../MITBoathouse.png',0)
+    import matplotlib.pyplot as plt
+    from TiltShiftImageIO import load_rgba, save_rgba
+    # Load the image, decoded straight to RGBA bytes
+    input_image = load_rgba('../MITBoathouse.png')
     plt.imshow(input_image)    
     plt.show()
     
@@ -53,71 +231,58 @@ if __name__ == '__main__':
     start_time = time.time()
     
     conversion_start_time = time.time()
-    # Convert the image from (h, w, 3) to (h, w), storing the RGB value into an int
-    image_combined = (input_image[...,0].astype(np.uint32) << 16) + (input_image[...,1].astype(np.uint32) << 8) + (input_image[...,2].astype(np.uint32) << 0)
+    # Get the image as (h, w, 4) RGBA bytes and view it as (h, w) uints,
+    # one per pixel, without converting it
+    input_rgba = to_rgba(input_image)
+    image_combined = as_packed(input_rgba)
     conversion_end_time = time.time()
-    print image_combined.shape
+    print(image_combined.shape)
     
-    # Make the placeholders for the output image and output combined
-    #output_combined = np.zeros_like(image_combined)
-    host_image_filtered = np.zeros_like(input_image)
+    # Make the placeholder for the output image, which the kernel output is copied straight into
+    host_image_filtered = empty_rgba(*image_combined.shape)
         
     # List our platforms
     platforms = cl.get_platforms()
-    print 'The platforms detected are:'
-    print '---------------------------'
+    print('The platforms detected are:')
+    print('---------------------------')
     for platform in platforms:
-        print platform.name, platform.vendor, 'version:', platform.version
+        print(platform.name, platform.vendor, 'version:', platform.version)
     
     # List devices in each platform
     for platform in platforms:
-        print 'The devices detected on platform', platform.name, 'are:'
-        print '---------------------------'
+        print('The devices detected on platform', platform.name, 'are:')
+        print('---------------------------')
         for device in platform.get_devices():
-            print device.name, '[Type:', cl.device_type.to_string(device.type), ']'
-            print 'Maximum clock Frequency:', device.max_clock_frequency, 'MHz'
-            print 'Maximum allocable memory size:', int(device.max_mem_alloc_size / 1e6), 'MB'
-            print 'Maximum work group size', device.max_work_group_size
-            print '---------------------------'
-
-    # Create a context with all the devices
-    devices = platforms[0].get_devices()
-    context = cl.Context(devices[1:])
-    print 'This context is associated with ', len(context.devices), 'devices'
-    
-    # Create a queue for transferring data and launching computations.
-    # Turn on profiling to allow us to check event times.
-    queue = cl.CommandQueue(context, context.devices[0],
-                            properties=cl.command_queue_properties.PROFILING_ENABLE)
-    print 'The queue is using the device:', queue.device.name
-
-    curdir = os.path.dirname(os.path.realpath(__file__))
-    program = cl.Program(context, open('TiltShiftColorBaselineBlurMask.cl').read()).build(options=['-I', curdir])
+            print(device.name, '[Type:', cl.device_type.to_string(device.type), ']')
+            print('Maximum clock Frequency:', device.max_clock_frequency, 'MHz')
+            print('Maximum allocable memory size:', int(device.max_mem_alloc_size / 1e6), 'MB')
+            print('Maximum work group size', device.max_work_group_size)
+            print('---------------------------')
+
+    # Set up OpenCL once. The session picks a device, creates the context and a
+    # profiling-enabled queue, and builds the program (or loads its cached binary).
+    # The events of every transfer and kernel are recorded in the profiler
+    session = TiltShiftSession(profiler=TiltShiftProfiler())
+    queue = session.queue
+    print('The queue is using the device:', queue.device.name)
         
     buf_start_time = time.time()
-    gpu_image_a = cl.Buffer(context, cl.mem_flags.READ_WRITE, image_combined.size * 32)
-    gpu_image_b = cl.Buffer(context, cl.mem_flags.READ_WRITE, image_combined.size * 32)
+    gpu_image_a = session.get_buffer(image_combined.nbytes)
+    gpu_image_b = session.get_buffer(image_combined.nbytes)
     buf_end_time = time.time()
     
-    # These settings for local_size appear to work best on my computer, not entirely sure why
-    # (HD Graphics 4000 [Type: GPU] Maximum work group size 512)
-    local_size = (256, 2)
-    global_size = tuple([round_up(g, l) for g, l in zip(image_combined.shape[::-1], local_size)])
+    # (256, 2) appeared to work best on an HD Graphics 4000 (maximum work group
+    # size 512), but the best local size differs between devices.  None uses the
+    # one tuned for this device and image width, see TiltShiftTuner.py
+    local_size = None
 
     width = np.int32(image_combined.shape[1])
     height = np.int32(image_combined.shape[0])
     
-    # Set up a (N+2 x N+2) local memory buffer.
-    # +2 for 1-pixel halo on all sides, 4 bytes for float.
-    local_memory = cl.LocalMemory(4 * (local_size[0] + 2) * (local_size[1] + 2))
-    # Each work group will have its own private buffer.
-    buf_width = np.int32(local_size[0] + 2)
-    buf_height = np.int32(local_size[1] + 2)
-    halo = np.int32(1)
-    
     # Send image to the device, non-blocking
     enqueue_start_time = time.time()
-    cl.enqueue_copy(queue, gpu_image_a, image_combined, is_blocking=False)
+    session.record(cl.enqueue_copy(queue, gpu_image_a, image_combined, is_blocking=False),
+                   'upload', 'upload', image_combined.nbytes)
     enqueue_end_time = time.time()
     
     ################################
@@ -133,60 +298,73 @@ if __name__ == '__main__':
     middle_in_focus = np.int32(600)
     # The number of pixels to either side of the middle_in_focus to keep in focus
     in_focus_radius = np.int32(50)
+    # The shape of the in-focus region: 'horizontal', 'circular', 'band' (a band
+    # through (middle_in_focus_x, middle_in_focus) tilted by focus_angle degrees)
+    # or 'elliptical' (see TiltShiftMasks.py)
+    focus_shape = 'horizontal'
+    # The x-index of the center of the in-focus region (all but horizontal)
+    middle_in_focus_x = 650
+    focus_angle = 0.0
+    # Run all the passes in one kernel launch, keeping each tile in local memory
+    # between passes instead of writing every pass back to global memory
+    fused = True
+    # An optional tone curve applied after the saturation and contrast, as a list
+    # of (input, output) points such as [(0, 0), (64, 50), (192, 210), (255, 255)]
+    tone_curve = None
+    # Where to write a Chrome trace of the transfers and kernels, for chrome://tracing
+    trace_path = None
+    # Tune the local size for this device and image width if it has not been tuned
+    # yet, and keep it for later runs (this times every legal local size once)
+    auto_tune = False
     ####################################
     ### END USER CHANGEABLE SETTINGS ###
     ####################################
 
-    print "Image Width %s" % width
-    print "Image Height %s" % height
+    print("Image Width %s" % width)
+    print("Image Height %s" % height)
     
-    kernel_start_time = time.time()
-    # We will perform 3 passes of the bux blur 
-    # effect to approximate Gaussian blurring
-    for pass_num in range(num_passes):
-        print "In iteration %s of %s" % (pass_num + 1, num_passes)
-        # We need to loop over the workgroups here, 
-        # because unlike OpenCL, they are not 
-        # automatically set up by Python
-        last_pass = np.bool_(False)
-        if pass_num == num_passes - 1:
-            print "Last Pass!"
-            last_pass = np.bool_(True)
-            
-        # Run tilt shift over the group and store the results in host_image_tilt_shifted
-        # Loop over all groups and call tiltshift once per group    
-        program.tiltshift(queue, global_size, local_size,
-                          gpu_image_a, gpu_image_b, local_memory, 
-                          width, height, 
-                          buf_width, buf_height, halo,
-                          sat, con, last_pass, 
-                          middle_in_focus, in_focus_radius)
+    # Look the local size up (or tune it) before the clock starts
+    session.tuner.auto_tune = auto_tune
+    if local_size is None:
+        local_size = session.tuner.local_size(session, width, num_passes, fused)
 
-        # Now put the output of the last pass into the input of the next pass
-        gpu_image_a, gpu_image_b = gpu_image_b, gpu_image_a
+    kernel_start_time = time.time()
+    print("Running %s passes (fused: %s) with local size %s" % (num_passes, fused, local_size))
+    gpu_image_a, gpu_image_b = run_passes(session, gpu_image_a, gpu_image_b, width, height,
+                                          num_passes, sat, con, middle_in_focus, in_focus_radius,
+                                          local_size, fused, rgba=True, tone_curve=tone_curve,
+                                          focus=focus_params(focus_shape, middle_in_focus_x, middle_in_focus,
+                                                             in_focus_radius, angle=focus_angle))
     kernel_end_time = time.time()
     
     dequeue_start_time = time.time()
-    cl.enqueue_copy(queue, image_combined, gpu_image_a, is_blocking=True)
+    session.record(cl.enqueue_copy(queue, as_packed(host_image_filtered), gpu_image_a, is_blocking=True),
+                   'download', 'download', host_image_filtered.nbytes)
     dequeue_end_time = time.time()
     
+    # The output is already RGBA bytes, so there is nothing left to convert
     reconversion_start_time = time.time()
-    host_image_filtered[...,0] = ((image_combined >> 16) & 0xFF)
-    host_image_filtered[...,1] = ((image_combined >> 8) & 0xFF)
-    host_image_filtered[...,2] = ((image_combined) & 0xFF)
     reconversion_end_time = time.time()
     
     end_time = time.time()
-    print "####### TIMING BREAKDOWN #######"
-    print "Took %s total seconds to run %s passes" % (end_time - start_time, num_passes)  
-    print "Conversion time was %s seconds" % (conversion_end_time - conversion_start_time) 
-    print "Buf creation time was %s seconds" % (buf_end_time - buf_start_time)
-    print "Enqueue time was %s seconds" % (enqueue_end_time - enqueue_start_time) 
-    print "Kernel time was %s seconds" % (kernel_end_time - kernel_start_time)  
-    print "Dequeue time was %s seconds" % (dequeue_end_time - dequeue_start_time) 
-    print "Reconversion time was %s seconds" % (reconversion_end_time - reconversion_start_time) 
+    print("####### TIMING BREAKDOWN #######")
+    print("Took %s total seconds to run %s passes" % (end_time - start_time, num_passes))
+    print("Conversion time was %s seconds" % (conversion_end_time - conversion_start_time))
+    print("Buf creation time was %s seconds" % (buf_end_time - buf_start_time))
+    print("Enqueue time was %s seconds" % (enqueue_end_time - enqueue_start_time))
+    print("Kernel time was %s seconds" % (kernel_end_time - kernel_start_time))
+    print("Dequeue time was %s seconds" % (dequeue_end_time - dequeue_start_time))
+    print("Reconversion time was %s seconds" % (reconversion_end_time - reconversion_start_time))
+
+    # The times above only measure how long the calls took to return, the
+    # device's own times for each transfer and kernel come from their events
+    print("####### DEVICE TIMING #######")
+    session.profiler.print_report()
+    if trace_path is not None:
+        session.profiler.save_chrome_trace(trace_path)
+        print("Wrote a Chrome trace to %s" % trace_path)
     
     # Display the new image
     plt.imshow(host_image_filtered)    
     plt.show()
-    mpimg.imsave("MITBoathouse_TiltShiftColorOptimized.png", host_image_filtered)
\ No newline at end of file
+    save_rgba("MITBoathouse_TiltShiftColorOptimized.png", host_image_filtered)
\ No newline at end of file
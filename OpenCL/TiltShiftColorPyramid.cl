@@ -0,0 +1,90 @@
+#include "TiltShiftPixels.h"
+#include "TiltShiftColorGrade.h"
+#include "TiltShiftFocus.h"
+
+// Kernels for the half-resolution pyramid version of the Tilt-Shift
+// effect (see TiltShiftColorPyramid.py).  The image is halved a few
+// times with downsample_half(), the coarsest level is fully blurred by
+// the tiltshift kernels in TiltShiftColorOptimized.cl, and
+// upsample_blend() scales it back up and blends it with the original,
+// weighted by the blur amount of each pixel.
+
+// Returns the (red, green, blue) of a packed pixel as floats
+inline float4 color_of(uint accessed) {
+    uchar4 p = expand(accessed);
+    return (float4) (p.y, p.z, p.w, 0);
+}
+
+// Halves a w x h image into a (w + 1) / 2 x (h + 1) / 2 one by averaging
+// every 2x2 block of pixels.  An odd last row or column is averaged with
+// itself, like the edge clamping of the blur.
+__kernel void
+downsample_half(__global const uint* in_values,
+                __global uint* out_values,
+                int w, int h,
+                int coarse_w, int coarse_h) {
+
+    // Global position of the coarse pixel
+    const int x = get_global_id(0);
+    const int y = get_global_id(1);
+
+    if ((y < coarse_h) && (x < coarse_w)) {
+        const int x0 = 2 * x;
+        const int y0 = 2 * y;
+        const int x1 = min(x0 + 1, w - 1);
+        const int y1 = min(y0 + 1, h - 1);
+        uint first = in_values[y0 * w + x0];
+        float4 total = color_of(first) + color_of(in_values[y0 * w + x1]) +
+                       color_of(in_values[y1 * w + x0]) + color_of(in_values[y1 * w + x1]);
+        uchar4 mean = convert_uchar4_sat_rte(total / 4.0f);
+        uchar4 pixel = {expand(first).x, mean.x, mean.y, mean.z};
+        out_values[y * coarse_w + x] = pack(pixel);
+    }
+}
+
+// Returns the coarse pixels on either side of the center of fine pixel i,
+// in an axis of n fine and n_coarse coarse pixels, and the weight of the
+// second one, for bilinear upsampling
+inline float upsample_coord(int i, int n, int n_coarse, int* i0, int* i1) {
+    float position = clamp((i + 0.5f) * n_coarse / n - 0.5f, 0.0f, (float) (n_coarse - 1));
+    *i0 = (int) floor(position);
+    *i1 = min(*i0 + 1, n_coarse - 1);
+    return position - *i0;
+}
+
+// Scales the blurred coarse image up to w x h with bilinear interpolation,
+// blends it with the original image by the blur amount of each pixel, and
+// grades the colors of the result with the tone table
+__kernel void
+upsample_blend(__global const uint* original,
+               __global const uint* coarse,
+               __global uint* out_values,
+               int w, int h,
+               int coarse_w, int coarse_h,
+               __constant uchar* tone_lut,
+               __constant float* focus) {
+
+    // Global position of output pixel
+    const int x = get_global_id(0);
+    const int y = get_global_id(1);
+
+    if ((y < h) && (x < w)) {
+        int x0, x1, y0, y1;
+        const float tx = upsample_coord(x, w, coarse_w, &x0, &x1);
+        const float ty = upsample_coord(y, h, coarse_h, &y0, &y1);
+        float4 top = mix(color_of(coarse[y0 * coarse_w + x0]), color_of(coarse[y0 * coarse_w + x1]), tx);
+        float4 bottom = mix(color_of(coarse[y1 * coarse_w + x0]), color_of(coarse[y1 * coarse_w + x1]), tx);
+        float4 blurred = mix(top, bottom, ty);
+
+        // Keep the original where the pixel is in focus and fade to the blurred image
+        uint accessed = original[y * w + x];
+        float blur_amount = focus_blur_amount(x, y, focus);
+        float4 blended = mix(color_of(accessed), blurred, blur_amount);
+
+        // Drop the fractional part like the blur kernels, then perform the
+        // saturation and contrast adjustments, along with any tone curve
+        uchar4 colors = convert_uchar4_sat_rtz(blended);
+        uchar4 pixel = {expand(accessed).x, colors.x, colors.y, colors.z};
+        out_values[y * w + x] = pack(tone_map(pixel, tone_lut));
+    }
+}
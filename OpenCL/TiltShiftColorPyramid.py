@@ -0,0 +1,137 @@
+import pyopencl as cl
+import numpy as np
+import sys
+import time
+from TiltShiftSession import TiltShiftSession
+from TiltShiftPixels import RGBA_OPTIONS, as_packed, empty_rgba
+from TiltShiftColorOptimized import run_passes, upload_tone_lut, upload_focus
+
+# A half-resolution pyramid version of the Optimized Tilt-Shift effect.
+# Far from the in-focus band the blur amount is 1.0, and after a few
+# passes of the 3x3 box the pixels there hold little but low frequencies,
+# so blurring them at full resolution is wasted work.  Instead the image
+# is halved levels times, the coarsest level is fully blurred with the
+# Optimized kernels (each pass there covers 2 ** levels pixels of the
+# original, for a quarter of the work per level), and the result is
+# scaled back up and blended with the original by the blur amount of
+# each pixel, so the in-focus band keeps its full detail.
+# The kernels are in TiltShiftColorPyramid.cl, and tiltshift_pyramid() in
+# Python/TiltShiftColorBlurMask.py is the NumPy version.
+
+# Returns the sizes of the levels of the pyramid, from the image down to
+# the coarsest level, as (width, height)
+def level_sizes(width, height, levels):
+    sizes = [(int(width), int(height))]
+    for level in range(levels):
+        width, height = sizes[-1]
+        sizes.append(((width + 1) // 2, (height + 1) // 2))
+    return sizes
+
+# Applies the tilt-shift effect to an (h, w, 4) RGBA uint8 image through a
+# pyramid of levels halvings, and returns the filtered RGBA image.
+# local_size and fused are passed on to run_passes() for the coarse level.
+# focus is the focus shape from focus_params(), or None for the horizontal band.
+def tiltshift_pyramid(session, rgba,
+                      num_passes=3, sat=0.0, con=0.0,
+                      middle_in_focus=600, in_focus_radius=50,
+                      levels=2, local_size=None, fused=True, tone_curve=None, focus=None):
+    if levels < 1:
+        raise ValueError('The pyramid needs at least one level, not %s' % levels)
+    image_combined = as_packed(rgba)
+    height, width = image_combined.shape
+    sizes = level_sizes(width, height, levels)
+
+    gpu_levels = [session.get_buffer(4 * w * h) for w, h in sizes]
+    session.record(cl.enqueue_copy(session.queue, gpu_levels[0], image_combined, is_blocking=False),
+                   'upload', 'upload', image_combined.nbytes)
+
+    # Halve the image levels times
+    downsample_half = session.kernel('TiltShiftColorPyramid.cl', 'downsample_half', RGBA_OPTIONS)
+    for level in range(levels):
+        (w, h), (coarse_w, coarse_h) = sizes[level], sizes[level + 1]
+        event = downsample_half(session.queue, (coarse_w, coarse_h), None,
+                                gpu_levels[level], gpu_levels[level + 1],
+                                np.int32(w), np.int32(h), np.int32(coarse_w), np.int32(coarse_h))
+        session.record(event, 'downsample level %s' % (level + 1), 'kernel',
+                       4 * (w * h + coarse_w * coarse_h))
+
+    # Blur every pixel of the coarsest level.  With an in-focus radius of 0
+    # the blur amount is 1.0 everywhere, and with no saturation or contrast
+    # the grading of the last pass leaves the colors alone
+    coarse_w, coarse_h = sizes[-1]
+    gpu_scratch = session.get_buffer(4 * coarse_w * coarse_h)
+    gpu_coarse, gpu_scratch = run_passes(session, gpu_levels[-1], gpu_scratch, coarse_w, coarse_h,
+                                         num_passes, 0.0, 0.0, 0, 0,
+                                         local_size, fused, rgba=True)
+
+    # Scale the blurred level back up and blend it with the original
+    gpu_tone_lut = upload_tone_lut(session, sat, con, tone_curve)
+    gpu_focus = upload_focus(session, middle_in_focus, in_focus_radius, focus)
+    gpu_output = session.get_buffer(image_combined.nbytes)
+    event = session.kernel('TiltShiftColorPyramid.cl', 'upsample_blend', RGBA_OPTIONS)(
+        session.queue, (width, height), None,
+        gpu_levels[0], gpu_coarse, gpu_output,
+        np.int32(width), np.int32(height), np.int32(coarse_w), np.int32(coarse_h),
+        gpu_tone_lut, gpu_focus)
+    session.record(event, 'upsample and blend', 'kernel',
+                   4 * (2 * width * height + coarse_w * coarse_h))
+
+    rgba_filtered = empty_rgba(height, width)
+    session.record(cl.enqueue_copy(session.queue, as_packed(rgba_filtered), gpu_output, is_blocking=True),
+                   'download', 'download', rgba_filtered.nbytes)
+
+    # run_passes() swapped the coarsest level with the scratch buffer, so
+    # hand back whichever buffers are now in each place
+    for buffer in gpu_levels[:-1] + [gpu_coarse, gpu_scratch, gpu_output]:
+        session.release_buffer(buffer)
+    return rgba_filtered
+
+# Run the pyramid Tilt-Shift effect on an image and compare its time with
+# the full-resolution passes:
+#   python TiltShiftColorPyramid.py ../MITBoathouse.png MITBoathouse_TiltShift.png
+if __name__ == '__main__':
+    from TiltShiftImageIO import load_rgba, save_rgba
+    from TiltShiftColorOptimized import tiltshift_rgba
+    if len(sys.argv) != 3:
+        print("Usage: python TiltShiftColorPyramid.py <input image> <output image>")
+        sys.exit(1)
+
+    ################################
+    ### USER CHANGEABLE SETTINGS ###
+    ################################
+    # Number of Passes on the coarsest level - 3 passes approximates Gaussian Blur
+    num_passes = 3
+    # Saturation - Between 0 and 1
+    sat = 0.0
+    # Contrast - Between -255 and 255
+    con = 0.0
+    # The y-index of the center of the in-focus region
+    middle_in_focus = 600
+    # The number of pixels to either side of the middle_in_focus to keep in focus
+    in_focus_radius = 50
+    # How many times the image is halved before it is blurred
+    levels = 2
+    ####################################
+    ### END USER CHANGEABLE SETTINGS ###
+    ####################################
+
+    rgba = load_rgba(sys.argv[1])
+    height, width = rgba.shape[:2]
+    session = TiltShiftSession()
+    print("The queue is using the device: %s" % session.queue.device.name)
+    print("Image Width %s, Height %s, levels %s" % (width, height, level_sizes(width, height, levels)))
+
+    # Warm up both paths so the times leave out the program builds
+    tiltshift_rgba(session, rgba, num_passes, sat, con, middle_in_focus, in_focus_radius)
+    tiltshift_pyramid(session, rgba, num_passes, sat, con, middle_in_focus, in_focus_radius, levels)
+
+    start_time = time.time()
+    tiltshift_rgba(session, rgba, num_passes, sat, con, middle_in_focus, in_focus_radius)
+    full_time = time.time() - start_time
+    start_time = time.time()
+    rgba_filtered = tiltshift_pyramid(session, rgba, num_passes, sat, con,
+                                      middle_in_focus, in_focus_radius, levels)
+    pyramid_time = time.time() - start_time
+    print("Full resolution took %s seconds, the pyramid %s seconds" % (full_time, pyramid_time))
+
+    save_rgba(sys.argv[2], rgba_filtered)
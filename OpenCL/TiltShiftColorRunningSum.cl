@@ -0,0 +1,138 @@
+// Separable running-sum (prefix sum) box blur with a per-pixel radius.
+// Instead of re-running a 3x3 box blur num_passes times, every sweep
+// blurs the rows and then the columns with a box whose radius is picked
+// by the blur amount in the alpha byte of each pixel.  Because the
+// window sums come from running sums, the cost per pixel does not
+// depend on the radius.
+
+#include "TiltShiftPixels.h"
+#include "TiltShiftColorGrade.h"
+
+// Unpacks the packed uint pixels (blur amount, red, green, blue) into
+// float4 pixels (red, green, blue, 0) that the sweeps work on
+__kernel void
+unpack_pixels(__global const uint* in_values,
+              __global float4* out_values,
+              int w, int h) {
+
+    // Global position of the pixel
+    const int x = get_global_id(0);
+    const int y = get_global_id(1);
+
+    if ((y < h) && (x < w)) {
+        uchar4 p = expand(in_values[y * w + x]);
+        out_values[y * w + x] = (float4) (p.y, p.z, p.w, 0);
+    }
+}
+
+// Builds the running sum of every line of the image, one work item per line.
+// A line is n pixels long, stride_along apart, and line i starts at
+// i * stride_across, so the same kernel works on rows (1, w) and columns (w, 1).
+// sums[i * (n + 1) + j] holds the sum of the first j pixels of line i.
+__kernel void
+running_sum(__global const float4* in_values,
+            __global float4* sums,
+            int n, int num_lines,
+            int stride_along, int stride_across) {
+
+    const int line = get_global_id(0);
+
+    if (line < num_lines) {
+        __global float4* line_sums = sums + line * (n + 1);
+        float4 total = 0;
+        int j;
+
+        line_sums[0] = total;
+        for (j = 0; j < n; j++) {
+            total += in_values[line * stride_across + j * stride_along];
+            line_sums[j + 1] = total;
+        }
+    }
+}
+
+// Returns the mean of the window [j - r, j + r] of a line from its running
+// sums.  Pixels outside the line are clamped to the first and last pixel,
+// like the halo loads in the 3x3 kernels.
+inline float4 window_mean(__global const float4* line_sums,
+                          float4 first, float4 last,
+                          int j, int n, int r) {
+
+    const int lo = max(j - r, 0);
+    const int hi = min(j + r, n - 1);
+
+    float4 total = line_sums[hi + 1] - line_sums[lo];
+    total += max(r - j, 0) * first;
+    total += max(j + r - (n - 1), 0) * last;
+    return total / (2 * r + 1);
+}
+
+// Blurs every pixel along one axis, with a radius between 0 and max_radius
+// taken from the blur amount in the alpha byte of the packed image.
+// Fractional radii are linearly interpolated between the two nearest
+// integer boxes so the blur fades in smoothly.
+__kernel void
+running_box(__global const float4* in_values,
+            __global const float4* sums,
+            __global const uint* packed_values,
+            __global float4* out_values,
+            int w, int h,
+            int horizontal, int max_radius) {
+
+    // Global position of output pixel
+    const int x = get_global_id(0);
+    const int y = get_global_id(1);
+
+    // Stay in bounds check is necessary due to possible
+    // images with size not nicely divisible by workgroup size
+    if ((y < h) && (x < w)) {
+        // Position of the pixel along its line, and where the line starts
+        int n, j, line, stride_along;
+        if (horizontal) {
+            n = w;
+            j = x;
+            line = y;
+            stride_along = 1;
+        } else {
+            n = h;
+            j = y;
+            line = x;
+            stride_along = w;
+        }
+        const int line_start = horizontal ? y * w : x;
+
+        float blur_amount = (float) expand(packed_values[y * w + x]).x / 255.0;
+        float radius = blur_amount * max_radius;
+        int r0 = (int) floor(radius);
+        int r1 = min(r0 + 1, max_radius);
+        float t = radius - r0;
+
+        __global const float4* line_sums = sums + line * (n + 1);
+        float4 first = in_values[line_start];
+        float4 last = in_values[line_start + (n - 1) * stride_along];
+
+        out_values[y * w + x] = (1 - t) * window_mean(line_sums, first, last, j, n, r0) +
+                                t * window_mean(line_sums, first, last, j, n, r1);
+    }
+}
+
+// Packs the blurred float4 pixels back into uints, dropping the fractional
+// part and keeping the blur amount of the original pixel in the alpha byte,
+// and grades the colors with tone_lut (see TiltShiftColorGrade.h) like the
+// last pass of the other kernels
+__kernel void
+pack_pixels(__global const float4* in_values,
+            __global const uint* packed_values,
+            __global uint* out_values,
+            int w, int h,
+            __constant uchar* tone_lut) {
+
+    // Global position of the pixel
+    const int x = get_global_id(0);
+    const int y = get_global_id(1);
+
+    if ((y < h) && (x < w)) {
+        uchar4 p = convert_uchar4_sat_rtz(in_values[y * w + x]);
+        uchar4 blurred = {expand(packed_values[y * w + x]).x, p.x, p.y, p.z};
+        out_values[y * w + x] = pack(tone_map(blurred, tone_lut));
+    }
+}
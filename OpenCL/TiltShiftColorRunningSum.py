@@ -0,0 +1,295 @@
+from __future__ import print_function
+import pyopencl as cl
+import os.path
+import numpy as np
+import time
+import math
+from TiltShiftMasks import focus_params
+from TiltShiftPixels import RGBA_OPTIONS, to_rgba, as_packed, empty_rgba
+from TiltShiftColorGrade import tone_lut
+from TiltShiftColorOptimized import upload_tone_lut, upload_focus
+from TiltShiftSession import default_device
+from TiltShiftProfiler import TiltShiftProfiler
+
+# A separable running-sum version of the Tilt-Shift effect in OpenCL.
+# Instead of running the 3x3 box blur kernel num_passes times, every
+# sweep blurs the rows and then the columns with a box whose radius is
+# picked per pixel from the blur mask, so a stronger blur only needs a
+# larger max_blur_radius and not more passes over the image.
+# The last kernel grades the colors with the same table as the last pass
+# of the Optimized kernels (see TiltShiftColorGrade.py).
+
+# Rounds up the size to a be multiple of the group_size
+def round_up(global_size, group_size):
+    r = global_size % group_size
+    if r == 0:
+        return global_size
+    return global_size + group_size - r
+
+# Applies the running-sum tilt-shift effect to an (h, w, 4) RGBA uint8
+# image using an existing TiltShiftSession, and returns the filtered RGBA
+# image.  Its alpha bytes hold the blur mask, written on the device from
+# the focus shape (focus from focus_params(), or None for the horizontal
+# band of in_focus_radius around row middle_in_focus).  local_size=None
+# lets the driver pick the local size.
+def tiltshift_running_sum(session, rgba,
+                          num_sweeps=3, sat=0.0, con=0.0,
+                          middle_in_focus=600, in_focus_radius=50,
+                          max_blur_radius=8, local_size=None, tone_curve=None, focus=None):
+    image_combined = as_packed(rgba)
+    height, width = image_combined.shape
+    num_pixels = image_combined.size
+    if local_size is None:
+        global_size = (width, height)
+    else:
+        global_size = (round_up(width, local_size[0]), round_up(height, local_size[1]))
+
+    # Returns a kernel of TiltShiftColorRunningSum.cl
+    def kernel(name):
+        return session.kernel('TiltShiftColorRunningSum.cl', name, RGBA_OPTIONS)
+
+    # The packed image is read-write, since the blur mask is written into its alpha bytes
+    gpu_packed = session.get_buffer(image_combined.nbytes)
+    gpu_output = session.get_buffer(image_combined.nbytes)
+    # The sweeps work on float4 pixels, 16 bytes each
+    gpu_pixels_a = session.get_buffer(num_pixels * 16)
+    gpu_pixels_b = session.get_buffer(num_pixels * 16)
+    # One running sum per row (w + 1 entries) or per column (h + 1 entries)
+    num_sums = max((width + 1) * height, (height + 1) * width)
+    gpu_sums = session.get_buffer(num_sums * 16)
+    gpu_tone_lut = upload_tone_lut(session, sat, con, tone_curve)
+    gpu_focus = upload_focus(session, middle_in_focus, in_focus_radius, focus)
+
+    session.record(cl.enqueue_copy(session.queue, gpu_packed, image_combined, is_blocking=False),
+                   'upload', 'upload', image_combined.nbytes)
+    event = session.kernel('TiltShiftMaskAlpha.cl', 'focus_alpha', RGBA_OPTIONS)(
+        session.queue, global_size, local_size,
+        gpu_packed, np.int32(width), np.int32(height), gpu_focus)
+    session.record(event, 'focus alpha', 'kernel', 2 * image_combined.nbytes)
+
+    # The bytes each kernel reads and writes per pixel: packed pixels are 4 bytes,
+    # float4 pixels and running sums are 16
+    w, h = np.int32(width), np.int32(height)
+    event = kernel('unpack_pixels')(session.queue, global_size, local_size,
+                                    gpu_packed, gpu_pixels_a, w, h)
+    session.record(event, 'unpack_pixels', 'kernel', num_pixels * (4 + 16))
+    for sweep_num in range(num_sweeps):
+        # Blur along the rows: one running sum per row, then one box per pixel
+        event = kernel('running_sum')(session.queue, (height,), None,
+                                      gpu_pixels_a, gpu_sums, w, h, np.int32(1), w)
+        session.record(event, 'row sums %s' % (sweep_num + 1), 'kernel', num_pixels * (16 + 16))
+        event = kernel('running_box')(session.queue, global_size, local_size,
+                                      gpu_pixels_a, gpu_sums, gpu_packed, gpu_pixels_b,
+                                      w, h, np.int32(1), np.int32(max_blur_radius))
+        session.record(event, 'row boxes %s' % (sweep_num + 1), 'kernel', num_pixels * (2 * 16 + 4 + 16))
+        # Blur along the columns
+        event = kernel('running_sum')(session.queue, (width,), None,
+                                      gpu_pixels_b, gpu_sums, h, w, w, np.int32(1))
+        session.record(event, 'column sums %s' % (sweep_num + 1), 'kernel', num_pixels * (16 + 16))
+        event = kernel('running_box')(session.queue, global_size, local_size,
+                                      gpu_pixels_b, gpu_sums, gpu_packed, gpu_pixels_a,
+                                      w, h, np.int32(0), np.int32(max_blur_radius))
+        session.record(event, 'column boxes %s' % (sweep_num + 1), 'kernel', num_pixels * (2 * 16 + 4 + 16))
+    event = kernel('pack_pixels')(session.queue, global_size, local_size,
+                                  gpu_pixels_a, gpu_packed, gpu_output, w, h, gpu_tone_lut)
+    session.record(event, 'pack_pixels', 'kernel', num_pixels * (16 + 4 + 4))
+
+    rgba_filtered = empty_rgba(height, width)
+    session.record(cl.enqueue_copy(session.queue, as_packed(rgba_filtered), gpu_output, is_blocking=True),
+                   'download', 'download', rgba_filtered.nbytes)
+
+    for buffer in [gpu_packed, gpu_output, gpu_pixels_a, gpu_pixels_b, gpu_sums]:
+        session.release_buffer(buffer)
+    return rgba_filtered
+
+# Run a Python implementation of Tilt-Shift (grayscale)
+if __name__ == '__main__':
+    import matplotlib.pyplot as plt
+    from TiltShiftImageIO import load_rgba, save_rgba
+    # Load the image, decoded straight to RGBA bytes
+    input_image = load_rgba('../MITBoathouse.png')
+    plt.imshow(input_image)    
+    plt.show()
+    
+    # Start the clock
+    start_time = time.time()
+    
+    conversion_start_time = time.time()
+    # Get the image as (h, w, 4) RGBA bytes and view it as (h, w) uints,
+    # one per pixel, without converting it
+    input_rgba = to_rgba(input_image)
+    image_combined = as_packed(input_rgba)
+    conversion_end_time = time.time()
+    print(image_combined.shape)
+    
+    # Make the placeholder for the output image, which the kernel output is copied straight into
+    host_image_filtered = empty_rgba(*image_combined.shape)
+        
+    # List our platforms
+    platforms = cl.get_platforms()
+    print('The platforms detected are:')
+    print('---------------------------')
+    for platform in platforms:
+        print(platform.name, platform.vendor, 'version:', platform.version)
+    
+    # List devices in each platform
+    for platform in platforms:
+        print('The devices detected on platform', platform.name, 'are:')
+        print('---------------------------')
+        for device in platform.get_devices():
+            print(device.name, '[Type:', cl.device_type.to_string(device.type), ']')
+            print('Maximum clock Frequency:', device.max_clock_frequency, 'MHz')
+            print('Maximum allocable memory size:', int(device.max_mem_alloc_size / 1e6), 'MB')
+            print('Maximum work group size', device.max_work_group_size)
+            print('---------------------------')
+
+    # Create a context with the device to run on: the one TILTSHIFT_DEVICE
+    # selects (a name, type or index, see TiltShiftSession.py) or else the first GPU
+    device = default_device()
+    context = cl.Context([device])
+    print('This context is associated with ', len(context.devices), 'devices')
+    
+    # Create a queue for transferring data and launching computations.
+    # Turn on profiling to allow us to check event times.
+    queue = cl.CommandQueue(context, device,
+                            properties=cl.command_queue_properties.PROFILING_ENABLE)
+    print('The queue is using the device:', queue.device.name)
+    # Record the event of every transfer and kernel to report the device's own times
+    profiler = TiltShiftProfiler()
+
+    curdir = os.path.dirname(os.path.realpath(__file__))
+    program = cl.Program(context, open('TiltShiftColorRunningSum.cl').read()).build(options=['-I', curdir] + list(RGBA_OPTIONS))
+    mask_program = cl.Program(context, open('TiltShiftMaskAlpha.cl').read()).build(options=['-I', curdir] + list(RGBA_OPTIONS))
+        
+    buf_start_time = time.time()
+    # The packed image is read-write, since the blur mask is written into its alpha bytes
+    gpu_packed = cl.Buffer(context, cl.mem_flags.READ_WRITE, image_combined.nbytes)
+    gpu_output = cl.Buffer(context, cl.mem_flags.WRITE_ONLY, image_combined.nbytes)
+    # The sweeps work on float4 pixels, 16 bytes each
+    gpu_pixels_a = cl.Buffer(context, cl.mem_flags.READ_WRITE, image_combined.size * 16)
+    gpu_pixels_b = cl.Buffer(context, cl.mem_flags.READ_WRITE, image_combined.size * 16)
+    # One running sum per row (w + 1 entries) or per column (h + 1 entries)
+    num_sums = max((image_combined.shape[1] + 1) * image_combined.shape[0],
+                   (image_combined.shape[0] + 1) * image_combined.shape[1])
+    gpu_sums = cl.Buffer(context, cl.mem_flags.READ_WRITE, num_sums * 16)
+    buf_end_time = time.time()
+    
+    local_size = (8, 8)
+    global_size = tuple([round_up(g, l) for g, l in zip(image_combined.shape[::-1], local_size)])
+
+    width = np.int32(image_combined.shape[1])
+    height = np.int32(image_combined.shape[0])
+    
+    ################################
+    ### USER CHANGEABLE SETTINGS ###
+    ################################
+    # Number of sweeps - 3 sweeps of a box blur approximate Gaussian Blur
+    num_sweeps = 3
+    # Saturation - Between 0 and 1
+    sat = 0.0
+    # Contrast - Between -255 and 255
+    con = 0.0
+    # The box radius used where the blur mask is 1.0 (completely blurry)
+    max_blur_radius = np.int32(8)
+    # The y-index of the center of the in-focus region
+    middle_in_focus = np.int32(600)
+    # The number of pixels to either side of the middle_in_focus to keep in focus
+    in_focus_radius = np.int32(50)
+    # The shape of the in-focus region: 'horizontal', 'circular', 'band' (a band
+    # through (middle_in_focus_x, middle_in_focus) tilted by focus_angle degrees)
+    # or 'elliptical' (see TiltShiftMasks.py)
+    focus_shape = 'horizontal'
+    # The x-index of the center of the in-focus region (all but horizontal)
+    middle_in_focus_x = 650
+    focus_angle = 0.0
+    ####################################
+    ### END USER CHANGEABLE SETTINGS ###
+    ####################################
+        
+    # Send image to the device, non-blocking
+    enqueue_start_time = time.time()
+    profiler.record(cl.enqueue_copy(queue, gpu_packed, image_combined, is_blocking=False),
+                    'upload', 'upload', image_combined.nbytes)
+    enqueue_end_time = time.time()
+
+    # The kernel reads the blur amount from the alpha byte, so write the blur
+    # mask there on the device, from the focus shape, instead of generating
+    # it on the host and combining it with the image before the upload
+    focus = focus_params(focus_shape, middle_in_focus_x, middle_in_focus, in_focus_radius,
+                         angle=focus_angle)
+    gpu_focus = cl.Buffer(context, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR, hostbuf=focus)
+    # The colors are graded while the pixels are packed, from a table built once
+    gpu_tone_lut = cl.Buffer(context, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR,
+                             hostbuf=tone_lut(sat, con))
+    event = mask_program.focus_alpha(queue, global_size, local_size,
+                                     gpu_packed, width, height, gpu_focus)
+    profiler.record(event, 'focus alpha', 'kernel', 2 * image_combined.nbytes)
+    
+    print("Image Width %s" % width)
+    print("Image Height %s" % height)
+        
+    # The bytes each kernel reads and writes per pixel: packed pixels are 4 bytes,
+    # float4 pixels and running sums are 16
+    num_pixels = image_combined.size
+    kernel_start_time = time.time()
+    event = program.unpack_pixels(queue, global_size, local_size,
+                                  gpu_packed, gpu_pixels_a,
+                                  width, height)
+    profiler.record(event, 'unpack_pixels', 'kernel', num_pixels * (4 + 16))
+    # Each sweep costs the same whatever max_blur_radius is
+    for sweep_num in range(num_sweeps):
+        print("In sweep %s of %s" % (sweep_num + 1, num_sweeps))
+        # Blur along the rows: one running sum per row, then one box per pixel
+        event = program.running_sum(queue, (int(height),), None,
+                                    gpu_pixels_a, gpu_sums,
+                                    width, height, np.int32(1), width)
+        profiler.record(event, 'row sums %s' % (sweep_num + 1), 'kernel', num_pixels * (16 + 16))
+        event = program.running_box(queue, global_size, local_size,
+                                    gpu_pixels_a, gpu_sums, gpu_packed, gpu_pixels_b,
+                                    width, height, np.int32(1), max_blur_radius)
+        profiler.record(event, 'row boxes %s' % (sweep_num + 1), 'kernel', num_pixels * (2 * 16 + 4 + 16))
+        # Blur along the columns
+        event = program.running_sum(queue, (int(width),), None,
+                                    gpu_pixels_b, gpu_sums,
+                                    height, width, width, np.int32(1))
+        profiler.record(event, 'column sums %s' % (sweep_num + 1), 'kernel', num_pixels * (16 + 16))
+        event = program.running_box(queue, global_size, local_size,
+                                    gpu_pixels_b, gpu_sums, gpu_packed, gpu_pixels_a,
+                                    width, height, np.int32(0), max_blur_radius)
+        profiler.record(event, 'column boxes %s' % (sweep_num + 1), 'kernel', num_pixels * (2 * 16 + 4 + 16))
+    event = program.pack_pixels(queue, global_size, local_size,
+                                gpu_pixels_a, gpu_packed, gpu_output,
+                                width, height, gpu_tone_lut)
+    profiler.record(event, 'pack_pixels', 'kernel', num_pixels * (16 + 4 + 4))
+    kernel_end_time = time.time()
+    
+    dequeue_start_time = time.time()
+    profiler.record(cl.enqueue_copy(queue, as_packed(host_image_filtered), gpu_output, is_blocking=True),
+                    'download', 'download', image_combined.nbytes)
+    dequeue_end_time = time.time()
+    
+    # The output is already RGBA bytes, so there is nothing left to convert.
+    # Its alpha channel still holds the blur mask, so only the colors are shown and saved
+    reconversion_start_time = time.time()
+    host_image_filtered = host_image_filtered[..., :3]
+    reconversion_end_time = time.time()
+    
+    end_time = time.time()
+    print("####### TIMING BREAKDOWN #######")
+    print("Took %s total seconds to run %s sweeps" % (end_time - start_time, num_sweeps))
+    print("Conversion time was %s seconds" % (conversion_end_time - conversion_start_time))
+    print("Buf creation time was %s seconds" % (buf_end_time - buf_start_time))
+    print("Enqueue time was %s seconds" % (enqueue_end_time - enqueue_start_time))
+    print("Kernel time was %s seconds" % (kernel_end_time - kernel_start_time))
+    print("Dequeue time was %s seconds" % (dequeue_end_time - dequeue_start_time))
+    print("Reconversion time was %s seconds" % (reconversion_end_time - reconversion_start_time))
+
+    # The times above only measure how long the calls took to return, the
+    # device's own times for each transfer and kernel come from their events
+    print("####### DEVICE TIMING #######")
+    profiler.print_report()
+    
+    # Display the new image
+    plt.imshow(host_image_filtered)    
+    plt.show()
+    save_rgba("MITBoathouse_TiltShiftColorRunningSum.png", host_image_filtered)
\ No newline at end of file
@@ -0,0 +1,103 @@
+#ifndef TILTSHIFT_FOCUS_H
+#define TILTSHIFT_FOCUS_H
+
+// The blur amount of each pixel, worked out on the device from the focus
+// shape instead of being uploaded as a mask.  The shape comes in constant
+// memory as the float parameters focus_params() in TiltShiftMasks.py builds:
+//   [shape id, center x, center y, radius, radius y, cos(angle), sin(angle),
+//    feather, number of vertices, x0, y0, x1, y1, ...]
+// The shapes other than the horizontal band use the same signed distance
+// fields as TiltShiftMasks.py: the distance to the outline of the in-focus
+// region, negative inside it, faded to full blur over feather pixels.
+
+#define FOCUS_HORIZONTAL 0
+#define FOCUS_CIRCULAR 1
+#define FOCUS_BAND 2
+#define FOCUS_ELLIPTICAL 3
+#define FOCUS_POLYGON 4
+
+// The blur amount for a pixel in row y, for a horizontal in-focus band
+// of radius focus_r around row focus_m that fades to full blur over its
+// outer feather rows, like blur_amount_from_distance() in TiltShiftMasks.py.
+// A focus_r of 0 blurs every row fully, which the pyramid relies on.
+inline float horizontal_blur_amount(int y, int focus_m, int focus_r, float feather) {
+    float blur_amount = 1.0;
+    int distance_to_m = abs(y - focus_m);
+
+    // The edge of the in-focus area should fade to blurry so that there is not an abrupt transition
+    float no_blur_region = focus_r - feather;
+    // If it is within the no blur region then don't have any blur at all, but then linearly increase to 1.0
+    if (distance_to_m < no_blur_region) {
+        blur_amount = 0;
+    } else if (distance_to_m < focus_r) {
+        blur_amount = (1.0 / feather) * (distance_to_m - no_blur_region);
+    }
+    return blur_amount;
+}
+
+// Approximate signed distance to an ellipse with semi-axes r, for a point
+// p in the frame of the ellipse, like ellipse_sdf() in TiltShiftMasks.py
+inline float ellipse_sdf(float2 p, float2 r) {
+    float k0 = length(p / r);
+    float k1 = length(p / (r * r));
+    if (k1 == 0) {
+        return -min(r.x, r.y);
+    }
+    return k0 * (k0 - 1) / k1;
+}
+
+// Signed distance to a polygon of num_vertices (x, y) vertices, like
+// polygon_sdf() in TiltShiftMasks.py
+inline float polygon_sdf(float2 p, __constant float* vertices, int num_vertices) {
+    float distance_sq = INFINITY;
+    int inside = 0;
+    int i;
+
+    for (i = 0; i < num_vertices; i++) {
+        int j = (i + 1) % num_vertices;
+        float2 a = (float2) (vertices[2 * i], vertices[2 * i + 1]);
+        float2 b = (float2) (vertices[2 * j], vertices[2 * j + 1]);
+        float2 e = b - a;
+        // The closest point on the edge to the pixel
+        float t = clamp(dot(p - a, e) / max(dot(e, e), 1e-12f), 0.0f, 1.0f);
+        float2 d = p - a - t * e;
+        distance_sq = min(distance_sq, dot(d, d));
+        // Does the edge cross the ray to the right of the pixel?
+        if (((a.y > p.y) != (b.y > p.y)) && (p.x < a.x + (p.y - a.y) * e.x / e.y)) {
+            inside = !inside;
+        }
+    }
+    return (inside ? -1.0f : 1.0f) * sqrt(distance_sq);
+}
+
+// The blur amount for pixel (x, y) of the focus shape in focus
+inline float focus_blur_amount(int x, int y, __constant float* focus) {
+    const int shape = (int) focus[0];
+    if (shape == FOCUS_HORIZONTAL) {
+        // The rows are kept in integers so the band is the same as it has always been
+        return horizontal_blur_amount(y, (int) focus[2], (int) focus[3], focus[7]);
+    }
+
+    // The pixel relative to the center, and in the frame of the rotated shape
+    const float2 d = (float2) (x - focus[1], y - focus[2]);
+    const float2 p = (float2) (d.x * focus[5] - d.y * focus[6], d.x * focus[6] + d.y * focus[5]);
+    const float feather = focus[7];
+    float sdf;
+
+    if (shape == FOCUS_CIRCULAR) {
+        sdf = length(d) - focus[3];
+    } else if (shape == FOCUS_BAND) {
+        sdf = fabs(p.y) - focus[3];
+    } else if (shape == FOCUS_ELLIPTICAL) {
+        sdf = ellipse_sdf(p, (float2) (focus[3], focus[4]));
+    } else {
+        sdf = polygon_sdf((float2) (x, y), focus + 9, (int) focus[8]);
+    }
+
+    if (feather <= 0) {
+        return sdf >= 0 ? 1.0f : 0.0f;
+    }
+    return clamp((sdf + feather) / feather, 0.0f, 1.0f);
+}
+
+#endif
@@ -0,0 +1,96 @@
+import numpy as np
+import os.path
+from TiltShiftPixels import to_rgba
+
+# Image files for the Tilt-Shift scripts, as (h, w, 4) RGBA uint8 arrays.
+# Frames the kernels read and write are best kept as .npy files or raw
+# RGBA bytes: they are memory-mapped rather than read, and a mapped
+# C-contiguous image can be handed to the kernels through as_packed()
+# (see TiltShiftPixels.py) and uploaded straight from the page cache,
+# with no decoding and no intermediate copy.
+# PNGs, JPEGs and the other formats are decoded with Pillow when it is
+# installed, which gives uint8 pixels directly instead of matplotlib's
+# float32 for PNGs, and encoded from uint8 the same way.  Without Pillow
+# (or for 16-bit images, which Pillow would clip) matplotlib is used.
+
+# Extensions of files holding raw RGBA bytes, which need the size given
+RAW_EXTENSIONS = ('.rgba', '.raw')
+
+# zlib level for saved PNGs: 1 is several times faster to encode than
+# Pillow's default of 6, for files a little larger
+PNG_COMPRESS_LEVEL = 1
+
+# Quality of saved JPEGs
+JPEG_QUALITY = 95
+
+# Returns the lower-case extension of a path
+def extension(path):
+    return os.path.splitext(path)[1].lower()
+
+# Opens an RGBA image file read-only without loading it: .npy files keep
+# their own shape, raw files need the width and height.  mode='r+' maps
+# it for writing in place.
+def open_image(path, width=None, height=None, mode='r'):
+    if extension(path) == '.npy':
+        return np.load(path, mmap_mode=mode)
+    if width is None or height is None:
+        raise ValueError('The width and height are needed to open the raw image %s' % path)
+    return np.memmap(path, dtype=np.uint8, mode=mode, shape=(height, width, 4))
+
+# Creates an RGBA image file of the given size, memory-mapped for writing
+def create_image(path, width, height):
+    if extension(path) == '.npy':
+        return np.lib.format.open_memmap(path, mode='w+', dtype=np.uint8, shape=(height, width, 4))
+    return np.memmap(path, dtype=np.uint8, mode='w+', shape=(height, width, 4))
+
+# Decodes an image file with Pillow, or returns None if Pillow is not
+# installed or the image has more than 8 bits per channel
+def decode_with_pillow(path):
+    try:
+        from PIL import Image
+    except ImportError:
+        return None
+    image = Image.open(path)
+    if image.mode in ('I', 'I;16', 'I;16B', 'I;16L', 'F'):
+        return None
+    if image.mode != 'RGBA':
+        image = image.convert('RGBA')
+    # One copy out of Pillow's buffer, into an array the kernels can write into
+    return np.array(image)
+
+# Loads an image as a contiguous (h, w, 4) RGBA uint8 array, which the
+# kernels read directly through a uint32 view.  .npy and raw RGBA files
+# are memory-mapped (raw ones need the width and height), anything else
+# is decoded.
+def load_rgba(path, width=None, height=None):
+    if extension(path) == '.npy' or extension(path) in RAW_EXTENSIONS:
+        return to_rgba(open_image(path, width, height))
+    rgba = decode_with_pillow(path)
+    if rgba is None:
+        import matplotlib.image as mpimg
+        return to_rgba(mpimg.imread(path))
+    return rgba
+
+# Saves a filtered RGBA image.  .npy and raw RGBA files get all four
+# channels, written straight from the array; the other formats get the
+# colors, since the alpha channel may hold a blur mask.
+def save_rgba(path, rgba):
+    if extension(path) == '.npy':
+        np.save(path, rgba)
+        return
+    if extension(path) in RAW_EXTENSIONS:
+        np.ascontiguousarray(rgba).tofile(path)
+        return
+    colors = np.ascontiguousarray(rgba[..., :3])
+    try:
+        from PIL import Image
+    except ImportError:
+        import matplotlib.image as mpimg
+        mpimg.imsave(path, colors)
+        return
+    options = {}
+    if extension(path) == '.png':
+        options['compress_level'] = PNG_COMPRESS_LEVEL
+    elif extension(path) in ('.jpg', '.jpeg'):
+        options['quality'] = JPEG_QUALITY
+    Image.fromarray(colors, 'RGB').save(path, **options)
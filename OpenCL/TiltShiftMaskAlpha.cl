@@ -0,0 +1,28 @@
+#include "TiltShiftPixels.h"
+#include "TiltShiftFocus.h"
+
+// Writes the blur mask into the alpha byte of every pixel on the device,
+// for the kernels that read the blur amount from there
+// (TiltShiftColorBaselineBlurMask.cl and TiltShiftColorRunningSum.cl).
+// The blur amount comes from the focus shape (see TiltShiftFocus.h), so
+// the mask is never generated, quantized or combined with the image on
+// the host, and only the image itself is uploaded.
+// The program is built with RGBA_OPTIONS, so the alpha byte is the x of
+// an expanded pixel.
+
+__kernel void
+focus_alpha(__global uint* values,
+            int w, int h,
+            __constant float* focus) {
+
+    // Global position of the pixel
+    const int x = get_global_id(0);
+    const int y = get_global_id(1);
+
+    if ((y < h) && (x < w)) {
+        uchar4 pixel = expand(values[y * w + x]);
+        // Quantized like quantize_blur_mask() in TiltShiftMasks.py, dropping the fraction
+        pixel.x = convert_uchar_sat_rtz(255.0f * focus_blur_amount(x, y, focus));
+        values[y * w + x] = pack(pixel);
+    }
+}
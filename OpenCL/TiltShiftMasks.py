@@ -0,0 +1,351 @@
+import numpy as np
+import collections
+import threading
+
+# Blur masks for the Tilt-Shift effect, and a cache for reusing them.
+# A blur mask holds one blur amount per pixel, from 0.0 (in focus) to
+# 1.0 (completely blurry).  Video and batch jobs use the same mask for
+# every frame, so BlurMaskCache keeps recently used masks, along with
+# the quantized alpha plane the BaselineBlurMask kernel reads, instead
+# of generating them again for every image.
+
+# The focus shapes the cache knows how to generate
+MASK_SHAPES = ('horizontal', 'circular', 'band', 'elliptical', 'polygon')
+
+# The number the kernels know each shape by (see TiltShiftFocus.h)
+SHAPE_IDS = dict((shape, index) for index, shape in enumerate(MASK_SHAPES))
+
+# Converts distances from the middle of the in-focus region into blur
+# amounts: no blur in the inner (1 - fade) of in_focus_radius, then a
+# linear fade to full blur at in_focus_radius so that there is not an
+# abrupt transition, and full blur beyond it
+def blur_amount_from_distance(distance_to_m, in_focus_radius, fade=0.2):
+    no_blur_region = (1 - fade) * in_focus_radius
+    blur_amount = np.ones(np.shape(distance_to_m))
+    blur_amount[distance_to_m <= no_blur_region] = 0.0
+    fading = (distance_to_m > no_blur_region) & (distance_to_m < in_focus_radius)
+    blur_amount[fading] = (1.0 / (in_focus_radius - no_blur_region)) * (distance_to_m[fading] - no_blur_region)
+    return blur_amount
+
+# generates horizontal blur mask using focus middle, focus radius, and image height,
+# and stores the blur mask in the blur_mask parameter (np.array)
+# The mask is computed for all rows at once from each row's distance to the
+# middle, so middle_in_focus can be anywhere, even outside the image.
+def generate_horizontal_blur_mask(blur_mask, middle_in_focus, in_focus_radius, height, fade=0.2):
+    # The blur amount depends on the y-value of the pixel
+    distance_to_m = np.abs(np.arange(height) - middle_in_focus)
+    blur_mask[:height] = blur_amount_from_distance(distance_to_m, in_focus_radius, fade)[:, np.newaxis]
+
+# generates circular blur mask using focus center, focus radius, and image width and height,
+# and stores the blur mask in the blur_mask parameter (np.array)
+# The mask is computed for all pixels at once from each pixel's distance to the
+# center, so the circle is clipped wherever it crosses the edge of the image.
+def generate_circular_blur_mask(blur_mask, middle_in_focus_x, middle_in_focus_y, in_focus_radius, width, height, fade=0.2):
+    # The blur amount depends on the euclidean distance between the pixel and focus center
+    y, x = np.ogrid[:height, :width]
+    distance_to_m = np.sqrt((x - middle_in_focus_x) ** 2 + (y - middle_in_focus_y) ** 2)
+    blur_mask[:height, :width] = blur_amount_from_distance(distance_to_m, in_focus_radius, fade)
+
+# The shapes below are rasterized from signed distance fields: the distance
+# in pixels from each pixel to the outline of the in-focus region, negative
+# inside it.  The blur amount fades from 0 at feather pixels inside the
+# outline to 1 on the outline, the same ramp blur_amount_from_distance()
+# gives a band or circle with feather = fade * in_focus_radius.  The fields
+# are computed for all pixels at once, and TiltShiftFocus.h computes the same
+# fields per pixel on the device.
+
+# Converts signed distances to the outline into blur amounts
+def blur_amount_from_sdf(sdf, feather):
+    if feather <= 0:
+        return (sdf >= 0).astype(np.float64)
+    return np.clip((sdf + feather) / float(feather), 0.0, 1.0)
+
+# Returns the (u, v) coordinates of pixels in the frame of a shape centered
+# on (center_x, center_y) and rotated counterclockwise by angle degrees:
+# u runs along the shape and v across it
+def rotated_coordinates(x, y, center_x, center_y, angle):
+    theta = np.radians(angle)
+    dx = x - center_x
+    dy = y - center_y
+    return dx * np.cos(theta) - dy * np.sin(theta), dx * np.sin(theta) + dy * np.cos(theta)
+
+# Signed distance to the edges of a straight band of half width radius
+# through (center_x, center_y), tilted by angle degrees from horizontal
+def band_sdf(x, y, center_x, center_y, radius, angle):
+    u, v = rotated_coordinates(x, y, center_x, center_y, angle)
+    return np.abs(v) - radius
+
+# Approximate signed distance to an ellipse with semi-axes radius_x and
+# radius_y, rotated by angle degrees.  The distance is exact on the axes and
+# close everywhere else, which is all a feathered edge needs.
+def ellipse_sdf(x, y, center_x, center_y, radius_x, radius_y, angle):
+    u, v = rotated_coordinates(x, y, center_x, center_y, angle)
+    k0 = np.sqrt((u / float(radius_x)) ** 2 + (v / float(radius_y)) ** 2)
+    k1 = np.sqrt((u / float(radius_x) ** 2) ** 2 + (v / float(radius_y) ** 2) ** 2)
+    # k1 is 0 only at the center, which is min(radius_x, radius_y) inside
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sdf = np.where(k1 > 0, k0 * (k0 - 1) / k1, -min(radius_x, radius_y))
+    return sdf
+
+# Signed distance to a polygon given as a list of (x, y) vertices, negative
+# inside it.  The distance is the shortest one to any edge, and the sign
+# comes from counting the edges a ray to the right of the pixel crosses, so
+# the polygon can be concave.  The pixels are all handled at once, with a
+# loop over the edges only.
+def polygon_sdf(x, y, vertices):
+    vertices = np.asarray(vertices, dtype=np.float64)
+    if vertices.ndim != 2 or vertices.shape[1] != 2 or len(vertices) < 3:
+        raise ValueError('A polygon needs at least 3 (x, y) vertices, got %s' % (vertices.shape,))
+    x, y = np.broadcast_arrays(x, y)
+    distance_sq = np.full(x.shape, np.inf)
+    inside = np.zeros(x.shape, dtype=bool)
+    for (x0, y0), (x1, y1) in zip(vertices, np.roll(vertices, -1, axis=0)):
+        ex, ey = x1 - x0, y1 - y0
+        # The closest point on the edge to each pixel
+        t = np.clip(((x - x0) * ex + (y - y0) * ey) / max(ex * ex + ey * ey, 1e-12), 0.0, 1.0)
+        distance_sq = np.minimum(distance_sq, (x - x0 - t * ex) ** 2 + (y - y0 - t * ey) ** 2)
+        # Does the edge cross the ray to the right of the pixel?
+        crosses = (y0 > y) != (y1 > y)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            crossing_x = x0 + (y - y0) * ex / ey
+        inside ^= crosses & (x < crossing_x)
+    return np.where(inside, -1.0, 1.0) * np.sqrt(distance_sq)
+
+# generates a blur mask for any of the MASK_SHAPES and stores it in blur_mask.
+#  - horizontal: a band of in_focus_radius around row middle_in_focus_y
+#  - circular: a circle of in_focus_radius around (middle_in_focus_x, middle_in_focus_y)
+#  - band: like horizontal, but through (middle_in_focus_x, middle_in_focus_y)
+#    and tilted by angle degrees
+#  - elliptical: an ellipse with semi-axes in_focus_radius and radius_y,
+#    rotated by angle degrees
+#  - polygon: the region inside vertices, fading over in_focus_radius
+#    pixels inside its edges
+# For the other shapes the blur fades over fade * in_focus_radius pixels
+# (fade * the smaller semi-axis for ellipses).
+def generate_shape_blur_mask(blur_mask, shape, middle_in_focus_x, middle_in_focus_y,
+                             in_focus_radius, width, height, fade=0.2,
+                             angle=0.0, radius_y=None, vertices=None):
+    if shape == 'horizontal':
+        generate_horizontal_blur_mask(blur_mask, middle_in_focus_y, in_focus_radius, height, fade)
+        return
+    if shape == 'circular':
+        generate_circular_blur_mask(blur_mask, middle_in_focus_x, middle_in_focus_y,
+                                    in_focus_radius, width, height, fade)
+        return
+
+    y, x = np.ogrid[:height, :width]
+    if shape == 'band':
+        sdf = band_sdf(x, y, middle_in_focus_x, middle_in_focus_y, in_focus_radius, angle)
+        feather = fade * in_focus_radius
+    elif shape == 'elliptical':
+        if radius_y is None:
+            radius_y = in_focus_radius
+        sdf = ellipse_sdf(x, y, middle_in_focus_x, middle_in_focus_y, in_focus_radius, radius_y, angle)
+        feather = fade * min(in_focus_radius, radius_y)
+    elif shape == 'polygon':
+        sdf = polygon_sdf(x, y, vertices)
+        feather = in_focus_radius
+    else:
+        raise ValueError('Unknown mask shape %r, expected one of %s' % (shape, ', '.join(MASK_SHAPES)))
+    blur_mask[:height, :width] = blur_amount_from_sdf(sdf, feather)
+
+# Returns the focus parameters the kernels evaluate a shape from, as a
+# float32 array for constant memory (see TiltShiftFocus.h):
+#   [shape id, center x, center y, radius, radius y, cos(angle), sin(angle),
+#    feather, number of vertices, x0, y0, x1, y1, ...]
+# The arguments are the same as generate_shape_blur_mask()'s.
+def focus_params(shape, middle_in_focus_x, middle_in_focus_y, in_focus_radius,
+                 fade=0.2, angle=0.0, radius_y=None, vertices=None):
+    if shape not in SHAPE_IDS:
+        raise ValueError('Unknown mask shape %r, expected one of %s' % (shape, ', '.join(MASK_SHAPES)))
+    if radius_y is None:
+        radius_y = in_focus_radius
+    if shape == 'polygon':
+        vertices = np.asarray(vertices, dtype=np.float64).reshape(-1, 2)
+        if len(vertices) < 3:
+            raise ValueError('A polygon needs at least 3 (x, y) vertices, got %s' % len(vertices))
+        feather = in_focus_radius
+    else:
+        vertices = np.zeros((0, 2))
+        feather = fade * (min(in_focus_radius, radius_y) if shape == 'elliptical' else in_focus_radius)
+    theta = np.radians(angle)
+    header = [SHAPE_IDS[shape], middle_in_focus_x or 0, middle_in_focus_y, in_focus_radius, radius_y,
+              np.cos(theta), np.sin(theta), feather, len(vertices)]
+    return np.concatenate([header, vertices.reshape(-1)]).astype(np.float32)
+
+# Returns focus parameters moved by (dx, dy) pixels, for kernels that only
+# see part of the image, such as a band of rows starting at row -dy
+def translate_focus(focus, dx, dy):
+    focus = focus.copy()
+    focus[1] += dx
+    focus[2] += dy
+    focus[9::2] += dx
+    focus[10::2] += dy
+    return focus
+
+# Quantizes a blur mask to the byte the BaselineBlurMask kernel reads from
+# the alpha channel, the same way as (255 * blur_mask).astype(np.uint32)
+def quantize_blur_mask(blur_mask):
+    return (255 * blur_mask.astype(np.float32)).astype(np.uint8)
+
+# Opens an (h, w) depth map without loading it where the format allows:
+# .npy files are memory-mapped with their own shape and dtype, raw files
+# of little-endian uint16 depths are memory-mapped with the width and
+# height given, and PNGs (8 or 16-bit, compressed so they cannot be
+# mapped) are decoded and scaled to 0-65535 whatever their bit depth.
+# Convert a depth map too large to decode to .npy once and open that.
+def open_depth_map(path, width=None, height=None):
+    if path.endswith('.npy'):
+        depth_map = np.load(path, mmap_mode='r')
+    elif path.endswith('.png'):
+        import matplotlib.image as mpimg
+        # imread() scales the depths of any bit depth to floats between 0 and 1
+        depth_map = mpimg.imread(path)
+        if depth_map.ndim == 3:
+            depth_map = depth_map[..., 0]
+        depth_map = np.round(65535 * depth_map).astype(np.uint16)
+    else:
+        if width is None or height is None:
+            raise ValueError('The width and height are needed to open the raw depth map %s' % path)
+        depth_map = np.memmap(path, dtype='<u2', mode='r', shape=(height, width))
+    if depth_map.ndim != 2:
+        raise ValueError('Expected an (h, w) depth map in %s, got shape %s' % (path, depth_map.shape))
+    return depth_map
+
+# Converts depths into blur amounts, the way blur_amount_from_distance()
+# converts distances from the middle of the in-focus region: the focal
+# plane is at focal_depth, depths within the inner (1 - fade) of
+# in_focus_depth of it are in focus, and the blur fades to full blur at
+# in_focus_depth from it.  The depths are in the units of the depth map.
+def blur_amount_from_depth(depth, focal_depth, in_focus_depth, fade=0.2):
+    distance = np.abs(np.asarray(depth, dtype=np.float32) - np.float32(focal_depth))
+    return blur_amount_from_distance(distance, in_focus_depth, fade)
+
+# The blur mask of a depth map, worked out a band of rows at a time.
+# The depth map is usually memory-mapped (see open_depth_map()), so only
+# the rows of the band being blurred are read and converted, and the
+# whole mask never has to be in memory next to the image.
+class DepthBlurMask(object):
+
+    def __init__(self, depth_map, focal_depth, in_focus_depth, fade=0.2):
+        self.depth_map = depth_map
+        self.focal_depth = focal_depth
+        self.in_focus_depth = in_focus_depth
+        self.fade = fade
+
+    @property
+    def shape(self):
+        return self.depth_map.shape
+
+    # Returns the float blur amounts of rows [start, stop)
+    def rows(self, start, stop):
+        return blur_amount_from_depth(self.depth_map[start:stop], self.focal_depth,
+                                      self.in_focus_depth, self.fade)
+
+    # Returns the blur amounts of rows [start, stop) as the uint8 alpha bytes
+    # the BaselineBlurMask kernel reads
+    def alpha_rows(self, start, stop):
+        return quantize_blur_mask(self.rows(start, stop))
+
+# A memoizing provider of blur masks with least-recently-used eviction.
+# Masks are keyed by their geometry and the cache holds at most max_bytes
+# of them.  The arrays it returns are read-only so they can safely be
+# shared between images and threads.
+class BlurMaskCache(object):
+
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        # key -> {'mask': float64 mask, 'alpha': uint8 alpha plane}, oldest first
+        self.entries = collections.OrderedDict()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    # Returns the cache key for a mask.  middle_in_focus_x only matters for
+    # shapes other than horizontal, and angle, radius_y and vertices only
+    # for the shapes that use them.
+    def key(self, width, height, middle_in_focus_y, in_focus_radius,
+            shape, middle_in_focus_x, fade, angle=0.0, radius_y=None, vertices=None):
+        if shape not in MASK_SHAPES:
+            raise ValueError('Unknown mask shape %r, expected one of %s' % (shape, ', '.join(MASK_SHAPES)))
+        if shape == 'horizontal':
+            middle_in_focus_x = None
+        if shape not in ('band', 'elliptical'):
+            angle = 0.0
+        if shape != 'elliptical':
+            radius_y = None
+        if shape == 'polygon':
+            vertices = tuple(tuple(float(c) for c in vertex) for vertex in vertices)
+        else:
+            vertices = None
+        return (shape, int(width), int(height), middle_in_focus_x, middle_in_focus_y,
+                in_focus_radius, fade, angle, radius_y, vertices)
+
+    # Generates the float mask for a key
+    def generate(self, key):
+        (shape, width, height, middle_in_focus_x, middle_in_focus_y, in_focus_radius, fade,
+         angle, radius_y, vertices) = key
+        blur_mask = np.ones((height, width))
+        generate_shape_blur_mask(blur_mask, shape, middle_in_focus_x, middle_in_focus_y,
+                                 in_focus_radius, width, height, fade, angle, radius_y, vertices)
+        return blur_mask
+
+    # Returns the entry for a key, generating the float mask on a miss and the
+    # named array (plane) with make_plane if the entry does not have it yet
+    def lookup(self, key, plane, make_plane):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None and plane in entry:
+                self.hits += 1
+                # Re-insert so the entry is now the most recently used
+                self.entries[key] = entry
+                return entry[plane]
+
+            self.misses += 1
+            if entry is None:
+                entry = {'mask': self.generate(key)}
+                entry['mask'].flags.writeable = False
+                self.current_bytes += entry['mask'].nbytes
+            if plane not in entry:
+                entry[plane] = make_plane(entry['mask'])
+                entry[plane].flags.writeable = False
+                self.current_bytes += entry[plane].nbytes
+            self.entries[key] = entry
+
+            # Drop the least recently used masks until the cache fits again
+            while self.current_bytes > self.max_bytes and self.entries:
+                old_key, old_entry = self.entries.popitem(last=False)
+                self.current_bytes -= sum(array.nbytes for array in old_entry.values())
+                self.evictions += 1
+            return entry[plane]
+
+    # Returns the read-only float blur mask, with shape (height, width)
+    def mask(self, width, height, middle_in_focus_y, in_focus_radius,
+             shape='horizontal', middle_in_focus_x=None, fade=0.2,
+             angle=0.0, radius_y=None, vertices=None):
+        key = self.key(width, height, middle_in_focus_y, in_focus_radius,
+                       shape, middle_in_focus_x, fade, angle, radius_y, vertices)
+        return self.lookup(key, 'mask', lambda blur_mask: blur_mask)
+
+    # Returns the read-only uint8 alpha plane of the blur mask, quantized the
+    # way the BaselineBlurMask kernel expects it
+    def alpha_plane(self, width, height, middle_in_focus_y, in_focus_radius,
+                    shape='horizontal', middle_in_focus_x=None, fade=0.2,
+                    angle=0.0, radius_y=None, vertices=None):
+        key = self.key(width, height, middle_in_focus_y, in_focus_radius,
+                       shape, middle_in_focus_x, fade, angle, radius_y, vertices)
+        return self.lookup(key, 'alpha', quantize_blur_mask)
+
+    # Returns the hit and miss counts and the memory the cache is using
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'hit_rate': self.hits / float(lookups) if lookups else 0.0,
+                    'entries': len(self.entries),
+                    'bytes': self.current_bytes,
+                    'max_bytes': self.max_bytes}
@@ -0,0 +1,250 @@
+import pyopencl as cl
+import numpy as np
+import sys
+import time
+from TiltShiftSession import TiltShiftSession, DEFAULT_CACHE_DIR, select_devices, sub_devices
+from TiltShiftTuner import DEFAULT_TUNING_PATH
+from TiltShiftColorOptimized import run_pass, upload_tone_lut, upload_focus
+from TiltShiftMasks import focus_params, translate_focus
+from TiltShiftPixels import as_packed, empty_rgba
+
+# Runs the Tilt-Shift effect on several OpenCL devices at once.
+# The image is split into horizontal bands, one per device, each with a
+# session (context, queue, programs and buffers) of its own.  Every
+# device holds its band with one halo row above and below, which is all
+# a single pass of the 3x3 blur reads.  The halo rows come out of a pass
+# wrong, since the kernel clamps at the edge of the band, so between
+# passes each device downloads the first and last rows of its band and
+# uploads them into the halo rows of its neighbours.  Only two rows per
+# boundary cross the host, so the passes stay on the devices.
+# The bands are sized by the throughput measured on the previous image
+# (rows blurred per second, from the kernel events), so a fast GPU gets
+# more rows than a slow CPU and the devices finish together.
+# To try it on a machine with a single CPU device, split the device into
+# sub-devices (pocl supports this), for example with num_sub_devices below.
+
+# How much of the throughput measured on the latest image goes into the
+# estimate, the rest is the estimate from the images before it
+THROUGHPUT_SMOOTHING = 0.5
+
+class MultiDeviceSession(object):
+
+    def __init__(self, devices, cache_dir=DEFAULT_CACHE_DIR, tuning_path=DEFAULT_TUNING_PATH):
+        if not devices:
+            raise ValueError('No devices to run on')
+        self.sessions = [TiltShiftSession(device, cache_dir, tuning_path=tuning_path)
+                         for device in devices]
+        # Rows per second each device has blurred, None until it has been measured
+        self.throughput = [None] * len(devices)
+
+    # Returns the share of the rows each device gets.  Until every device has
+    # been measured, the shares are estimated from the compute units and clocks
+    def weights(self):
+        if None not in self.throughput:
+            return list(self.throughput)
+        return [float(session.device.max_compute_units * max(session.device.max_clock_frequency, 1))
+                for session in self.sessions]
+
+    # Folds the rows per second a device blurred on the latest image into its estimate
+    def update_throughput(self, index, rows_per_second):
+        if self.throughput[index] is None:
+            self.throughput[index] = rows_per_second
+        else:
+            self.throughput[index] = (THROUGHPUT_SMOOTHING * rows_per_second +
+                                      (1 - THROUGHPUT_SMOOTHING) * self.throughput[index])
+
+# Splits height rows into one (start, stop) band per weight, with sizes
+# proportional to the weights.  Bands can be empty when there are fewer
+# rows than devices.
+def split_rows(height, weights):
+    total = float(sum(weights))
+    bounds = [0]
+    cumulative = 0.0
+    for weight in weights:
+        cumulative += weight
+        bounds.append(int(round(height * cumulative / total)))
+    bounds[-1] = height
+    return list(zip(bounds[:-1], bounds[1:]))
+
+# One device's band of the image and its buffers, with one halo row on
+# each side that has a neighbour
+class Band(object):
+
+    def __init__(self, index, session, start, stop, height, width):
+        self.index = index
+        self.session = session
+        self.start = start
+        self.stop = stop
+        self.halo_start = max(start - 1, 0)
+        self.halo_stop = min(stop + 1, height)
+        self.row_bytes = 4 * width
+        nbytes = (self.halo_stop - self.halo_start) * self.row_bytes
+        self.gpu_image_a = session.get_buffer(nbytes)
+        self.gpu_image_b = session.get_buffer(nbytes)
+        # The edge rows downloaded for the neighbours, one buffer per band so
+        # that no two devices write into the same host memory
+        self.first_row = np.empty(width, dtype=np.uint32)
+        self.last_row = np.empty(width, dtype=np.uint32)
+        self.kernel_events = []
+
+    # Returns the byte offset of an image row in the band buffers
+    def offset(self, row):
+        return (row - self.halo_start) * self.row_bytes
+
+    def release(self):
+        self.session.release_buffer(self.gpu_image_a)
+        self.session.release_buffer(self.gpu_image_b)
+
+# Copies the edge rows of each band into the halo rows of its neighbours
+def exchange_halos(bands):
+    downloads = []
+    for band in bands:
+        queue = band.session.queue
+        if band.halo_start < band.start:
+            downloads.append(band.session.record(
+                cl.enqueue_copy(queue, band.first_row, band.gpu_image_a,
+                                device_offset=band.offset(band.start), is_blocking=False),
+                'halo rows', 'download', band.row_bytes))
+        if band.stop < band.halo_stop:
+            downloads.append(band.session.record(
+                cl.enqueue_copy(queue, band.last_row, band.gpu_image_a,
+                                device_offset=band.offset(band.stop - 1), is_blocking=False),
+                'halo rows', 'download', band.row_bytes))
+    # The events belong to different contexts, so wait for them one by one
+    for event in downloads:
+        event.wait()
+
+    uploads = []
+    for above, below in zip(bands[:-1], bands[1:]):
+        uploads.append(above.session.record(
+            cl.enqueue_copy(above.session.queue, above.gpu_image_a, below.first_row,
+                            device_offset=above.offset(above.stop), is_blocking=False),
+            'halo rows', 'upload', above.row_bytes))
+        uploads.append(below.session.record(
+            cl.enqueue_copy(below.session.queue, below.gpu_image_a, above.last_row,
+                            device_offset=below.offset(below.halo_start), is_blocking=False),
+            'halo rows', 'upload', below.row_bytes))
+    # The uploads read the edge rows from host memory on the neighbours'
+    # queues, and the next exchange downloads into the same rows on the
+    # owners' queues, so let every upload finish before that can happen
+    for event in uploads:
+        event.wait()
+
+# Applies the tilt-shift effect to an (h, w, 4) RGBA image, splitting it
+# across the devices of a MultiDeviceSession, and returns the filtered
+# image.  The kernel time of every device updates its throughput, so the
+# next image is split to match.  local_size=None uses the local size tuned
+# for each device (see TiltShiftTuner.py).  focus is the focus shape
+# from focus_params(), or None for the horizontal band.
+def tiltshift_multi(multi, rgba, num_passes=3, sat=0.0, con=0.0,
+                    middle_in_focus=600, in_focus_radius=50,
+                    local_size=None, tone_curve=None, focus=None):
+    if focus is None:
+        focus = focus_params('horizontal', None, middle_in_focus, in_focus_radius)
+    image_combined = as_packed(rgba)
+    height, width = image_combined.shape
+    bands = []
+    for index, (session, (start, stop)) in enumerate(zip(multi.sessions,
+                                                         split_rows(height, multi.weights()))):
+        if stop > start:
+            bands.append(Band(index, session, start, stop, height, width))
+
+    for band in bands:
+        band.session.record(cl.enqueue_copy(band.session.queue, band.gpu_image_a,
+                                            image_combined[band.halo_start:band.halo_stop],
+                                            is_blocking=False),
+                            'upload rows %s-%s' % (band.halo_start, band.halo_stop), 'upload',
+                            (band.halo_stop - band.halo_start) * band.row_bytes)
+        band.gpu_tone_lut = upload_tone_lut(band.session, sat, con, tone_curve)
+        # The kernels only see their band, so the focus shape moves up with it
+        band.gpu_focus = upload_focus(band.session, None, None,
+                                      translate_focus(focus, 0, -band.halo_start))
+        band.local_size = local_size
+        if band.local_size is None:
+            band.local_size = band.session.tuner.local_size(band.session, width, num_passes,
+                                                            False)
+
+    for pass_num in range(num_passes):
+        last_pass = pass_num == num_passes - 1
+        for band in bands:
+            band.kernel_events.append(run_pass(
+                band.session, band.gpu_image_a, band.gpu_image_b,
+                width, band.halo_stop - band.halo_start, band.gpu_tone_lut, last_pass,
+                band.gpu_focus, band.local_size,
+                rgba=True, name='pass %s' % (pass_num + 1)))
+            band.gpu_image_a, band.gpu_image_b = band.gpu_image_b, band.gpu_image_a
+        if not last_pass:
+            exchange_halos(bands)
+
+    # Download the band rows, leaving the halo rows behind
+    rgba_filtered = empty_rgba(height, width)
+    downloads = []
+    for band in bands:
+        downloads.append(band.session.record(
+            cl.enqueue_copy(band.session.queue, as_packed(rgba_filtered[band.start:band.stop]),
+                            band.gpu_image_a, device_offset=band.offset(band.start),
+                            is_blocking=False),
+            'download rows %s-%s' % (band.start, band.stop), 'download',
+            (band.stop - band.start) * band.row_bytes))
+    for event in downloads:
+        event.wait()
+
+    for band in bands:
+        seconds = sum(event.profile.end - event.profile.start for event in band.kernel_events) * 1e-9
+        if seconds > 0:
+            multi.update_throughput(band.index, (band.stop - band.start) * num_passes / seconds)
+        band.release()
+    return rgba_filtered
+
+# Run the Tilt-Shift effect on an image across several devices:
+#   python TiltShiftMultiDevice.py ../MITBoathouse.png MITBoathouse_TiltShift.png
+if __name__ == '__main__':
+    from TiltShiftImageIO import load_rgba, save_rgba
+    if len(sys.argv) != 3:
+        print("Usage: python TiltShiftMultiDevice.py <input image> <output image>")
+        sys.exit(1)
+
+    ################################
+    ### USER CHANGEABLE SETTINGS ###
+    ################################
+    # Number of Passes - 3 passes approximates Gaussian Blur
+    num_passes = 3
+    # Saturation - Between 0 and 1
+    sat = 0.0
+    # Contrast - Between -255 and 255
+    con = 0.0
+    # The y-index of the center of the in-focus region
+    middle_in_focus = 600
+    # The number of pixels to either side of the middle_in_focus to keep in focus
+    in_focus_radius = 50
+    # The devices to run on, as a name, type or index (see select_devices()),
+    # or None for every device
+    device_spec = None
+    # Split the first selected device into this many sub-devices instead,
+    # to try the multi-device mode on a single CPU, or None to use the devices as they are
+    num_sub_devices = None
+    # Runs of the image, so that the bands settle on the measured throughputs
+    num_runs = 3
+    ####################################
+    ### END USER CHANGEABLE SETTINGS ###
+    ####################################
+
+    devices = select_devices(device_spec)
+    if num_sub_devices is not None:
+        devices = sub_devices(devices[0], num_sub_devices)
+    multi = MultiDeviceSession(devices)
+    rgba = load_rgba(sys.argv[1])
+    height, width = rgba.shape[:2]
+    print("Image Width %s, Height %s" % (width, height))
+
+    for run in range(num_runs):
+        bands = split_rows(height, multi.weights())
+        start_time = time.time()
+        rgba_filtered = tiltshift_multi(multi, rgba, num_passes, sat, con,
+                                        middle_in_focus, in_focus_radius)
+        end_time = time.time()
+        print("Run %s took %s seconds" % (run + 1, end_time - start_time))
+        for session, (start, stop), throughput in zip(multi.sessions, bands, multi.throughput):
+            print("  %s: rows %s-%s, %s rows per second" % (session.device.name, start, stop, throughput))
+
+    save_rgba(sys.argv[2], rgba_filtered)
@@ -0,0 +1,36 @@
+#ifndef TILTSHIFT_PIXELS_H
+#define TILTSHIFT_PIXELS_H
+
+// Pixel packing shared by the Tilt-Shift kernels.
+// Inside the kernels a pixel is a uchar4 of (alpha, red, green, blue),
+// where alpha holds the blur amount for the BlurMask kernels.
+// In global memory a pixel is one uint, either
+//  - 0xAARRGGBB, built on the host with shifts (the default), or
+//  - the four bytes of an (h, w, 4) RGBA uint8 image, when the program
+//    is built with -D RGBA_PIXELS, so the host can upload its image
+//    without converting it first.  as_uchar4() follows the byte order
+//    of the device, which is the same as the host's on little-endian
+//    devices.
+
+// Unpacks a uint pixel into (alpha, red, green, blue)
+inline uchar4 expand(uint accessed) {
+#ifdef RGBA_PIXELS
+    uchar4 rgba = as_uchar4(accessed);
+    uchar4 expanded = {rgba.w, rgba.x, rgba.y, rgba.z};
+#else
+    uchar4 expanded = {((accessed >> 24) & 0xFF), ((accessed >> 16) & 0xFF), ((accessed >> 8) & 0xFF), ((accessed) & 0xFF)};
+#endif
+    return expanded;
+}
+
+// Packs an (alpha, red, green, blue) pixel back into a uint
+inline uint pack(uchar4 p) {
+#ifdef RGBA_PIXELS
+    uchar4 rgba = {p.y, p.z, p.w, p.x};
+    return as_uint(rgba);
+#else
+    return ((uint) p.x << 24) + (p.y << 16) + (p.z << 8) + p.w;
+#endif
+}
+
+#endif
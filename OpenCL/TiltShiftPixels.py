@@ -0,0 +1,44 @@
+import numpy as np
+
+# Zero-copy pixel packing for the Tilt-Shift kernels.
+# The kernels take one uint per pixel.  Rather than building that uint
+# with shifts and adds (three uint32 temporaries on the way in, three
+# masked shifts on the way out), the host keeps its image as a
+# contiguous (h, w, 4) RGBA uint8 array and hands the kernels a uint32
+# view of the same memory.  Programs built with RGBA_OPTIONS read and
+# write that byte order natively (see TiltShiftPixels.h), and the blur
+# mask byte goes straight into the alpha channel.
+
+# Build options that make the kernels use the RGBA byte order
+RGBA_OPTIONS = ('-D', 'RGBA_PIXELS')
+
+# Returns the image as a contiguous (h, w, 4) RGBA uint8 array.
+# Images that already are one are returned as they are, without a copy.
+# RGB images get an opaque alpha channel, and float images (PNGs are
+# decoded to floats between 0 and 1) are scaled to 0-255.
+def to_rgba(input_image):
+    if input_image.dtype.kind == 'f':
+        input_image = np.round(input_image * 255).astype(np.uint8)
+    if input_image.dtype == np.uint8 and input_image.shape[2] == 4 and input_image.flags.c_contiguous:
+        return input_image
+    rgba = np.empty(input_image.shape[:2] + (4,), dtype=np.uint8)
+    rgba[..., :3] = input_image[..., :3]
+    if input_image.shape[2] == 4:
+        rgba[..., 3] = input_image[..., 3]
+    else:
+        rgba[..., 3] = 255
+    return rgba
+
+# Returns an (h, w) uint32 view of an RGBA image for the kernels, without copying it
+def as_packed(rgba):
+    if rgba.dtype != np.uint8 or rgba.ndim != 3 or rgba.shape[2] != 4 or not rgba.flags.c_contiguous:
+        raise ValueError('Expected a contiguous (h, w, 4) uint8 image, got %s %s' % (rgba.dtype, rgba.shape))
+    return rgba.view(np.uint32).reshape(rgba.shape[:2])
+
+# Writes the quantized blur mask into the alpha channel of an RGBA image, in place
+def write_blur_alpha(rgba, blur_alpha):
+    rgba[..., 3] = blur_alpha
+
+# Returns an empty RGBA image to download the kernel output into
+def empty_rgba(height, width):
+    return np.empty((height, width, 4), dtype=np.uint8)
@@ -0,0 +1,100 @@
+import json
+import pyopencl as cl
+
+# Records the events of OpenCL commands and reports what the device did.
+# Timing an enqueue with time.time() only measures how long the call takes
+# to return, not the transfer or the kernel itself, which may not even
+# have started yet.  Every command returns an event instead, and with a
+# profiling-enabled queue the event holds the device's own timestamps:
+#  - queued: when the command was enqueued on the host
+#  - submit: when it was handed to the device
+#  - start and end: when the device ran it
+# The profiler keeps the events of the commands it is given, and once
+# they are complete reports their times, the bytes each one moved and
+# the bandwidth achieved, or exports them as a Chrome trace that can be
+# opened in chrome://tracing or https://ui.perfetto.dev.
+
+class TiltShiftProfiler(object):
+
+    def __init__(self):
+        # (name, category, event, bytes moved), in the order they were enqueued
+        self.entries = []
+
+    # Records the event of a command and returns it.  category is 'upload',
+    # 'download' or 'kernel', and nbytes is how many bytes the command reads
+    # and writes in global memory, which the bandwidth is worked out from.
+    def record(self, event, name, category='kernel', nbytes=0):
+        self.entries.append((name, category, event, nbytes))
+        return event
+
+    # Forgets every recorded event
+    def clear(self):
+        self.entries = []
+
+    # Waits for the recorded commands and returns one dict per command, with
+    # its times in nanoseconds since the first command was queued
+    def records(self):
+        if not self.entries:
+            return []
+        cl.wait_for_events([event for name, category, event, nbytes in self.entries])
+        records = []
+        for name, category, event, nbytes in self.entries:
+            records.append({'name': name, 'category': category, 'bytes': nbytes,
+                            'queued': event.profile.queued, 'submit': event.profile.submit,
+                            'start': event.profile.start, 'end': event.profile.end})
+
+        origin = min(record['queued'] for record in records)
+        for record in records:
+            for stamp in ['queued', 'submit', 'start', 'end']:
+                record[stamp] -= origin
+            duration = record['end'] - record['start']
+            record['duration_s'] = duration * 1e-9
+            # Bytes per nanosecond are gigabytes per second
+            record['bandwidth_gb_s'] = float(nbytes) / duration if nbytes and duration > 0 else None
+        return records
+
+    # Prints the times of every command, then the total per category
+    def print_report(self):
+        records = self.records()
+        print('%-24s %-8s %10s %10s %10s %10s %10s %9s' % ('Command', 'Type', 'Queued us', 'Submit us',
+                                                         'Start us', 'End us', 'Bytes', 'GB/s'))
+        for record in records:
+            bandwidth = record['bandwidth_gb_s']
+            print('%-24s %-8s %10.1f %10.1f %10.1f %10.1f %10d %9s' % (
+                record['name'], record['category'],
+                record['queued'] / 1e3, record['submit'] / 1e3, record['start'] / 1e3, record['end'] / 1e3,
+                record['bytes'], '%.2f' % bandwidth if bandwidth is not None else '-'))
+
+        for category in ['upload', 'kernel', 'download']:
+            selected = [record for record in records if record['category'] == category]
+            if selected:
+                seconds = sum(record['duration_s'] for record in selected)
+                nbytes = sum(record['bytes'] for record in selected)
+                print('%s time was %s seconds for %s bytes' % (category.capitalize(), seconds, nbytes))
+        if records:
+            print('Device time from first enqueue to last completion was %s seconds' %
+                  (max(record['end'] for record in records) * 1e-9))
+
+    # Returns the recorded commands in the Chrome trace event format, one
+    # complete event per command on a row per category, with the queued
+    # and submit times, the bytes and the bandwidth as arguments
+    def chrome_trace(self):
+        rows = {'upload': 0, 'kernel': 1, 'download': 2}
+        trace_events = []
+        for record in self.records():
+            # Chrome traces are in microseconds
+            trace_events.append({
+                'name': record['name'], 'cat': record['category'], 'ph': 'X',
+                'ts': record['start'] / 1e3, 'dur': (record['end'] - record['start']) / 1e3,
+                'pid': 0, 'tid': rows.get(record['category'], len(rows)),
+                'args': {'queued_us': record['queued'] / 1e3, 'submit_us': record['submit'] / 1e3,
+                         'bytes': record['bytes'], 'bandwidth_gb_s': record['bandwidth_gb_s']}})
+        for category, row in rows.items():
+            trace_events.append({'name': 'thread_name', 'ph': 'M', 'pid': 0, 'tid': row,
+                                 'args': {'name': category}})
+        return {'traceEvents': trace_events, 'displayTimeUnit': 'ns'}
+
+    # Writes chrome_trace() to a JSON file
+    def save_chrome_trace(self, path):
+        with open(path, 'w') as trace_file:
+            json.dump(self.chrome_trace(), trace_file, indent=1)
@@ -0,0 +1,279 @@
+import pyopencl as cl
+import collections
+import hashlib
+import os.path
+from TiltShiftTuner import LocalSizeTuner, DEFAULT_TUNING_PATH
+
+# A reusable OpenCL session for running the Tilt-Shift kernels on many
+# images.  Setting up OpenCL (finding a device, creating a context and a
+# queue, building the program from source and allocating buffers) costs
+# far more than running the kernel on a single image, so the session
+# does all of this once and keeps the results around:
+#  - the context and a profiling-enabled queue on one device
+#  - built programs, in memory and as binaries in an on-disk cache keyed
+#    by the hash of the source and headers, the build options and the device
+#  - a pool of device buffers (and images) keyed by size, so images of the
+#    same size reuse the buffers of the previous image.  The pool holds at
+#    most pool_budget bytes, freeing the least recently used sizes first
+#  - an optional TiltShiftProfiler that the events of its commands are
+#    recorded in (see TiltShiftProfiler.py)
+#  - the local sizes tuned for the device (see TiltShiftTuner.py)
+
+# The directory holding the .cl files, used to find kernels and includes
+# no matter which directory the session is created from
+KERNEL_DIR = os.path.dirname(os.path.realpath(__file__))
+
+# Where compiled program binaries are kept between runs
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'tiltshift')
+
+# The device types a device spec can name
+DEVICE_TYPES = {'gpu': cl.device_type.GPU, 'cpu': cl.device_type.CPU,
+                'accelerator': cl.device_type.ACCELERATOR}
+
+# The share of the device's memory the buffer pool may hold on to when no
+# pool_budget is given
+DEFAULT_POOL_SHARE = 0.25
+
+# The environment variable the scripts read a device spec from
+DEVICE_ENV = 'TILTSHIFT_DEVICE'
+
+# Returns every device of every platform, in the order the platforms list them
+def all_devices():
+    return [device for platform in cl.get_platforms()
+            for device in platform.get_devices()]
+
+# Returns the devices a spec selects, out of all_devices():
+#  - None or 'all': every device
+#  - an index such as 2 or '2': that device in all_devices()
+#  - 'gpu', 'cpu' or 'accelerator': every device of that type,
+#    and 'gpu:1' the second one of them
+#  - anything else: every device whose name contains it, ignoring case
+def select_devices(spec=None):
+    devices = all_devices()
+    if spec is None or spec == 'all':
+        return devices
+    spec = str(spec).strip()
+    if spec.isdigit():
+        index = int(spec)
+        if index >= len(devices):
+            raise ValueError('There is no device %s, only %s devices' % (index, len(devices)))
+        return [devices[index]]
+    kind, _, index = spec.lower().partition(':')
+    if kind in DEVICE_TYPES:
+        selected = [device for device in devices if device.type & DEVICE_TYPES[kind]]
+        if index:
+            selected = selected[int(index):int(index) + 1]
+    else:
+        selected = [device for device in devices if spec.lower() in device.name.lower()]
+    if not selected:
+        raise ValueError('No OpenCL device matches %r (found: %s)'
+                         % (spec, ', '.join(device.name for device in devices)))
+    return selected
+
+# Picks the device the scripts use when none is given: the first one the
+# TILTSHIFT_DEVICE spec selects if it is set, otherwise the first GPU if
+# there is one, otherwise the first device of the first platform
+def default_device():
+    if os.environ.get(DEVICE_ENV):
+        return select_devices(os.environ[DEVICE_ENV])[0]
+    devices = all_devices()
+    for device in devices:
+        if device.type & cl.device_type.GPU:
+            return device
+    return devices[0]
+
+# Splits a device into count sub-devices with equal shares of its compute
+# units, such as the cores of a pocl CPU device, so that the multi-device
+# mode (see TiltShiftMultiDevice.py) can be run on a single CPU
+def sub_devices(device, count):
+    units = device.max_compute_units // count
+    if units < 1:
+        raise ValueError('%s has %s compute units, too few for %s sub-devices'
+                         % (device.name, device.max_compute_units, count))
+    return device.create_sub_devices(
+        [cl.device_partition_property.EQUALLY, units])[:count]
+
+# Returns the bytes a free buffer or image under a buffer pool key takes up
+def pooled_bytes(key):
+    if key[0] == 'image':
+        return 4 * key[1] * key[2]
+    return key[0]
+
+class TiltShiftSession(object):
+
+    def __init__(self, device=None, cache_dir=DEFAULT_CACHE_DIR, profiler=None,
+                 tuning_path=DEFAULT_TUNING_PATH, auto_tune=False, pool_budget=None):
+        if device is None:
+            device = default_device()
+        self.device = device
+        self.context = cl.Context([device])
+        # Turn on profiling to allow us to check event times.
+        self.queue = cl.CommandQueue(self.context, device,
+                                     properties=cl.command_queue_properties.PROFILING_ENABLE)
+        # cache_dir=None turns off the on-disk program cache
+        self.cache_dir = cache_dir
+        self.profiler = profiler
+        # tuning_path=None keeps tuned local sizes for this session only
+        self.tuner = LocalSizeTuner(tuning_path, auto_tune)
+
+        # Built programs and their kernels, keyed by (filename, options)
+        self.programs = {}
+        self.kernels = {}
+        # Free buffers, keyed by (size in bytes, memory flags), with the
+        # least recently released size first
+        self.buffer_pool = collections.OrderedDict()
+        # The bytes held by the free buffers, and the most it may hold
+        self.pool_bytes = 0
+        if pool_budget is None:
+            pool_budget = int(DEFAULT_POOL_SHARE * device.global_mem_size)
+        self.pool_budget = pool_budget
+
+    # Returns the cache key for a program: the hash of its source, the headers
+    # it can include, the build options and everything about the device that
+    # affects the binary
+    def program_key(self, source, options):
+        headers = [open(os.path.join(KERNEL_DIR, name)).read()
+                   for name in sorted(os.listdir(KERNEL_DIR)) if name.endswith('.h')]
+        key = hashlib.sha1()
+        for part in [source] + headers + [' '.join(options),
+                     self.device.name, self.device.platform.name,
+                     self.device.version, self.device.driver_version]:
+            key.update(part.encode('utf-8'))
+            key.update(b'\0')
+        return key.hexdigest()
+
+    # Returns the built program for a .cl file in the OpenCL directory.
+    # The program is only built once per session, and the binary is loaded
+    # from the on-disk cache when this device has built the same source before.
+    def program(self, filename, options=()):
+        options = ['-I', KERNEL_DIR] + list(options)
+        name = (filename, tuple(options))
+        if name in self.programs:
+            return self.programs[name]
+
+        source = open(os.path.join(KERNEL_DIR, filename)).read()
+        program = None
+        cache_path = None
+        if self.cache_dir is not None:
+            cache_path = os.path.join(self.cache_dir, self.program_key(source, options) + '.bin')
+            if os.path.exists(cache_path):
+                binary = open(cache_path, 'rb').read()
+                try:
+                    program = cl.Program(self.context, [self.device], [binary]).build(options=options)
+                except cl.Error:
+                    # A stale or corrupt binary, so rebuild it from source
+                    program = None
+
+        if program is None:
+            program = cl.Program(self.context, source).build(options=options)
+            if cache_path is not None:
+                self.save_binary(program, cache_path)
+
+        self.programs[name] = program
+        return program
+
+    # Writes the binary of a built program to the cache, through a temporary
+    # file so that a concurrent reader never sees a partially written binary
+    def save_binary(self, program, cache_path):
+        binary = program.get_info(cl.program_info.BINARIES)[0]
+        if not binary:
+            return
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        tmp_path = '%s.%s.tmp' % (cache_path, os.getpid())
+        with open(tmp_path, 'wb') as cache_file:
+            cache_file.write(binary)
+        os.rename(tmp_path, cache_path)
+
+    # Returns a kernel from a program, retrieving it only once per session
+    def kernel(self, filename, kernel_name, options=()):
+        name = (filename, tuple(options), kernel_name)
+        if name not in self.kernels:
+            self.kernels[name] = getattr(self.program(filename, options), kernel_name)
+        return self.kernels[name]
+
+    # Records the event of a command in the profiler, if the session has one,
+    # and returns the event
+    def record(self, event, name, category='kernel', nbytes=0):
+        if self.profiler is not None:
+            self.profiler.record(event, name, category, nbytes)
+        return event
+
+    # Returns a device buffer of nbytes bytes, reusing a free one from the
+    # pool when there is one of the same size and flags
+    def get_buffer(self, nbytes, flags=cl.mem_flags.READ_WRITE):
+        buffer = self.take_pooled((nbytes, flags))
+        if buffer is not None:
+            return buffer
+        return self.allocate(lambda: cl.Buffer(self.context, flags, nbytes))
+
+    # Returns a buffer from get_buffer() to the pool so a later image can use it
+    def release_buffer(self, buffer):
+        self.pool((buffer.size, buffer.flags), buffer)
+
+    # Returns a width x height RGBA8 device image, reusing a free one from the
+    # pool when there is one of the same size and flags (see TiltShiftColorImage.py)
+    def get_image(self, width, height, flags=cl.mem_flags.READ_WRITE):
+        image = self.take_pooled(('image', width, height, flags))
+        if image is not None:
+            return image
+        return self.allocate(lambda: cl.Image(
+            self.context, flags,
+            cl.ImageFormat(cl.channel_order.RGBA, cl.channel_type.UNORM_INT8),
+            shape=(width, height)))
+
+    # Returns an image from get_image() to the pool so a later image can use it
+    def release_image(self, image):
+        self.pool(('image', image.width, image.height, image.flags), image)
+
+    # Takes a free buffer or image out of the pool, or returns None if there
+    # is none under key
+    def take_pooled(self, key):
+        free_buffers = self.buffer_pool.get(key)
+        if not free_buffers:
+            return None
+        buffer = free_buffers.pop()
+        if not free_buffers:
+            del self.buffer_pool[key]
+        self.pool_bytes -= pooled_bytes(key)
+        return buffer
+
+    # Puts a free buffer or image in the pool as the most recently used,
+    # then frees the least recently used ones until the pool is back
+    # within its budget
+    def pool(self, key, buffer):
+        free_buffers = self.buffer_pool.pop(key, [])
+        free_buffers.append(buffer)
+        self.buffer_pool[key] = free_buffers
+        self.pool_bytes += pooled_bytes(key)
+        while self.pool_bytes > self.pool_budget and self.buffer_pool:
+            self.evict()
+
+    # Frees the oldest buffer or image of the least recently used size in the pool
+    def evict(self):
+        key, free_buffers = next(iter(self.buffer_pool.items()))
+        buffer = free_buffers.pop(0)
+        if not free_buffers:
+            del self.buffer_pool[key]
+        self.pool_bytes -= pooled_bytes(key)
+        buffer.release()
+
+    # Allocates a buffer or image with create(), freeing the pool and trying
+    # again if the device is out of memory, since the free buffers of other
+    # sizes may be what is taking it up
+    def allocate(self, create):
+        try:
+            return create()
+        except cl.MemoryError:
+            if not self.buffer_pool:
+                raise
+            self.clear_buffer_pool()
+            return create()
+
+    # Frees every buffer and image in the pool
+    def clear_buffer_pool(self):
+        for free_buffers in self.buffer_pool.values():
+            for buffer in free_buffers:
+                buffer.release()
+        self.buffer_pool = collections.OrderedDict()
+        self.pool_bytes = 0
@@ -0,0 +1,173 @@
+import pyopencl as cl
+import numpy as np
+import sys
+import time
+from TiltShiftSession import TiltShiftSession
+from TiltShiftColorOptimized import run_passes
+from TiltShiftColorBaselineBlurMask import run_mask_passes
+from TiltShiftMasks import focus_params, translate_focus, open_depth_map, DepthBlurMask
+from TiltShiftPixels import as_packed
+from TiltShiftImageIO import open_image, create_image
+
+# Out-of-core processing for the Tilt-Shift effect.
+# Gigapixel images do not fit in device memory, and often not in host
+# memory either, so instead of loading the whole image this reads it
+# from a memory-mapped file one horizontal band at a time and writes
+# each filtered band straight into a memory-mapped output file.
+# Every pass of the 3x3 blur reads one row above and below, so each band
+# is uploaded with num_passes halo rows on either side (where the image
+# has them).  The halo rows come out wrong, since the kernels clamp at
+# the edge of the band, but the rows of the band itself come out exactly
+# as if the whole image had been blurred at once.  Only the band rows are
+# downloaded, so memory use depends on the band size, not the image size.
+# Images are (h, w, 4) RGBA uint8 arrays, stored either as .npy files or
+# as raw RGBA bytes with the size given separately (see open_image() and
+# create_image() in TiltShiftImageIO.py).
+# With a depth map (see DepthBlurMask in TiltShiftMasks.py) the blur mask
+# is streamed the same way: the depths of each band and its halo are
+# converted to alpha bytes as the band is uploaded, and the band is
+# blurred by the BaselineBlurMask kernel, which reads them from there.
+
+# Device memory allowed for one band and its halo, in each of the two buffers
+DEFAULT_MAX_BAND_BYTES = 64 * 1024 * 1024
+
+# Returns the number of rows in a band so that the band and its halo fit
+# in max_band_bytes, and in the largest buffer the device can allocate
+def band_height_for(session, width, num_passes, max_band_bytes=DEFAULT_MAX_BAND_BYTES):
+    max_bytes = min(max_band_bytes, session.device.max_mem_alloc_size)
+    rows = max_bytes // (4 * width) - 2 * num_passes
+    if rows < 1:
+        raise ValueError('A %s pixel wide row and its halo do not fit in %s bytes' % (width, max_bytes))
+    return rows
+
+# Yields (start, stop, halo_start, halo_stop) for the bands of an image:
+# the band rows [start, stop) and the rows [halo_start, halo_stop) that are
+# uploaded to blur them
+def bands(height, band_height, halo):
+    for start in range(0, height, band_height):
+        stop = min(start + band_height, height)
+        yield start, stop, max(start - halo, 0), min(stop + halo, height)
+
+# Applies the tilt-shift effect to an (h, w, 4) RGBA image one band at a
+# time, writing the result into rgba_filtered.  Both are usually memory
+# mapped (see open_image() and create_image()), but any contiguous RGBA
+# arrays work.  The band height is worked out from max_band_bytes unless
+# it is given.  focus is the focus shape from focus_params(), or None for
+# the horizontal band, and depth_mask a DepthBlurMask the blur amounts
+# come from instead of the focus shape.
+def tiltshift_tiled(session, rgba, rgba_filtered,
+                    num_passes=3, sat=0.0, con=0.0,
+                    middle_in_focus=600, in_focus_radius=50,
+                    local_size=None, fused=True,
+                    band_height=None, max_band_bytes=DEFAULT_MAX_BAND_BYTES, focus=None,
+                    depth_mask=None):
+    if focus is None:
+        focus = focus_params('horizontal', None, middle_in_focus, in_focus_radius)
+    height, width = rgba.shape[:2]
+    if rgba_filtered.shape != rgba.shape:
+        raise ValueError('The output is %s but the image is %s' % (rgba_filtered.shape, rgba.shape))
+    if depth_mask is not None and depth_mask.shape != (height, width):
+        raise ValueError('The depth map is %s but the image is %s x %s' % (depth_mask.shape, height, width))
+    if band_height is None:
+        band_height = band_height_for(session, width, num_passes, max_band_bytes)
+    row_bytes = 4 * width
+
+    for start, stop, halo_start, halo_stop in bands(height, band_height, num_passes):
+        # Whole rows of a C-contiguous image are contiguous, so the band and
+        # its halo can be uploaded straight from the memory map
+        if depth_mask is None:
+            band_combined = as_packed(np.ascontiguousarray(rgba[halo_start:halo_stop]))
+        else:
+            # The kernel reads the blur amount from the alpha byte, so the band
+            # is copied to write the depth map's blur amounts for its rows there
+            band_rgba = np.array(rgba[halo_start:halo_stop])
+            band_rgba[..., 3] = depth_mask.alpha_rows(halo_start, halo_stop)
+            band_combined = as_packed(band_rgba)
+        gpu_image_a = session.get_buffer(band_combined.nbytes)
+        gpu_image_b = session.get_buffer(band_combined.nbytes)
+        session.record(cl.enqueue_copy(session.queue, gpu_image_a, band_combined, is_blocking=False),
+                       'upload rows %s-%s' % (halo_start, halo_stop), 'upload', band_combined.nbytes)
+
+        if depth_mask is not None:
+            gpu_image_a, gpu_image_b = run_mask_passes(session, gpu_image_a, gpu_image_b,
+                                                       width, halo_stop - halo_start,
+                                                       num_passes, sat, con, local_size)
+        else:
+            # The kernels only see the band, so the focus shape moves up with it
+            gpu_image_a, gpu_image_b = run_passes(session, gpu_image_a, gpu_image_b,
+                                                  width, halo_stop - halo_start,
+                                                  num_passes, sat, con, None, None,
+                                                  local_size, fused, rgba=True,
+                                                  focus=translate_focus(focus, 0, -halo_start))
+
+        # Download the band rows, leaving the halo rows behind
+        event = cl.enqueue_copy(session.queue, as_packed(rgba_filtered[start:stop]), gpu_image_a,
+                                src_offset=(start - halo_start) * row_bytes, is_blocking=True)
+        session.record(event, 'download rows %s-%s' % (start, stop), 'download', (stop - start) * row_bytes)
+        if depth_mask is not None:
+            # Put back the alpha channel the blur mask was written over
+            rgba_filtered[start:stop, :, 3] = rgba[start:stop, :, 3]
+        session.release_buffer(gpu_image_a)
+        session.release_buffer(gpu_image_b)
+
+    if isinstance(rgba_filtered, np.memmap):
+        rgba_filtered.flush()
+    return rgba_filtered
+
+# Run the Tilt-Shift effect on an image too large to load, stored as .npy or raw RGBA:
+#   python TiltShiftTiled.py panorama.npy panorama_TiltShift.npy
+#   python TiltShiftTiled.py panorama.rgba panorama_TiltShift.rgba 60000 20000
+if __name__ == '__main__':
+    if len(sys.argv) not in (3, 5):
+        print("Usage: python TiltShiftTiled.py <input .npy or raw> <output .npy or raw> [<width> <height>]")
+        sys.exit(1)
+
+    ################################
+    ### USER CHANGEABLE SETTINGS ###
+    ################################
+    # Number of Passes - 3 passes approximates Gaussian Blur
+    num_passes = 3
+    # Saturation - Between 0 and 1
+    sat = 0.0
+    # Contrast - Between -255 and 255
+    con = 0.0
+    # The y-index of the center of the in-focus region
+    middle_in_focus = 600
+    # The number of pixels to either side of the middle_in_focus to keep in focus
+    in_focus_radius = 50
+    # Device memory for each band buffer, which bounds the band height
+    max_band_bytes = DEFAULT_MAX_BAND_BYTES
+    # A depth map (.npy, 16-bit .png or raw uint16 the size of the image) to
+    # take the blur from instead of the in-focus band, or None
+    depth_map_path = None
+    # The depth of the focal plane, in the units of the depth map
+    focal_depth = 32768
+    # How far from the focal plane the depths stay in focus, fading to full blur
+    in_focus_depth = 4096
+    ####################################
+    ### END USER CHANGEABLE SETTINGS ###
+    ####################################
+
+    if len(sys.argv) == 5:
+        rgba = open_image(sys.argv[1], int(sys.argv[3]), int(sys.argv[4]))
+    else:
+        rgba = open_image(sys.argv[1])
+    height, width = rgba.shape[:2]
+    rgba_filtered = create_image(sys.argv[2], width, height)
+    depth_mask = None
+    if depth_map_path is not None:
+        depth_mask = DepthBlurMask(open_depth_map(depth_map_path, width, height),
+                                   focal_depth, in_focus_depth)
+
+    start_time = time.time()
+    session = TiltShiftSession()
+    print("The queue is using the device: %s" % session.queue.device.name)
+    band_height = band_height_for(session, width, num_passes, max_band_bytes)
+    print("Image Width %s, Height %s, in bands of %s rows" % (width, height, band_height))
+    tiltshift_tiled(session, rgba, rgba_filtered,
+                    num_passes, sat, con,
+                    middle_in_focus, in_focus_radius,
+                    band_height=band_height, depth_mask=depth_mask)
+    end_time = time.time()
+    print("Took %s seconds (%s megapixels per second)" %
+          (end_time - start_time, width * height / 1e6 / max(end_time - start_time, 1e-9)))
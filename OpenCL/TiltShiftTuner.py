@@ -0,0 +1,209 @@
+import pyopencl as cl
+import json
+import os.path
+import sys
+import numpy as np
+
+# Picks the local work-group size of the Optimized kernels for a device.
+# The best shape depends on the device (its SIMD width, how many work
+# items a group can hold, how much local memory it has) as well as on the
+# image width, so a shape that is fast on one GPU is slow or illegal on
+# another.  The tuner sweeps every legal shape, times each one with the
+# kernel events, and keeps the fastest in a JSON cache keyed by the
+# device, the image width, the number of passes and whether the passes are
+# fused, so later runs on the same device use it without tuning again.
+# Tune ahead of time for the widths you process with:
+#   python TiltShiftTuner.py 1920 3840
+
+# Where the tuned local sizes are kept between runs
+DEFAULT_TUNING_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'tiltshift', 'tuning.json')
+
+# The local size used when nothing has been tuned, if the device allows it
+DEFAULT_LOCAL_SIZE = (256, 2)
+
+# Returns the kernel run_passes() launches for these settings
+def pass_kernel(session, fused, rgba=True):
+    from TiltShiftPixels import RGBA_OPTIONS
+    return session.kernel('TiltShiftColorOptimized.cl', 'tiltshift_fused' if fused else 'tiltshift',
+                          RGBA_OPTIONS if rgba else ())
+
+# Returns the local memory, in bytes, a work group of local_size needs
+def local_memory_bytes(local_size, num_passes, fused):
+    if fused:
+        # Two 4-byte pixel buffers with a num_passes-pixel halo
+        return 2 * 4 * (local_size[0] + 2 * num_passes) * (local_size[1] + 2 * num_passes)
+    return 4 * (local_size[0] + 2) * (local_size[1] + 2)
+
+# Returns whether a work group of local_size loads its whole halo.  The
+# unfused kernel loads one column of the local buffer per work item, for
+# the first local_size[0] + 2 work items only, so a smaller group (every
+# (x, 1) shape, and (1, 2)) would blur with uninitialized halo columns.
+# The fused kernel strides its loads by the group size, so any shape works.
+def loads_halo(local_size, fused):
+    return fused or local_size[0] * local_size[1] >= local_size[0] + 2
+
+# Returns whether the device can launch the kernel with local_size, and
+# the kernel gives the right result with it
+def fits_device(session, local_size, num_passes, fused, rgba=True):
+    if not loads_halo(local_size, fused):
+        return False
+    device = session.device
+    max_group_size = pass_kernel(session, fused, rgba).get_work_group_info(
+        cl.kernel_work_group_info.WORK_GROUP_SIZE, device)
+    return (local_size[0] <= device.max_work_item_sizes[0] and
+            local_size[1] <= device.max_work_item_sizes[1] and
+            local_size[0] * local_size[1] <= max_group_size and
+            local_memory_bytes(local_size, num_passes, fused) <= device.local_mem_size)
+
+# Returns every power-of-two local size the device can launch the kernel
+# with, no wider than the image needs
+def legal_local_sizes(session, width, num_passes, fused, rgba=True):
+    device = session.device
+    widths = [2 ** i for i in range(16) if 2 ** i <= device.max_work_item_sizes[0]]
+    heights = [2 ** i for i in range(16) if 2 ** i <= device.max_work_item_sizes[1]]
+    # A group much wider than the image is mostly idle work items
+    widths = [x for x in widths if x < 2 * width]
+    return [(x, y) for x in widths for y in heights
+            if fits_device(session, (x, y), num_passes, fused, rgba)]
+
+# Returns DEFAULT_LOCAL_SIZE, halved along x and then y until the device can launch it
+def fit_local_size(session, num_passes, fused, rgba=True):
+    x, y = DEFAULT_LOCAL_SIZE
+    while not fits_device(session, (x, y), num_passes, fused, rgba):
+        if x > 1:
+            x //= 2
+        elif y > 1:
+            y //= 2
+        else:
+            raise ValueError('%s cannot run a single work item with %s passes (fused: %s)'
+                             % (session.device.name, num_passes, fused))
+    return x, y
+
+# Returns the seconds the device spends running num_passes passes on a
+# random width x height image with local_size, the best of repetitions runs
+def time_local_size(session, width, height, num_passes, fused, local_size, repetitions=3):
+    from TiltShiftColorOptimized import run_passes
+    from TiltShiftProfiler import TiltShiftProfiler
+    image_combined = np.random.RandomState(0).randint(0, 2 ** 32, (height, width), dtype=np.uint64).astype(np.uint32)
+    gpu_image_a = session.get_buffer(image_combined.nbytes)
+    gpu_image_b = session.get_buffer(image_combined.nbytes)
+    cl.enqueue_copy(session.queue, gpu_image_a, image_combined, is_blocking=True)
+
+    # Only the kernels of the runs are timed, in a profiler of their own
+    profiler = session.profiler
+    times = []
+    try:
+        for i in range(repetitions):
+            session.profiler = TiltShiftProfiler()
+            run_passes(session, gpu_image_a, gpu_image_b, width, height,
+                       num_passes, 0.0, 0.0, height // 2, height // 4,
+                       local_size, fused, rgba=True)
+            times.append(sum(record['duration_s'] for record in session.profiler.records()
+                             if record['category'] == 'kernel'))
+    finally:
+        session.profiler = profiler
+        session.release_buffer(gpu_image_a)
+        session.release_buffer(gpu_image_b)
+    return min(times)
+
+class LocalSizeTuner(object):
+
+    # path=None keeps the tuned sizes in memory only.  With auto_tune, a
+    # local size that has not been tuned yet is tuned the first time it is
+    # asked for, otherwise DEFAULT_LOCAL_SIZE (shrunk to fit) is used.
+    def __init__(self, path=DEFAULT_TUNING_PATH, auto_tune=False):
+        self.path = path
+        self.auto_tune = auto_tune
+        self.entries = {}
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path) as tuning_file:
+                    self.entries = json.load(tuning_file)
+            except ValueError:
+                # A corrupt cache, so start again
+                self.entries = {}
+
+    # Returns the cache key for a device and the settings the local size depends on
+    def key(self, device, width, num_passes, fused):
+        return '%s|%s|%s|width=%s|passes=%s|fused=%s' % (
+            device.platform.name, device.name, device.driver_version,
+            int(width), int(num_passes), int(bool(fused)))
+
+    # Returns the tuned local size, or None if it has not been tuned.  Sizes
+    # cached before the unfused kernel's halo limit was checked are ignored.
+    def lookup(self, device, width, num_passes, fused):
+        entry = self.entries.get(self.key(device, width, num_passes, fused))
+        if entry is None or not loads_halo(entry['local_size'], fused):
+            return None
+        return tuple(entry['local_size'])
+
+    # Times every legal local size on a random image of this width and
+    # tune_height rows, stores the fastest and returns it along with the
+    # times of all of them, as {local size: seconds}
+    def tune(self, session, width, num_passes, fused, tune_height=256, repetitions=3):
+        local_sizes = legal_local_sizes(session, width, num_passes, fused)
+        if not local_sizes:
+            raise ValueError('%s has no local size that fits %s passes (fused: %s)'
+                             % (session.device.name, num_passes, fused))
+        times = {}
+        for local_size in local_sizes:
+            times[local_size] = time_local_size(session, width, tune_height, num_passes, fused,
+                                                local_size, repetitions)
+        best = min(times, key=times.get)
+        self.entries[self.key(session.device, width, num_passes, fused)] = {
+            'local_size': list(best), 'seconds': times[best]}
+        self.save()
+        return best, times
+
+    # Writes the cache through a temporary file, like the program binaries,
+    # so that a concurrent reader never sees a partially written cache
+    def save(self):
+        if self.path is None:
+            return
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        tmp_path = '%s.%s.tmp' % (self.path, os.getpid())
+        with open(tmp_path, 'w') as tuning_file:
+            json.dump(self.entries, tuning_file, indent=1, sort_keys=True)
+        os.rename(tmp_path, self.path)
+
+    # Returns the local size to run with: the tuned one if there is one,
+    # else a freshly tuned one with auto_tune, else the default that fits
+    def local_size(self, session, width, num_passes, fused, rgba=True):
+        local_size = self.lookup(session.device, width, num_passes, fused)
+        if local_size is None and self.auto_tune:
+            local_size = self.tune(session, width, num_passes, fused)[0]
+        if local_size is None:
+            local_size = fit_local_size(session, num_passes, fused, rgba)
+        return local_size
+
+# Tune the local sizes of the session's device for some image widths:
+#   python TiltShiftTuner.py <width> [<width> ...]
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print("Usage: python TiltShiftTuner.py <width> [<width> ...]")
+        sys.exit(1)
+
+    ################################
+    ### USER CHANGEABLE SETTINGS ###
+    ################################
+    # The numbers of passes to tune for
+    passes = [3]
+    # Tune the fused kernel, the per-pass kernel, or both
+    fused_modes = [True, False]
+    ####################################
+    ### END USER CHANGEABLE SETTINGS ###
+    ####################################
+
+    from TiltShiftSession import TiltShiftSession
+    session = TiltShiftSession()
+    print("Tuning on the device: %s" % session.device.name)
+    for width in [int(arg) for arg in sys.argv[1:]]:
+        for num_passes in passes:
+            for fused in fused_modes:
+                best, times = session.tuner.tune(session, width, num_passes, fused)
+                print("Width %s, %s passes, fused %s: %s tried, best %s at %.6f seconds (default %s)"
+                      % (width, num_passes, fused, len(times), best, times[best],
+                         fit_local_size(session, num_passes, fused)))
+    print("Saved to %s" % session.tuner.path)
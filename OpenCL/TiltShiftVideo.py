@@ -0,0 +1,203 @@
+import pyopencl as cl
+import numpy as np
+import os.path
+import sys
+import time
+from TiltShiftSession import TiltShiftSession
+from TiltShiftColorOptimized import run_passes
+from TiltShiftPixels import to_rgba, as_packed, empty_rgba
+from TiltShiftBatch import find_images
+from TiltShiftImageIO import load_rgba, save_rgba
+
+# Streaming video for the Tilt-Shift effect.
+# Frames come from image files or from raw frames piped on stdin (for
+# example from ffmpeg -f rawvideo -pix_fmt rgba), and go to image files
+# or back out on stdout as raw frames.  One session, program and set of
+# device buffers is used for the whole stream, and frames are double
+# buffered: while the kernel runs on one frame, the next frame is
+# uploaded on a second queue and the previous one is downloaded on a
+# third, with events keeping each frame's steps in order.
+# The in-focus band can move during the video: it is linearly
+# interpolated between keyframes of (frame, middle_in_focus, in_focus_radius).
+
+# Number of frames in flight at once, one uploading while another is blurred
+NUM_SLOTS = 2
+
+# Returns the in-focus middle and radius for a frame, interpolated linearly
+# between the keyframes and held before the first and after the last one
+def interpolate_focus(keyframes, frame_index):
+    keyframes = sorted(keyframes)
+    frames = [keyframe[0] for keyframe in keyframes]
+    middle_in_focus = np.interp(frame_index, frames, [keyframe[1] for keyframe in keyframes])
+    in_focus_radius = np.interp(frame_index, frames, [keyframe[2] for keyframe in keyframes])
+    return int(round(middle_in_focus)), int(round(in_focus_radius))
+
+# Yields RGBA frames from image files
+def frames_from_files(paths):
+    for path in paths:
+        yield load_rgba(path)
+
+# Yields RGBA frames from raw (height, width, channels) uint8 frames on a
+# binary stream, reading each frame straight into its own array
+def frames_from_stream(stream, width, height, channels=4):
+    while True:
+        frame = np.empty((height, width, channels), dtype=np.uint8)
+        view = memoryview(frame.reshape(-1))
+        num_read = 0
+        while num_read < frame.nbytes:
+            count = stream.readinto(view[num_read:])
+            if not count:
+                break
+            num_read += count
+        if num_read == 0:
+            return
+        if num_read < frame.nbytes:
+            raise ValueError('The stream ended part way through a frame (%s of %s bytes)' % (num_read, frame.nbytes))
+        yield to_rgba(frame)
+
+# Returns a function that saves frames as numbered PNGs in output_dir
+def frames_to_files(output_dir):
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    def write_frame(frame_index, rgba):
+        save_rgba(os.path.join(output_dir, 'frame%06d.png' % frame_index), rgba)
+    return write_frame
+
+# Returns a function that writes frames to a binary stream as raw uint8 frames
+def frames_to_stream(stream, channels=4):
+    def write_frame(frame_index, rgba):
+        stream.write(np.ascontiguousarray(rgba[..., :channels]).tobytes())
+        stream.flush()
+    return write_frame
+
+# A frame on its way through the device: the host frames it is read from
+# and written to, its device buffers and the event of its download
+class FrameSlot(object):
+
+    def __init__(self):
+        self.frame_index = None
+        self.rgba = None
+        self.rgba_filtered = None
+        self.gpu_image_a = None
+        self.gpu_image_b = None
+        self.download_event = None
+
+# Applies the tilt-shift effect to every frame from frames and passes each
+# filtered frame to write_frame(frame_index, rgba) in order.
+# Returns the number of frames processed.
+def process_video(session, frames, write_frame, focus_keyframes,
+                  num_passes=3, sat=0.0, con=0.0,
+                  local_size=None, fused=True):
+    # The kernels run on the session queue, while transfers get queues of their own,
+    # with profiling turned on like the session queue so the profiler can time them
+    properties = cl.command_queue_properties.PROFILING_ENABLE
+    upload_queue = cl.CommandQueue(session.context, session.device, properties=properties)
+    download_queue = cl.CommandQueue(session.context, session.device, properties=properties)
+    slots = [FrameSlot() for i in range(NUM_SLOTS)]
+
+    # Waits for the frame in a slot to finish and writes it out
+    def finish(slot):
+        slot.download_event.wait()
+        write_frame(slot.frame_index, slot.rgba_filtered)
+        session.release_buffer(slot.gpu_image_a)
+        session.release_buffer(slot.gpu_image_b)
+        slot.frame_index = None
+
+    num_frames = 0
+    for frame_index, rgba in enumerate(frames):
+        slot = slots[frame_index % NUM_SLOTS]
+        if slot.frame_index is not None:
+            finish(slot)
+
+        image_combined = as_packed(rgba)
+        height, width = image_combined.shape
+        middle_in_focus, in_focus_radius = interpolate_focus(focus_keyframes, frame_index)
+
+        # The buffers come from the session pool, so after the first frames
+        # every frame reuses the buffers of the frame two before it
+        slot.frame_index = frame_index
+        slot.rgba = rgba
+        slot.gpu_image_a = session.get_buffer(image_combined.nbytes)
+        slot.gpu_image_b = session.get_buffer(image_combined.nbytes)
+        upload_event = cl.enqueue_copy(upload_queue, slot.gpu_image_a, image_combined, is_blocking=False)
+        session.record(upload_event, 'upload frame %s' % frame_index, 'upload', image_combined.nbytes)
+
+        # The passes wait for this frame's upload, but not for anything on the other queues
+        cl.enqueue_barrier(session.queue, wait_for=[upload_event])
+        slot.gpu_image_a, slot.gpu_image_b = run_passes(session, slot.gpu_image_a, slot.gpu_image_b,
+                                                        width, height,
+                                                        num_passes, sat, con,
+                                                        middle_in_focus, in_focus_radius,
+                                                        local_size, fused, rgba=True)
+        kernel_event = cl.enqueue_marker(session.queue)
+
+        slot.rgba_filtered = empty_rgba(height, width)
+        slot.download_event = cl.enqueue_copy(download_queue, as_packed(slot.rgba_filtered), slot.gpu_image_a,
+                                              is_blocking=False, wait_for=[kernel_event])
+        session.record(slot.download_event, 'download frame %s' % frame_index, 'download',
+                       slot.rgba_filtered.nbytes)
+        # Start the queues now rather than when the next frame is read
+        upload_queue.flush()
+        session.queue.flush()
+        download_queue.flush()
+        num_frames += 1
+
+    # Write out the frames still in flight, oldest first
+    for slot in sorted(slots, key=lambda slot: slot.frame_index):
+        if slot.frame_index is not None:
+            finish(slot)
+    return num_frames
+
+# Run the Tilt-Shift effect on a video, as image files or raw frames:
+#   python TiltShiftVideo.py 'frames/*.png' output_directory
+#   ffmpeg -i in.mp4 -f rawvideo -pix_fmt rgba - |
+#       python TiltShiftVideo.py - - 1920 1080 |
+#       ffmpeg -f rawvideo -pix_fmt rgba -s 1920x1080 -i - out.mp4
+if __name__ == '__main__':
+    if len(sys.argv) not in (3, 5):
+        sys.stderr.write("Usage: python TiltShiftVideo.py <frames glob, directory or -> <output directory or -> [<width> <height>]\n")
+        sys.exit(1)
+
+    ################################
+    ### USER CHANGEABLE SETTINGS ###
+    ################################
+    # Number of Passes - 3 passes approximates Gaussian Blur
+    num_passes = 3
+    # Saturation - Between 0 and 1
+    sat = 0.0
+    # Contrast - Between -255 and 255
+    con = 0.0
+    # Keyframes of (frame, middle_in_focus, in_focus_radius). The in-focus band
+    # moves linearly between keyframes and holds before the first and after the last
+    focus_keyframes = [(0, 300, 50), (100, 600, 80)]
+    # Channels of the raw frames on stdin and stdout, 4 for RGBA or 3 for RGB
+    raw_channels = 4
+    ####################################
+    ### END USER CHANGEABLE SETTINGS ###
+    ####################################
+
+    # Raw frames need binary streams, which are sys.stdin.buffer on Python 3
+    stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+    stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+
+    if sys.argv[1] == '-':
+        if len(sys.argv) != 5:
+            sys.stderr.write("The width and height are needed to read raw frames from stdin\n")
+            sys.exit(1)
+        frames = frames_from_stream(stdin, int(sys.argv[3]), int(sys.argv[4]), raw_channels)
+    else:
+        frames = frames_from_files(find_images(sys.argv[1]))
+    if sys.argv[2] == '-':
+        write_frame = frames_to_stream(stdout, raw_channels)
+    else:
+        write_frame = frames_to_files(sys.argv[2])
+
+    session = TiltShiftSession()
+    sys.stderr.write("The queue is using the device: %s\n" % session.queue.device.name)
+    start_time = time.time()
+    num_frames = process_video(session, frames, write_frame, focus_keyframes,
+                               num_passes, sat, con)
+    end_time = time.time()
+    # Report on stderr, since stdout may be carrying frames
+    sys.stderr.write("Processed %s frames in %s seconds (%s frames per second)\n" %
+                     (num_frames, end_time - start_time, num_frames / max(end_time - start_time, 1e-9)))
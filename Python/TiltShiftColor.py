@@ -1,8 +1,5 @@
+from __future__ import print_function
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib.image as mpimg
-from skimage import color
-from cython.parallel import prange
 import time
 import math
 
@@ -156,6 +153,8 @@ def round_up(global_size, group_size):
 
 # Run a Python implementation of Tilt-Shift (grayscale)
 if __name__ == '__main__':
+    import matplotlib.pyplot as plt
+    import matplotlib.image as mpimg
     # Load the image and convert it to grayscale
     input_image = mpimg.imread('MITBoathouse.png',0)
     plt.imshow(input_image)    
@@ -193,19 +192,19 @@ if __name__ == '__main__':
     buf_height = local_size[1] + 2
     halo = 1
     
-    print "Image Width %s" % width
-    print "Image Height %s" % height
+    print("Image Width %s" % width)
+    print("Image Height %s" % height)
     
     # We will perform 3 passes of the bux blur 
     # effect to approximate Gaussian blurring
     for pass_num in range(num_passes):
-        print "In iteration %s of %s" % (pass_num + 1, num_passes)
+        print("In iteration %s of %s" % (pass_num + 1, num_passes))
         # We need to loop over the workgroups here, 
         # because unlike OpenCL, they are not 
         # automatically set up by Python
         last_pass = False
         if pass_num == num_passes - 1:
-            print "---Last Pass---"
+            print("---Last Pass---")
             last_pass = True
         
         # Loop over all groups and call tiltshift once per group
@@ -224,7 +223,7 @@ if __name__ == '__main__':
         # Now put the output of the last pass into the input of the next pass
         input_image = output_image
     end_time = time.time()
-    print "Took %s seconds to run %s passes" % (end_time - start_time, num_passes)   
+    print("Took %s seconds to run %s passes" % (end_time - start_time, num_passes))
     
     # Display the new image
     plt.imshow(input_image)    
@@ -1,11 +1,18 @@
+from __future__ import print_function
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib.image as mpimg
-from skimage import color
-from cython.parallel import prange
+import os.path
+import sys
 import time
 import math
 
+# The tone curve tables and blur masks are shared with the OpenCL version,
+# so that both grade colors with the same curve and blur the same pixels
+OPENCL_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'OpenCL')
+if OPENCL_DIR not in sys.path:
+    sys.path.append(OPENCL_DIR)
+from TiltShiftColorGrade import tone_curve_table
+from TiltShiftMasks import generate_horizontal_blur_mask, generate_circular_blur_mask
+
 # A basic, parallelized Python implementation of 
 # the Tilt-Shift effect we hope to achieve in OpenCL
 
@@ -138,6 +145,197 @@ def tiltshift(input_image, output_image, buf, blur_mask,
     # Return the output of the last pass
     return output_image
 
+# Returns the (dy, dx) neighbour of every pixel as a view into padded,
+# an image that has already been padded by one pixel on every side.
+# The result lines up with the unpadded (h, w) image.
+def shifted_view(padded, dy, dx, w, h):
+    return padded[1 + dy:1 + dy + h, 1 + dx:1 + dx + w]
+
+# A vectorized version of tiltshift() that handles the whole image in
+# one call instead of one work group at a time.  The 3x3 neighbourhood
+# of every pixel is read through shifted views of an edge-clamped copy
+# of the image, so no Python code runs per pixel.
+# The arithmetic is done in float64 and in the same order as boxblur(),
+# saturation() and contrast(), so the result is bit-identical to the
+# reference engine.  tone_curve is an optional tone curve applied after
+# the saturation and contrast in the last pass (see color_grade_lut()).
+def tiltshift_vectorized(input_image, output_image, blur_mask,
+                         w, h,
+                         sat, con, last_pass, tone_curve=None):
+    # Pad by one pixel on each side by repeating the edge, which is what
+    # the halo load in tiltshift() does with its tmp_x/tmp_y clamping
+    padded = np.pad(input_image[:h, :w, :3].astype(np.float64),
+                    ((1, 1), (1, 1), (0, 0)), mode='edge')
+    blurred = boxblur_padded(padded, blur_mask[:h, :w], w, h)
+
+    # If we're in the last pass, perform the saturation and contrast adjustments as well
+    if last_pass:
+        blurred = color_grade(blurred, sat, con, tone_curve)
+    output_image[:h, :w, :3] = blurred
+
+    # Return the output of the last pass
+    return output_image
+
+# The 3x3 blur of tiltshift_vectorized() on its own: blurs the (h, w)
+# pixels in the middle of padded, an (h + 2, w + 2, 3) float64 image that
+# holds their one pixel halo, and returns them as float64 with the
+# fractional part dropped.  blur_mask holds the blur amount of the (h, w)
+# pixels.  Anything that fills the halo the same way (see
+# TiltShiftMultiprocess.py, which blurs one tile at a time) gets the same result.
+def boxblur_padded(padded, blur_mask, w, h):
+    p0 = shifted_view(padded, -1, -1, w, h)
+    p1 = shifted_view(padded, -1, 0, w, h)
+    p2 = shifted_view(padded, -1, 1, w, h)
+    p3 = shifted_view(padded, 0, -1, w, h)
+    p4 = shifted_view(padded, 0, 0, w, h)
+    p5 = shifted_view(padded, 0, 1, w, h)
+    p6 = shifted_view(padded, 1, -1, w, h)
+    p7 = shifted_view(padded, 1, 0, w, h)
+    p8 = shifted_view(padded, 1, 1, w, h)
+
+    # Calculate the blur amount for the central and neighboring
+    # pixels, with a trailing axis so it broadcasts over the colors
+    blur_amount = blur_mask[:h, :w, np.newaxis].astype(np.float64)
+    self_blur_amount = (9 - (blur_amount * 8)) / 9.0
+    other_blur_amount = blur_amount / 9.0
+
+    # Sum a weighted average of self and others based on the blur amount,
+    # then drop the fractional part like the int() calls in boxblur()
+    others = p0 + p1 + p2 + p3 + p5 + p6 + p7 + p8
+    return np.trunc((self_blur_amount * p4) + (other_blur_amount * others))
+
+# Applies saturation() and then contrast() to a whole (h, w, 3) float64
+# image of whole numbers from 0 to 255 at once, followed by tone_curve if
+# there is one.  The colors are looked up in color_grade_lut() rather
+# than worked out per pixel.
+def color_grade(image, sat, con, tone_curve=None):
+    lut = color_grade_lut(sat, con, tone_curve)
+    return lut[np.arange(3), image.astype(np.intp)]
+
+# Returns a (3, 256) float64 table of what saturation() and then
+# contrast() turn each 8-bit color into, one row per color, computed in
+# the same order of operations as the per-pixel versions.  With a
+# tone_curve, the results (truncated to whole numbers, like storing them
+# in the image does) are then looked up in the curve.
+def color_grade_lut(sat, con, tone_curve=None):
+    values = np.arange(256, dtype=np.float64) * (1 - sat)
+    factor = (259 * (con + 255)) / float(255 * (259 - con))
+    lut = np.tile(np.clip(factor * (values - 128) + 128, 0, 255), (3, 1))
+    if tone_curve is not None:
+        lut = tone_curve_table(tone_curve).astype(np.float64)[np.arange(3)[:, np.newaxis], lut.astype(np.intp)]
+    return lut
+
+# Returns the mean of the window [x - r, x + r] along the rows of an
+# (h, w, 3) image, where the integer radius r is given per pixel.
+# The window sums come from a running sum (prefix sum) along each row,
+# so each pixel costs two lookups no matter how large its radius is.
+# Pixels outside the image are clamped to the edge.
+def running_box_mean(image, radius, max_radius):
+    h, w = radius.shape
+    # Pad each row by max_radius so every window lies inside the padded row
+    padded = np.pad(image, ((0, 0), (max_radius, max_radius), (0, 0)), mode='edge')
+    # sums[:, i] holds the sum of the first i pixels of each padded row
+    sums = np.zeros((h, padded.shape[1] + 1, image.shape[2]))
+    np.cumsum(padded, axis=1, out=sums[:, 1:])
+
+    rows = np.arange(h)[:, np.newaxis]
+    cols = np.arange(w)[np.newaxis, :] + max_radius
+    window_sum = sums[rows, cols + radius + 1] - sums[rows, cols - radius]
+    return window_sum / (2 * radius + 1)[..., np.newaxis]
+
+# One horizontal box blur sweep where blur_mask picks the radius of each
+# pixel, from 0 (no blur) up to max_radius (full blur).  Fractional radii
+# are linearly interpolated between the two nearest integer boxes so the
+# blur fades in smoothly.
+def running_sum_sweep(image, blur_mask, max_radius):
+    radius = blur_mask * max_radius
+    r0 = np.floor(radius).astype(np.intp)
+    r1 = np.minimum(r0 + 1, max_radius)
+    t = (radius - r0)[..., np.newaxis]
+    return ((1 - t) * running_box_mean(image, r0, max_radius) +
+            t * running_box_mean(image, r1, max_radius))
+
+# Applies the tilt-shift effect with separable running-sum box blurs
+# instead of repeated 3x3 passes.  Each sweep is one horizontal and one
+# vertical blur whose cost per pixel does not depend on the radius, so
+# a stronger blur only needs a larger max_radius rather than more passes.
+# A few sweeps (3 by default) approximate a Gaussian blur.
+def tiltshift_running_sum(input_image, output_image, blur_mask,
+                          w, h,
+                          max_radius, num_sweeps,
+                          sat, con, tone_curve=None):
+    blur_mask = blur_mask[:h, :w]
+    blurred = input_image[:h, :w, :3].astype(np.float64)
+    for sweep in range(num_sweeps):
+        # Blur along the rows, then along the columns by sweeping the transposed image
+        blurred = running_sum_sweep(blurred, blur_mask, max_radius)
+        blurred = running_sum_sweep(blurred.swapaxes(0, 1), blur_mask.T, max_radius).swapaxes(0, 1)
+
+    # Drop the fractional part like the int() calls in boxblur(),
+    # then perform the saturation and contrast adjustments
+    output_image[:h, :w, :3] = color_grade(np.trunc(blurred), sat, con, tone_curve)
+    return output_image
+
+# Halves an (h, w, 3) image in each direction by averaging every 2x2
+# block of pixels.  An odd last row or column is averaged with itself,
+# like the edge clamping of the blur.
+def downsample_half(image):
+    h, w = image.shape[:2]
+    padded = np.pad(image, ((0, h % 2), (0, w % 2), (0, 0)), mode='edge')
+    return (padded[0::2, 0::2] + padded[0::2, 1::2] +
+            padded[1::2, 0::2] + padded[1::2, 1::2]) / 4.0
+
+# Returns the coordinates in a coarse axis of n_coarse pixels that the n
+# pixel centers of a fine axis map onto, for bilinear upsampling: the
+# pixels on either side of each center and the weight of the second one
+def upsample_coords(n, n_coarse):
+    position = np.clip((np.arange(n) + 0.5) * n_coarse / float(n) - 0.5, 0, n_coarse - 1)
+    i0 = np.floor(position).astype(np.intp)
+    i1 = np.minimum(i0 + 1, n_coarse - 1)
+    return i0, i1, position - i0
+
+# Scales a coarse (h', w', 3) image up to (h, w, 3) with bilinear interpolation
+def upsample_bilinear(coarse, h, w):
+    y0, y1, ty = upsample_coords(h, coarse.shape[0])
+    x0, x1, tx = upsample_coords(w, coarse.shape[1])
+    ty = ty[:, np.newaxis, np.newaxis]
+    tx = tx[np.newaxis, :, np.newaxis]
+    top = (1 - tx) * coarse[y0][:, x0] + tx * coarse[y0][:, x1]
+    bottom = (1 - tx) * coarse[y1][:, x0] + tx * coarse[y1][:, x1]
+    return (1 - ty) * top + ty * bottom
+
+# Applies the tilt-shift effect with a half-resolution pyramid instead of
+# full-resolution passes.  The image is halved levels times, the coarsest
+# level gets num_passes fully blurred 3x3 passes (each of which covers
+# 2 ** levels pixels of the original), and the result is scaled back up.
+# blur_mask then blends every pixel between the original and the blurred
+# image, so the in-focus band keeps its full detail while the blurry
+# regions cost a quarter of the work per level.
+def tiltshift_pyramid(input_image, output_image, blur_mask,
+                      w, h,
+                      num_passes, levels,
+                      sat, con, tone_curve=None):
+    original = input_image[:h, :w, :3].astype(np.float64)
+    coarse = original
+    for level in range(levels):
+        coarse = downsample_half(coarse)
+
+    # Every pixel of the coarse level is fully blurred
+    coarse_h, coarse_w = coarse.shape[:2]
+    full_blur = np.ones((coarse_h, coarse_w))
+    for pass_num in range(num_passes):
+        padded = np.pad(coarse, ((1, 1), (1, 1), (0, 0)), mode='edge')
+        coarse = boxblur_padded(padded, full_blur, coarse_w, coarse_h)
+
+    blurred = upsample_bilinear(coarse, h, w)
+    blur_amount = blur_mask[:h, :w, np.newaxis].astype(np.float64)
+    blended = (1 - blur_amount) * original + blur_amount * blurred
+
+    # Drop the fractional part like the int() calls in boxblur(),
+    # then perform the saturation and contrast adjustments
+    output_image[:h, :w, :3] = color_grade(np.trunc(blended), sat, con, tone_curve)
+    return output_image
+
 # Rounds up the size to a be multiple of the group_size
 def round_up(global_size, group_size):
     r = global_size % group_size
@@ -146,85 +344,10 @@ def round_up(global_size, group_size):
     return global_size + group_size - r
     
     
-# generates horizontal blur mask using focus middle, focus radius, and image height,
-# and stores the blur mask in the blur_mask parameter (np.array)
-def generate_horizontal_blur_mask(blur_mask, middle_in_focus, in_focus_radius, height):
-    # Calculate blur amount for each pixel based on middle_in_focus and in_focus_radius
-    
-    # Loop over y first so we can calculate the blur amount
-    # fade out 20% to blurry so that there is not an abrupt transition
-    no_blur_region = .8 * in_focus_radius
-    
-    # Set blur amount for focus middle
-    #blur_row = np.array([blur_mask])
-    blur_row = np.zeros_like(blur_mask[0], dtype=np.float)
-    blur_mask[middle_in_focus] = blur_row
-    # Simulataneously set blur amount for both rows of same distance from middle
-    for y in xrange(middle_in_focus - in_focus_radius, middle_in_focus):
-        # The blur amount depends on the y-value of the pixel
-        distance_to_m = abs(y - middle_in_focus)
-        # Note: Because we are iterating over all y's in the focus region, all the y's are within
-        # the focus radius.
-        # Thus, we need only check if we should fade to blurry so that there is not an abrupt transition
-        if distance_to_m > no_blur_region:
-            # Calculate blur ammount
-            blur_amount = (1.0 / (in_focus_radius - no_blur_region)) * (distance_to_m - no_blur_region) 
-        else:
-            # No blur
-            blur_amount = 0.0
-        blur_row.fill(blur_amount)
-        if y > 0:
-            blur_mask[y] = blur_row
-        if middle_in_focus + distance_to_m < height:
-            blur_mask[middle_in_focus + distance_to_m] = blur_row
-            
-# generates horizontal blur mask using focus middle, focus radius, and image height,
-# and stores the blur mask in the blur_mask parameter (np.array)            
-def generate_circular_blur_mask(blur_mask, middle_in_focus_x,middle_in_focus_y, in_focus_radius, width, height):
-    # Calculate blur amount for each pixel based on middle_in_focus and in_focus_radius
-    
-    
-    # fade out 20% to blurry so that there is not an abrupt transition
-    no_blur_region = .8 * in_focus_radius
-    
-    # Set blur amount (no blur) for center of in-focus region
-    blur_mask[middle_in_focus_y, middle_in_focus_x] = 0.0
-    
-    # Loop over x and y first so we can calculate the blur amount
-    for x in xrange(middle_in_focus_x - in_focus_radius, middle_in_focus_x):
-        for y in xrange(middle_in_focus_y - in_focus_radius, middle_in_focus_y):
-            
-            # The blur amount depends on the euclidean distance between the pixel and focus center
-            x_distance_to_m = x - middle_in_focus_x
-            y_distance_to_m = y - middle_in_focus_y
-            distance_to_m = (x_distance_to_m ** 2 + y_distance_to_m ** 2) ** 0.5
-            
-            # Note: Not all values we iterate over are within the focus region, so we must check
-            if distance_to_m < no_blur_region:
-                # No blur
-                blur_amount = 0.0
-            # Check if we should fade to blurry so that there is not an abrupt transition
-            elif distance_to_m < in_focus_radius:
-                blur_amount = (1.0 / (in_focus_radius - no_blur_region)) * (distance_to_m - no_blur_region)
-            else:
-                # Completely blurred
-                blur_amount = 1.0
-            
-            # Set the blur_amount for 4 pixels of the same distance from the center of the in-focus region
-            if x > 0:
-                if y > 0:
-                    blur_mask[y, x] = blur_amount
-                if middle_in_focus_y + y_distance_to_m < height:
-                    blur_mask[middle_in_focus_y + y_distance_to_m, x] = blur_amount
-            if middle_in_focus_x + x_distance_to_m < width:
-                if y > 0:
-                    blur_mask[y, middle_in_focus_x + x_distance_to_m] = blur_amount
-                if middle_in_focus_y + y_distance_to_m < height:
-                    blur_mask[middle_in_focus_y + y_distance_to_m, middle_in_focus_x + x_distance_to_m] = blur_amount
-            
-    
 # Run a Python implementation of Tilt-Shift (grayscale)
 if __name__ == '__main__':
+    import matplotlib.pyplot as plt
+    import matplotlib.image as mpimg
     # Load the image and convert it to grayscale
     input_image = mpimg.imread('../MITBoathouse.png',0)
     plt.imshow(input_image)    
@@ -251,6 +374,19 @@ if __name__ == '__main__':
     middle_in_focus_x = 650
     # The number of pixels distance from middle_in_focus to keep in focus
     in_focus_radius = 200
+    # 'vectorized' blurs the whole image at once with NumPy, 'reference'
+    # runs the per-work-group loop and is kept as an oracle to test against,
+    # 'running_sum' uses num_passes separable running-sum sweeps instead of 3x3 passes,
+    # 'pyramid' blurs a downsampled copy and blends it in with the blur mask
+    engine = 'vectorized'
+    # The blur radius used where blur_mask is 1.0 (running_sum engine only)
+    max_blur_radius = 8
+    # How many times the pyramid engine halves the image before blurring it
+    pyramid_levels = 2
+    # An optional tone curve applied after the saturation and contrast, as a list
+    # of (input, output) points such as [(0, 0), (64, 50), (192, 210), (255, 255)]
+    # (vectorized, running_sum and pyramid engines only)
+    tone_curve = None
     ######################################
     ### USER CHANGEABLE SETTINGS - END ###
     ######################################
@@ -270,8 +406,8 @@ if __name__ == '__main__':
     buf_height = local_size[1] + 2
     halo = 1
     
-    print "Image Width %s" % width
-    print "Image Height %s" % height
+    print("Image Width %s" % width)
+    print("Image Height %s" % height)
     
     
     # Initialize blur mask to be all 1's (completely blurry)
@@ -283,34 +419,59 @@ if __name__ == '__main__':
     else:
         generate_horizontal_blur_mask(blur_mask, middle_in_focus_y, in_focus_radius, height)
     
-    # We will perform 3 passes of the bux blur 
-    # effect to approximate Gaussian blurring
-    for pass_num in range(num_passes):
-        print "In iteration %s of %s" % (pass_num + 1, num_passes)
-        # We need to loop over the workgroups here, 
-        # because unlike OpenCL, they are not 
-        # automatically set up by Python
-        last_pass = False
-        if pass_num == num_passes - 1:
-            print "---Last Pass---"
-            last_pass = True
-        
-        # Loop over all groups and call tiltshift once per group
-        for group_corner_x in range(0, global_size[0], local_size[0]):
-            for group_corner_y in range(0, global_size[1], local_size[1]):
-                #print "GROUP CONRER %s %s" % (group_corner_x, group_corner_y)
-                # Run tilt shift over the group and store the results in host_image_tilt_shifted
-                tiltshift(input_image, output_image, local_memory, blur_mask,
-                          width, height, 
-                          buf_width, buf_height, halo, 
-                          local_size[0], local_size[1],
-                          sat, con, last_pass, 
-                          group_corner_x, group_corner_y)
-
-        # Now put the output of the last pass into the input of the next pass
+    if engine == 'running_sum':
+        # The running-sum blur does a fixed number of sweeps whatever the radius
+        print("Running %s running-sum sweeps with a maximum radius of %s" % (num_passes, max_blur_radius))
+        tiltshift_running_sum(input_image, output_image, blur_mask,
+                              width, height,
+                              max_blur_radius, num_passes,
+                              sat, con, tone_curve)
+        input_image = output_image
+    elif engine == 'pyramid':
+        # The passes run on the image downsampled pyramid_levels times
+        print("Running %s passes on the image downsampled %s times" % (num_passes, pyramid_levels))
+        tiltshift_pyramid(input_image, output_image, blur_mask,
+                          width, height,
+                          num_passes, pyramid_levels,
+                          sat, con, tone_curve)
         input_image = output_image
+    else:
+        # We will perform 3 passes of the bux blur 
+        # effect to approximate Gaussian blurring
+        for pass_num in range(num_passes):
+            print("In iteration %s of %s" % (pass_num + 1, num_passes))
+            # We need to loop over the workgroups here, 
+            # because unlike OpenCL, they are not 
+            # automatically set up by Python
+            last_pass = False
+            if pass_num == num_passes - 1:
+                print("---Last Pass---")
+                last_pass = True
+        
+            if engine == 'vectorized':
+                # Blur every pixel of the image in a single call
+                tiltshift_vectorized(input_image, output_image, blur_mask,
+                                     width, height,
+                                     sat, con, last_pass, tone_curve)
+            else:
+                # Loop over all groups and call tiltshift once per group
+                for group_corner_x in range(0, global_size[0], local_size[0]):
+                    for group_corner_y in range(0, global_size[1], local_size[1]):
+                        #print "GROUP CONRER %s %s" % (group_corner_x, group_corner_y)
+                        # Run tilt shift over the group and store the results in host_image_tilt_shifted
+                        tiltshift(input_image, output_image, local_memory, blur_mask,
+                                  width, height, 
+                                  buf_width, buf_height, halo, 
+                                  local_size[0], local_size[1],
+                                  sat, con, last_pass, 
+                                  group_corner_x, group_corner_y)
+
+            # Now put the output of the last pass into the input of the next pass.
+            # Swap the two images, like gpu_image_a/gpu_image_b in the OpenCL version,
+            # so that a pass never reads pixels it has already overwritten
+            input_image, output_image = output_image, input_image
     end_time = time.time()
-    print "Took %s seconds to run %s passes" % (end_time - start_time, num_passes)   
+    print("Took %s seconds to run %s passes" % (end_time - start_time, num_passes))
     
     # Display the new image
     plt.imshow(input_image)    
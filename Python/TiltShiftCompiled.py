@@ -0,0 +1,154 @@
+import numpy as np
+import time
+from TiltShiftColorBlurMask import tiltshift_vectorized
+from TiltShiftColorBlurMask import generate_horizontal_blur_mask, generate_circular_blur_mask
+
+# Numba is optional, the NumPy engine is used without it
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+# A compiled Python implementation of the Tilt-Shift effect.
+# The 3x3 stencil is compiled with Numba when it is installed, with the
+# rows of each pass split across cores by prange the way OpenCL splits
+# the image across work groups.  Each pixel reads its neighbours
+# straight from the input, clamped to the edge of the image, which is
+# what the halo of each work group holds in the OpenCL version.
+# The arithmetic is done in float64 and in the same order as boxblur(),
+# saturation() and contrast(), so the result matches the vectorized
+# engine of TiltShiftColorBlurMask.py.
+# Without Numba the passes run on that vectorized engine instead, so
+# this script works either way.  (Cython would need a separate build
+# step, so only Numba is tried.)
+
+if njit is not None:
+    BACKEND = 'numba'
+
+    # Applies one pass of the tilt-shift effect to input_image, writing the
+    # result into output_image.  Compiled the first time it is called.
+    @njit(parallel=True, cache=True)
+    def tiltshift_pass(input_image, output_image, blur_mask,
+                       w, h,
+                       sat, con, last_pass):
+        factor = (259 * (con + 255)) / (255 * (259 - con))
+        for y in prange(h):
+            up = max(y - 1, 0)
+            down = min(y + 1, h - 1)
+            for x in range(w):
+                left = max(x - 1, 0)
+                right = min(x + 1, w - 1)
+
+                # Calculate the blur amount for the central and
+                # neighboring pixels
+                blur_amount = blur_mask[y, x]
+                self_blur_amount = (9 - (blur_amount * 8)) / 9.0
+                other_blur_amount = blur_amount / 9.0
+
+                for c in range(3):
+                    # Sum a weighted average of self and others based on the blur amount,
+                    # then drop the fractional part like the int() calls in boxblur()
+                    others = (float(input_image[up, left, c]) + float(input_image[up, x, c]) +
+                              float(input_image[up, right, c]) + float(input_image[y, left, c]) +
+                              float(input_image[y, right, c]) + float(input_image[down, left, c]) +
+                              float(input_image[down, x, c]) + float(input_image[down, right, c]))
+                    value = np.trunc((self_blur_amount * float(input_image[y, x, c])) +
+                                     (other_blur_amount * others))
+
+                    # If we're in the last pass, perform the saturation and contrast adjustments as well
+                    if last_pass:
+                        value = factor * (value * (1 - sat) - 128) + 128
+                        value = min(max(value, 0.0), 255.0)
+                    output_image[y, x, c] = value
+else:
+    BACKEND = 'numpy'
+
+    # Applies one pass of the tilt-shift effect to input_image, writing the
+    # result into output_image
+    def tiltshift_pass(input_image, output_image, blur_mask,
+                       w, h,
+                       sat, con, last_pass):
+        tiltshift_vectorized(input_image, output_image, blur_mask,
+                             w, h,
+                             sat, con, last_pass)
+
+# Applies num_passes passes of the tilt-shift effect to input_image and
+# returns the filtered image.  The passes ping-pong between two private
+# buffers, so the caller's image is left as it is.
+def tiltshift_compiled(input_image, blur_mask, num_passes, sat, con):
+    height, width = input_image.shape[:2]
+    input_image = np.array(input_image, order='C')
+    output_image = np.zeros_like(input_image)
+    blur_mask = np.ascontiguousarray(blur_mask[:height, :width], dtype=np.float64)
+
+    for pass_num in range(num_passes):
+        last_pass = pass_num == num_passes - 1
+        tiltshift_pass(input_image, output_image, blur_mask,
+                       width, height,
+                       float(sat), float(con), last_pass)
+        # Now put the output of the last pass into the input of the next pass
+        input_image, output_image = output_image, input_image
+    return input_image
+
+# Run a compiled Python implementation of Tilt-Shift
+if __name__ == '__main__':
+    import matplotlib.pyplot as plt
+    import matplotlib.image as mpimg
+    # Load the image
+    input_image = mpimg.imread('../MITBoathouse.png',0)
+    plt.imshow(input_image)
+    plt.show()
+
+    ################################
+    ### USER CHANGEABLE SETTINGS ###
+    ################################
+    # Number of Passes - 3 passes approximates Gaussian Blur
+    num_passes = 3
+    # Saturation - Between 0 and 1
+    sat = 0.0
+    # Contrast - Between -255 and 255
+    con = 0.0
+    # The y-index of the center of the in-focus region
+    middle_in_focus_y = 420
+    # Circle in-focus region, or horizontal in-focus region
+    focused_circle = True
+    # The x-index of the center of the in-focus region
+    # Note: this only matters for circular in-focus region
+    middle_in_focus_x = 650
+    # The number of pixels distance from middle_in_focus to keep in focus
+    in_focus_radius = 200
+    ######################################
+    ### USER CHANGEABLE SETTINGS - END ###
+    ######################################
+
+    width = input_image.shape[1]
+    height = input_image.shape[0]
+    print("Image Width %s" % width)
+    print("Image Height %s" % height)
+
+    # Initialize blur mask to be all 1's (completely blurry)
+    # Note: There is one float blur amount per pixel
+    blur_mask = np.ones(input_image.shape[:2], dtype=np.float64)
+    # Generate the blur mask
+    if focused_circle:
+        generate_circular_blur_mask(blur_mask, middle_in_focus_x, middle_in_focus_y, in_focus_radius, width, height)
+    else:
+        generate_horizontal_blur_mask(blur_mask, middle_in_focus_y, in_focus_radius, height)
+
+    # The first call compiles the stencil (or loads it from Numba's cache),
+    # so time a one pass warm-up separately
+    compile_start_time = time.time()
+    tiltshift_compiled(input_image[:8, :8], blur_mask, 1, sat, con)
+    compile_end_time = time.time()
+
+    start_time = time.time()
+    print("Running %s passes with the %s backend" % (num_passes, BACKEND))
+    output_image = tiltshift_compiled(input_image, blur_mask, num_passes, sat, con)
+    end_time = time.time()
+    print("Compile time was %s seconds" % (compile_end_time - compile_start_time))
+    print("Took %s seconds to run %s passes" % (end_time - start_time, num_passes))
+
+    # Display the new image
+    plt.imshow(output_image)
+    plt.show()
+    mpimg.imsave("MITBoathouseColorTS.png", output_image)
@@ -0,0 +1,230 @@
+import numpy as np
+import atexit
+import multiprocessing
+import time
+from TiltShiftColorBlurMask import boxblur_padded, color_grade
+from TiltShiftColorBlurMask import generate_horizontal_blur_mask, generate_circular_blur_mask
+
+# A multi-core Python implementation of the Tilt-Shift effect.
+# The other Python scripts imitate the OpenCL work groups with a loop
+# over tiles that runs on a single core.  Here the tiles are handed to a
+# pool of worker processes instead, like work groups to compute units:
+#  - the input image, the output image and the blur mask live in shared
+#    memory, so workers read their tile and its one pixel halo straight
+#    from the input and write the blurred tile straight into the output
+#  - every tile of a pass has to be done before the next pass reads the
+#    output, so each pass is one Pool.map(), which only returns once
+#    every tile is done (the barrier between passes)
+#  - the two images swap roles after each pass, like gpu_image_a and
+#    gpu_image_b in the OpenCL version
+# Each tile is blurred with boxblur_padded(), so the result is the same as
+# the vectorized engine of TiltShiftColorBlurMask.py.
+
+# Shared memory that worker processes attach to by name, which a pool that
+# outlives a single image needs (Python 3.8 and later)
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+# The shared images and blur mask, as seen from inside a worker process
+shared_images = []
+shared_blur_mask = None
+# The names of the shared-memory blocks the worker has attached to, and the blocks
+attached_names = None
+attached_blocks = []
+
+# The worker pools, one per number of workers, kept for the next image
+pools = {}
+
+# Returns the pool of num_workers processes, starting it the first time.
+# The workers are started by a fork server (or spawned where there is
+# none) rather than forked from this process, which may have threads of
+# its own by now (Numba's and the OpenCL driver's) that a forked child
+# would deadlock on.
+def worker_pool(num_workers):
+    if num_workers not in pools:
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+        pools[num_workers] = context.Pool(num_workers)
+    return pools[num_workers]
+
+# Shuts down the worker pools
+def close_pools():
+    for pool in pools.values():
+        pool.close()
+        pool.join()
+    pools.clear()
+
+atexit.register(close_pools)
+
+# Returns a shared-memory block for an array of the given shape and dtype,
+# along with a NumPy array viewing it
+def shared_array(shape, dtype):
+    if shared_memory is None:
+        raw = multiprocessing.RawArray('b', int(np.prod(shape)) * np.dtype(dtype).itemsize)
+        return raw, as_array(raw, shape, dtype)
+    block = shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape)) * np.dtype(dtype).itemsize, 1))
+    return block, as_array(block.buf, shape, dtype)
+
+# Returns a NumPy array viewing a shared-memory block, without copying it
+def as_array(raw, shape, dtype):
+    return np.frombuffer(raw, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+
+# Runs in each worker process when a pool without shared_memory starts:
+# views the shared images and blur mask, which stay in place for every pass
+def init_worker(raw_images, raw_blur_mask, image_shape, image_dtype):
+    global shared_images, shared_blur_mask
+    shared_images = [as_array(raw, image_shape, image_dtype) for raw in raw_images]
+    shared_blur_mask = as_array(raw_blur_mask, image_shape[:2], np.float64)
+
+# Runs in a worker process: views the shared images and blur mask of the
+# image a task belongs to, attaching to their blocks by name the first
+# time and letting go of the blocks of the previous image
+def attach(names, image_shape, image_dtype):
+    global shared_images, shared_blur_mask, attached_names, attached_blocks
+    if names == attached_names:
+        return
+    shared_images, shared_blur_mask = [], None
+    for block in attached_blocks:
+        block.close()
+    attached_blocks = [shared_memory.SharedMemory(name=name) for name in names]
+    attached_names = names
+    shared_images = [as_array(block.buf, image_shape, image_dtype) for block in attached_blocks[:2]]
+    shared_blur_mask = as_array(attached_blocks[2].buf, image_shape[:2], np.float64)
+
+# Returns the (x0, x1, y0, y1) bounds of the tiles covering a w x h image
+def tiles(w, h, tile_size):
+    return [(x0, min(x0 + tile_size[0], w), y0, min(y0 + tile_size[1], h))
+            for y0 in range(0, h, tile_size[1])
+            for x0 in range(0, w, tile_size[0])]
+
+# Runs in a worker process: blurs one tile of shared image src into
+# shared image dst, the work of one work group in one pass
+def blur_tile(task):
+    shared, src, dst, x0, x1, y0, y1, sat, con, last_pass = task
+    if shared is not None:
+        attach(*shared)
+    input_image = shared_images[src]
+    h, w = input_image.shape[:2]
+
+    # Read the tile and its one pixel halo, repeating the edge of the
+    # image wherever the halo falls outside of it
+    region = input_image[max(y0 - 1, 0):min(y1 + 1, h), max(x0 - 1, 0):min(x1 + 1, w), :3]
+    padded = np.pad(region.astype(np.float64),
+                    ((int(y0 == 0), int(y1 == h)), (int(x0 == 0), int(x1 == w)), (0, 0)),
+                    mode='edge')
+    blurred = boxblur_padded(padded, shared_blur_mask[y0:y1, x0:x1], x1 - x0, y1 - y0)
+
+    # If we're in the last pass, perform the saturation and contrast adjustments as well
+    if last_pass:
+        blurred = color_grade(blurred, sat, con)
+    shared_images[dst][y0:y1, x0:x1, :3] = blurred
+
+# Applies num_passes passes of the tilt-shift effect to input_image with a
+# pool of num_workers processes (one per core by default), and returns
+# the filtered image.  The pool is kept for the next image with the same
+# number of workers.  Without shared_memory (before Python 3.8) the
+# shared blocks can only be handed to workers as they start, so a pool is
+# forked for each image instead.
+def tiltshift_multiprocess(input_image, blur_mask, num_passes, sat, con,
+                           num_workers=None, tile_size=(256, 256)):
+    height, width = input_image.shape[:2]
+    raw_a, image_a = shared_array(input_image.shape, input_image.dtype)
+    raw_b, image_b = shared_array(input_image.shape, input_image.dtype)
+    raw_blur_mask, shared_mask = shared_array((height, width), np.float64)
+    image_a[...] = input_image
+    # The output image starts out zeroed, like the output image of the other scripts
+    image_b[...] = 0
+    shared_mask[...] = blur_mask[:height, :width]
+    images = [image_a, image_b]
+
+    if shared_memory is None:
+        pool = multiprocessing.Pool(num_workers, init_worker,
+                                    ([raw_a, raw_b], raw_blur_mask, input_image.shape, input_image.dtype))
+        shared = None
+    else:
+        pool = worker_pool(num_workers or multiprocessing.cpu_count())
+        shared = ((raw_a.name, raw_b.name, raw_blur_mask.name), input_image.shape, input_image.dtype)
+    try:
+        src, dst = 0, 1
+        for pass_num in range(num_passes):
+            last_pass = pass_num == num_passes - 1
+            # map() only returns once every tile of this pass is done
+            pool.map(blur_tile, [(shared, src, dst, x0, x1, y0, y1, sat, con, last_pass)
+                                 for x0, x1, y0, y1 in tiles(width, height, tile_size)])
+            # Now put the output of the last pass into the input of the next pass
+            src, dst = dst, src
+        # Copy the result out of shared memory, which goes away with the blocks
+        return images[src].copy()
+    finally:
+        if shared_memory is None:
+            pool.close()
+            pool.join()
+        else:
+            del images, image_a, image_b, shared_mask
+            for block in (raw_a, raw_b, raw_blur_mask):
+                block.close()
+                block.unlink()
+
+# Run a multi-core Python implementation of Tilt-Shift
+if __name__ == '__main__':
+    import matplotlib.pyplot as plt
+    import matplotlib.image as mpimg
+    # Load the image
+    input_image = mpimg.imread('../MITBoathouse.png',0)
+    plt.imshow(input_image)
+    plt.show()
+
+    start_time = time.time()
+
+    ################################
+    ### USER CHANGEABLE SETTINGS ###
+    ################################
+    # Number of Passes - 3 passes approximates Gaussian Blur
+    num_passes = 3
+    # Saturation - Between 0 and 1
+    sat = 0.0
+    # Contrast - Between -255 and 255
+    con = 0.0
+    # The y-index of the center of the in-focus region
+    middle_in_focus_y = 420
+    # Circle in-focus region, or horizontal in-focus region
+    focused_circle = True
+    # The x-index of the center of the in-focus region
+    # Note: this only matters for circular in-focus region
+    middle_in_focus_x = 650
+    # The number of pixels distance from middle_in_focus to keep in focus
+    in_focus_radius = 200
+    # Worker processes, one per core
+    num_workers = multiprocessing.cpu_count()
+    # The size of the tile each worker blurs at a time, like local_size in OpenCL
+    tile_size = (256, 256)
+    ######################################
+    ### USER CHANGEABLE SETTINGS - END ###
+    ######################################
+
+    width = input_image.shape[1]
+    height = input_image.shape[0]
+    print("Image Width %s" % width)
+    print("Image Height %s" % height)
+
+    # Initialize blur mask to be all 1's (completely blurry)
+    # Note: There is one float blur amount per pixel
+    blur_mask = np.ones(input_image.shape[:2], dtype=np.float64)
+    # Generate the blur mask
+    if focused_circle:
+        generate_circular_blur_mask(blur_mask, middle_in_focus_x, middle_in_focus_y, in_focus_radius, width, height)
+    else:
+        generate_horizontal_blur_mask(blur_mask, middle_in_focus_y, in_focus_radius, height)
+
+    print("Running %s passes on %s worker processes" % (num_passes, num_workers))
+    output_image = tiltshift_multiprocess(input_image, blur_mask, num_passes, sat, con,
+                                          num_workers, tile_size)
+    end_time = time.time()
+    print("Took %s seconds to run %s passes" % (end_time - start_time, num_passes))
+
+    # Display the new image
+    plt.imshow(output_image)
+    plt.show()
+    mpimg.imsave("MITBoathouseColorTS.png", output_image)
@@ -0,0 +1,157 @@
+import os.path
+import sys
+import numpy as np
+import pytest
+
+# Regression tests for the Tilt-Shift engines.  Every engine is meant to
+# give the same output as a simpler one it replaces, so each test runs
+# two of them on a small synthetic image and checks that they match
+# exactly.  The images are small and not multiples of the local sizes,
+# so the edges of the image and of the work groups, tiles and bands are
+# all covered.  The OpenCL tests are skipped without pyopencl or an
+# OpenCL platform.
+
+# The engines live in the Python and OpenCL directories next to this one
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path[:0] = [os.path.join(REPO_DIR, 'Python'), os.path.join(REPO_DIR, 'OpenCL')]
+
+# The size of the synthetic images, as (width, height)
+WIDTH, HEIGHT = 45, 37
+
+# The grading and focus used for every test, so the last pass is checked too
+NUM_PASSES = 3
+SAT = 0.1
+CON = 20.0
+MIDDLE_IN_FOCUS = 18
+IN_FOCUS_RADIUS = 6
+
+# Returns a random (h, w, 4) RGBA uint8 image, the same one every time
+def synthetic_image(width=WIDTH, height=HEIGHT):
+    rng = np.random.RandomState(width * 100003 + height)
+    return rng.randint(0, 256, (height, width, 4)).astype(np.uint8)
+
+# Returns the blur mask of the horizontal band the tests keep in focus
+def synthetic_blur_mask(width=WIDTH, height=HEIGHT):
+    from TiltShiftMasks import generate_horizontal_blur_mask
+    blur_mask = np.ones((height, width), dtype=np.float64)
+    generate_horizontal_blur_mask(blur_mask, MIDDLE_IN_FOCUS, IN_FOCUS_RADIUS, height)
+    return blur_mask
+
+# Runs the vectorized engine of TiltShiftColorBlurMask.py on a copy of image
+def run_vectorized(image, blur_mask):
+    from TiltShiftColorBlurMask import tiltshift_vectorized
+    height, width = image.shape[:2]
+    input_image = image.copy()
+    output_image = np.zeros_like(image)
+    for pass_num in range(NUM_PASSES):
+        tiltshift_vectorized(input_image, output_image, blur_mask, width, height,
+                             SAT, CON, pass_num == NUM_PASSES - 1)
+        # Now put the output of the last pass into the input of the next pass
+        input_image, output_image = output_image, input_image
+    return input_image
+
+# The per-work-group loop of TiltShiftColorBlurMask.py, which the other
+# engines are checked against
+def test_vectorized_matches_reference():
+    from TiltShiftColorBlurMask import tiltshift, round_up
+    # The reference writes whole pixels, so it needs an RGB image like the
+    # script loads, and it adds up the neighbours in the image's own type,
+    # so the bytes are widened to keep the sums from wrapping around
+    image = synthetic_image()[..., :3].astype(np.int32)
+    blur_mask = synthetic_blur_mask()
+    local_size = (16, 16)
+    global_size = (round_up(WIDTH, local_size[0]), round_up(HEIGHT, local_size[1]))
+    local_memory = [[]] * (local_size[0] + 2) * (local_size[1] + 2)
+
+    input_image = image.copy()
+    output_image = np.zeros_like(image)
+    for pass_num in range(NUM_PASSES):
+        for group_corner_x in range(0, global_size[0], local_size[0]):
+            for group_corner_y in range(0, global_size[1], local_size[1]):
+                tiltshift(input_image, output_image, local_memory, blur_mask,
+                          WIDTH, HEIGHT,
+                          local_size[0] + 2, local_size[1] + 2, 1,
+                          local_size[0], local_size[1],
+                          SAT, CON, pass_num == NUM_PASSES - 1,
+                          group_corner_x, group_corner_y)
+        input_image, output_image = output_image, input_image
+
+    np.testing.assert_array_equal(run_vectorized(image, blur_mask), input_image)
+
+# TiltShiftMultiprocess.py, with tiles smaller than the image, run twice so
+# the second image goes through the pool kept from the first
+def test_multiprocess_matches_vectorized():
+    from TiltShiftMultiprocess import tiltshift_multiprocess
+    image = synthetic_image()
+    blur_mask = synthetic_blur_mask()
+    expected = run_vectorized(image, blur_mask)
+    for repetition in range(2):
+        rgba_filtered = tiltshift_multiprocess(image, blur_mask, NUM_PASSES, SAT, CON,
+                                               num_workers=2, tile_size=(16, 16))
+        np.testing.assert_array_equal(rgba_filtered[..., :3], expected[..., :3])
+
+# TiltShiftCompiled.py, compiled with Numba when it is installed, which
+# must leave the image it is given alone
+def test_compiled_matches_vectorized():
+    from TiltShiftCompiled import tiltshift_compiled
+    image = synthetic_image()
+    original = image.copy()
+    blur_mask = synthetic_blur_mask()
+    rgba_filtered = tiltshift_compiled(image, blur_mask, NUM_PASSES, SAT, CON)
+    np.testing.assert_array_equal(rgba_filtered[..., :3], run_vectorized(image, blur_mask)[..., :3])
+    np.testing.assert_array_equal(image, original)
+
+# Returns the first OpenCL device, skipping the test if there is none
+def opencl_device():
+    cl = pytest.importorskip('pyopencl')
+    try:
+        platforms = cl.get_platforms()
+    except cl.Error:
+        platforms = []
+    devices = [device for platform in platforms for device in platform.get_devices()]
+    if not devices:
+        pytest.skip('no OpenCL platform')
+    return devices[0]
+
+# An OpenCL session shared by the OpenCL tests, with nothing cached on disk
+@pytest.fixture(scope='module')
+def session():
+    from TiltShiftSession import TiltShiftSession
+    return TiltShiftSession(opencl_device(), cache_dir=None, tuning_path=None)
+
+# Runs the buffer kernels of TiltShiftColorOptimized.py, fused or not
+def run_opencl(session, image, fused):
+    from TiltShiftColorOptimized import tiltshift_rgba
+    return tiltshift_rgba(session, image, NUM_PASSES, SAT, CON, MIDDLE_IN_FOCUS, IN_FOCUS_RADIUS,
+                          fused=fused, images=False)
+
+# The fused kernel, the kernel launched once per pass and the image2d_t kernel
+def test_opencl_fused_matches_unfused_and_image(session):
+    from TiltShiftColorImage import supports_images, tiltshift_image
+    image = synthetic_image()
+    fused = run_opencl(session, image, True)
+    np.testing.assert_array_equal(fused, run_opencl(session, image, False))
+    if not supports_images(session, WIDTH, HEIGHT):
+        pytest.skip('the device does not support RGBA8 images')
+    np.testing.assert_array_equal(fused, tiltshift_image(session, image, NUM_PASSES, SAT, CON,
+                                                         MIDDLE_IN_FOCUS, IN_FOCUS_RADIUS))
+
+# TiltShiftMultiDevice.py, with the image split into bands on two contexts
+# of the same device, which exchange their halos between passes
+def test_multi_device_matches_single_device(session):
+    from TiltShiftMultiDevice import MultiDeviceSession, tiltshift_multi
+    image = synthetic_image()
+    multi = MultiDeviceSession([session.device, session.device], cache_dir=None, tuning_path=None)
+    rgba_filtered = tiltshift_multi(multi, image, NUM_PASSES, SAT, CON,
+                                    MIDDLE_IN_FOCUS, IN_FOCUS_RADIUS)
+    np.testing.assert_array_equal(rgba_filtered, run_opencl(session, image, False))
+
+# TiltShiftTiled.py, with bands a few rows high so most rows are near a band edge
+@pytest.mark.parametrize('fused', [True, False])
+def test_tiled_matches_whole_image(session, fused):
+    from TiltShiftTiled import tiltshift_tiled
+    image = synthetic_image()
+    rgba_filtered = np.zeros_like(image)
+    tiltshift_tiled(session, image, rgba_filtered, NUM_PASSES, SAT, CON,
+                    MIDDLE_IN_FOCUS, IN_FOCUS_RADIUS, fused=fused, band_height=10)
+    np.testing.assert_array_equal(rgba_filtered, run_opencl(session, image, fused))
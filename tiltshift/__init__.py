@@ -0,0 +1,99 @@
+import os.path
+import sys
+import numpy as np
+
+# The Tilt-Shift effect as a library:
+#   import tiltshift
+#   filtered = tiltshift.tilt_shift(image, backend='vectorized', middle_in_focus=420)
+# The backends are the engines of the scripts in Python/ and OpenCL/,
+# registered by name in tiltshift/backends.py.  Importing the package only
+# imports NumPy.  pyopencl, Numba and multiprocessing are imported by the
+# backends that use them, the first time they run, and matplotlib only by
+# preview(), so a worker that only calls tilt_shift() never loads it.
+
+# The scripts import each other by module name, so their directories go on the path
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+for directory in [os.path.join(REPO_DIR, 'Python'), os.path.join(REPO_DIR, 'OpenCL')]:
+    if directory not in sys.path:
+        sys.path.append(directory)
+
+from tiltshift.backends import BACKENDS, register_backend, available_backends, get_backend
+from TiltShiftImageIO import load_rgba, save_rgba
+
+__all__ = ['tilt_shift', 'preview', 'load_rgba', 'save_rgba', 'BACKENDS', 'register_backend',
+           'available_backends', 'get_backend']
+
+# Returns the image as a contiguous (h, w, 4) RGBA uint8 array, whether it
+# is grayscale, RGB or RGBA, and bytes or floats between 0 and 1
+def as_rgba(image):
+    from TiltShiftPixels import to_rgba
+    image = np.asarray(image)
+    if image.ndim == 2:
+        image = np.dstack([image] * 3)
+    return np.ascontiguousarray(to_rgba(image))
+
+# Returns the blur mask of a focus shape (see generate_shape_blur_mask() in
+# OpenCL/TiltShiftMasks.py) as an (h, w) float64 array
+def focus_mask(width, height, middle_in_focus, in_focus_radius, middle_in_focus_x=None,
+               shape='horizontal', fade=0.2, angle=0.0, radius_y=None, vertices=None):
+    from TiltShiftMasks import generate_shape_blur_mask
+    blur_mask = np.ones((height, width), dtype=np.float64)
+    generate_shape_blur_mask(blur_mask, shape, middle_in_focus_x, middle_in_focus, in_focus_radius,
+                             width, height, fade, angle, radius_y, vertices)
+    return blur_mask
+
+# Applies the tilt-shift effect to an image and returns the result as
+# uint8, with as many channels as the image (grayscale comes back as RGB).
+# The in-focus region is a horizontal band of in_focus_radius around the
+# row middle_in_focus (by default the middle of the image and an eighth of
+# its height), or another shape around (middle_in_focus_x, middle_in_focus):
+# 'circular' (the default when middle_in_focus_x is given), 'band',
+# 'elliptical' or 'polygon', with the fade, angle, radius_y and vertices
+# of focus_mask().  Backends with a blur mask also take any (h, w)
+# blur_mask of blur amounts between 0 and 1.  Any other options are passed
+# on to the backend (see tiltshift/backends.py).
+def tilt_shift(image, backend='vectorized', num_passes=3, sat=0.0, con=0.0,
+               middle_in_focus=None, in_focus_radius=None, middle_in_focus_x=None,
+               blur_mask=None, tone_curve=None, shape=None, fade=0.2, angle=0.0,
+               radius_y=None, vertices=None, **options):
+    run, uses_mask = get_backend(backend)
+    rgba = as_rgba(image)
+    height, width = rgba.shape[:2]
+    if middle_in_focus is None:
+        middle_in_focus = height // 2
+    if in_focus_radius is None:
+        in_focus_radius = max(height // 8, 1)
+    if shape is None:
+        shape = 'horizontal' if middle_in_focus_x is None else 'circular'
+    if shape != 'horizontal' and middle_in_focus_x is None:
+        middle_in_focus_x = width // 2
+
+    if uses_mask:
+        if blur_mask is None:
+            blur_mask = focus_mask(width, height, middle_in_focus, in_focus_radius, middle_in_focus_x,
+                                   shape, fade, angle, radius_y, vertices)
+        elif np.shape(blur_mask)[:2] != (height, width):
+            raise ValueError('The blur mask is %s but the image is %s x %s'
+                             % (np.shape(blur_mask), height, width))
+    elif blur_mask is not None:
+        raise ValueError('The %s backend evaluates the focus shape itself and takes no blur mask' % backend)
+    else:
+        # The kernels evaluate the shape on the device from its parameters
+        from TiltShiftMasks import focus_params
+        options['focus'] = focus_params(shape, middle_in_focus_x, middle_in_focus, in_focus_radius,
+                                        fade, angle, radius_y, vertices)
+
+    rgba_filtered = run(rgba, num_passes=num_passes, sat=sat, con=con,
+                        middle_in_focus=middle_in_focus, in_focus_radius=in_focus_radius,
+                        blur_mask=blur_mask, tone_curve=tone_curve, **options)
+    if np.ndim(image) == 3 and np.shape(image)[2] == 4:
+        return rgba_filtered
+    return rgba_filtered[..., :3]
+
+# Shows an image with matplotlib, which is only imported here
+def preview(image, title=None):
+    import matplotlib.pyplot as plt
+    plt.imshow(image)
+    if title is not None:
+        plt.title(title)
+    plt.show()
@@ -0,0 +1,139 @@
+import collections
+import numpy as np
+
+# The registry of Tilt-Shift backends for tilt_shift() (see __init__.py).
+# A backend is a function
+#   run(rgba, num_passes, sat, con, middle_in_focus, in_focus_radius,
+#       blur_mask, tone_curve, **options)
+# that takes an (h, w, 4) RGBA uint8 image and returns the filtered one,
+# keeping its alpha channel.  Backends that use a blur mask get the
+# (h, w) blur amounts in blur_mask, the others get None and evaluate the
+# focus shape themselves from the focus parameters of focus_params()
+# (see OpenCL/TiltShiftMasks.py), passed as the focus option.  Each backend imports its engine when it
+# runs, so registering them imports nothing.
+
+# name: (run, uses_mask), in the order they are registered
+BACKENDS = collections.OrderedDict()
+
+# Registers the decorated function as the backend called name
+def register_backend(name, uses_mask=True):
+    def register(run):
+        BACKENDS[name] = (run, uses_mask)
+        return run
+    return register
+
+# Returns the names of the registered backends
+def available_backends():
+    return list(BACKENDS)
+
+# Returns the (run, uses_mask) of a backend
+def get_backend(name):
+    if name not in BACKENDS:
+        raise ValueError('Unknown backend %r, expected one of %s' % (name, ', '.join(BACKENDS)))
+    return BACKENDS[name]
+
+# Raises ValueError for a tone curve passed to a backend that cannot apply one
+def check_no_tone_curve(name, tone_curve):
+    if tone_curve is not None:
+        raise ValueError('The %s backend does not apply tone curves' % name)
+
+# The OpenCL session the OpenCL backends share unless they are given one,
+# created the first time one of them runs
+_session = None
+
+def default_session():
+    global _session
+    if _session is None:
+        from TiltShiftSession import TiltShiftSession
+        _session = TiltShiftSession()
+    return _session
+
+# The NumPy engine of Python/TiltShiftColorBlurMask.py, one call per pass
+@register_backend('vectorized')
+def run_vectorized(rgba, num_passes, sat, con, middle_in_focus, in_focus_radius,
+                   blur_mask, tone_curve):
+    from TiltShiftColorBlurMask import tiltshift_vectorized
+    height, width = rgba.shape[:2]
+    input_image = rgba.copy()
+    output_image = rgba.copy()
+    for pass_num in range(num_passes):
+        tiltshift_vectorized(input_image, output_image, blur_mask, width, height,
+                             sat, con, pass_num == num_passes - 1, tone_curve)
+        # Now put the output of the last pass into the input of the next pass
+        input_image, output_image = output_image, input_image
+    return input_image
+
+# The running-sum engine of Python/TiltShiftColorBlurMask.py, one sweep per pass
+@register_backend('running_sum')
+def run_running_sum(rgba, num_passes, sat, con, middle_in_focus, in_focus_radius,
+                    blur_mask, tone_curve, max_blur_radius=8):
+    from TiltShiftColorBlurMask import tiltshift_running_sum
+    height, width = rgba.shape[:2]
+    return tiltshift_running_sum(rgba, rgba.copy(), blur_mask, width, height,
+                                 max_blur_radius, num_passes, sat, con, tone_curve)
+
+# The pyramid engine of Python/TiltShiftColorBlurMask.py
+@register_backend('pyramid')
+def run_pyramid(rgba, num_passes, sat, con, middle_in_focus, in_focus_radius,
+                blur_mask, tone_curve, levels=2):
+    from TiltShiftColorBlurMask import tiltshift_pyramid
+    height, width = rgba.shape[:2]
+    return tiltshift_pyramid(rgba, rgba.copy(), blur_mask, width, height,
+                             num_passes, levels, sat, con, tone_curve)
+
+# Python/TiltShiftMultiprocess.py, one worker per core by default
+@register_backend('multiprocess')
+def run_multiprocess(rgba, num_passes, sat, con, middle_in_focus, in_focus_radius,
+                     blur_mask, tone_curve, num_workers=None, tile_size=(256, 256)):
+    from TiltShiftMultiprocess import tiltshift_multiprocess
+    check_no_tone_curve('multiprocess', tone_curve)
+    rgba_filtered = tiltshift_multiprocess(rgba, blur_mask, num_passes, sat, con,
+                                           num_workers, tile_size)
+    rgba_filtered[..., 3] = rgba[..., 3]
+    return rgba_filtered
+
+# Python/TiltShiftCompiled.py, compiled with Numba when it is installed
+@register_backend('compiled')
+def run_compiled(rgba, num_passes, sat, con, middle_in_focus, in_focus_radius,
+                 blur_mask, tone_curve):
+    from TiltShiftCompiled import tiltshift_compiled
+    check_no_tone_curve('compiled', tone_curve)
+    rgba_filtered = tiltshift_compiled(rgba, blur_mask, num_passes, sat, con)
+    rgba_filtered[..., 3] = rgba[..., 3]
+    return rgba_filtered
+
+# The Optimized OpenCL kernels (OpenCL/TiltShiftColorOptimized.py).
+# images=None runs the image2d_t kernel where the device supports it, and
+# images=False the buffer kernels, fused or not.
+@register_backend('opencl', uses_mask=False)
+def run_opencl(rgba, num_passes, sat, con, middle_in_focus, in_focus_radius,
+               blur_mask, tone_curve, session=None, local_size=None, fused=True, images=None,
+               focus=None):
+    from TiltShiftColorOptimized import tiltshift_rgba
+    return tiltshift_rgba(session or default_session(), rgba, num_passes, sat, con,
+                          middle_in_focus, in_focus_radius, local_size, fused, tone_curve, images,
+                          focus)
+
+# The pyramid version of the Optimized kernels (OpenCL/TiltShiftColorPyramid.py)
+@register_backend('opencl_pyramid', uses_mask=False)
+def run_opencl_pyramid(rgba, num_passes, sat, con, middle_in_focus, in_focus_radius,
+                       blur_mask, tone_curve, session=None, levels=2, local_size=None, fused=True,
+                       focus=None):
+    from TiltShiftColorPyramid import tiltshift_pyramid
+    return tiltshift_pyramid(session or default_session(), rgba, num_passes, sat, con,
+                             middle_in_focus, in_focus_radius, levels, local_size, fused, tone_curve,
+                             focus)
+
+# The separable running-sum OpenCL kernels (OpenCL/TiltShiftColorRunningSum.py),
+# one sweep of a box of up to max_blur_radius pixels per pass.  The kernels
+# write the blur mask into the alpha bytes, so the alpha of the image is put back
+@register_backend('opencl_running_sum', uses_mask=False)
+def run_opencl_running_sum(rgba, num_passes, sat, con, middle_in_focus, in_focus_radius,
+                           blur_mask, tone_curve, session=None, max_blur_radius=8, local_size=None,
+                           focus=None):
+    from TiltShiftColorRunningSum import tiltshift_running_sum
+    rgba_filtered = tiltshift_running_sum(session or default_session(), rgba, num_passes, sat, con,
+                                          middle_in_focus, in_focus_radius, max_blur_radius,
+                                          local_size, tone_curve, focus)
+    rgba_filtered[..., 3] = rgba[..., 3]
+    return rgba_filtered